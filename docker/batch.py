@@ -0,0 +1,371 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+"""
+batch.py re-processes a catalog of videos with the lambda_handler of a model container
+on one machine. A pool of worker processes loads the models once per worker and runs
+the videos through the handler with an unlimited deadline, so the outputs, progress
+manifests and result cache entries are the same as the ones of the lambda.
+
+usage:
+    python batch.py <container dir> --root /data/catalog [--workers 8] [--threads 4]
+    python batch.py <container dir> --manifest videos.jsonl [--event '{"decoder": "torchvision"}']
+
+--root processes every directory under it with a framesegmentation json (read and
+written through the file:// storage), --manifest a json list or json lines of events
+with at least "bucket" and "prefix". The fields of the container default events,
+--event and the manifest are merged in this order.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+FRAMESEGMENTATION_JSON = "framesegmentation.json"
+
+# default events of the model containers, as sent by the state machines
+EVENTS = {
+    "zero-shot-classifier-on-aws": {
+        "json": FRAMESEGMENTATION_JSON,
+        "embeddings": "scene_embeddings.json",
+    },
+    "zero-shot-object-on-aws": {
+        "json": FRAMESEGMENTATION_JSON,
+        "output": "object_detection.json",
+    },
+    "shoppable-on-aws": {
+        "json": FRAMESEGMENTATION_JSON,
+        "embeddings": "shoppable_embeddings.json",
+    },
+}
+# output field of each container
+OUTPUT_FIELDS = {
+    "zero-shot-classifier-on-aws": "embeddings",
+    "zero-shot-object-on-aws": "output",
+    "shoppable-on-aws": "embeddings",
+}
+
+# model loaders of the containers, called once per worker
+MODEL_LOADERS = ["load_cls_model", "load_obj_model", "load_model"]
+
+# torch threads of a worker, the default number of workers fills the cpus
+THREADS_PER_WORKER = 4
+
+# quit_now() of the containers stops processing with 60s left
+QUIT_MARGIN_MS = 60000
+# max number of invocations of a video, guards against a handler that never completes
+MAX_INVOCATIONS = 1000
+
+# state of a worker process, set by init_worker()
+_worker = {}
+
+class BatchContext:
+    """
+    BatchContext stands in for the lambda context, the deadline never comes and the
+    memory limit is the share of the worker
+    """
+    def __init__(self, request_id, memory_limit_in_mb = None):
+        self.aws_request_id = request_id
+        self.function_name = "batch"
+        if memory_limit_in_mb is not None:
+            self.memory_limit_in_mb = str(memory_limit_in_mb)
+
+    def get_remaining_time_in_millis(self):
+        return QUIT_MARGIN_MS * 1000
+
+def load_models_once(app):
+    """
+    load_models_once() replaces the model loaders of the container by loaders that keep
+    the models of each checkpoint, the handler calls them on every invocation
+
+    :param app: app module of the container
+    """
+    for name in MODEL_LOADERS:
+        loader = getattr(app, name, None)
+        if loader is None:
+            continue
+
+        models = {}
+
+        def cached_loader(*args, loader = loader, models = models, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            if key not in models:
+                models[key] = loader(*args, **kwargs)
+            return models[key]
+
+        setattr(app, name, cached_loader)
+
+def init_worker(container_dir, options):
+    """
+    init_worker() imports the container and loads its models in a worker process
+
+    :param container_dir: directory of the container
+    :param options: threads, checkpoints, memory_limit_in_mb and log_dir
+    """
+    os.chdir(container_dir)
+    sys.path.insert(0, container_dir)
+
+    # the handlers print every frame, the log of a worker goes to its own file
+    log = os.devnull
+    if options["log_dir"] is not None:
+        log = os.path.join(options["log_dir"], f"worker_{os.getpid()}.log")
+    sys.stdout = open(log, "a", buffering=1)
+
+    import torch
+    torch.set_num_threads(options["threads"])
+
+    import app
+    import utils
+
+    for name, checkpoint in options["checkpoints"].items():
+        loader = getattr(app, name, None)
+        if loader is not None:
+            loader.__defaults__ = (checkpoint,)
+    load_models_once(app)
+
+    t0 = time.perf_counter()
+    for name in MODEL_LOADERS:
+        if hasattr(app, name):
+            getattr(app, name)()
+
+    _worker.update({
+        "app": app,
+        "utils": utils,
+        "options": options,
+        "model_load": round(time.perf_counter() - t0, 3),
+        "videos": 0,
+    })
+
+def is_completed(utils, event, output_field):
+    """
+    is_completed() checks the progress manifest of the output of a previous run
+
+    :param utils: utils module of the container
+    :param event: event of the video
+    :param output_field: output field of the container
+    :return: True if all frames of the video were processed, False if not or unknown
+    """
+    try:
+        output = event[output_field]
+        progress = utils.loads(utils.get_object(event["bucket"], utils.get_progress_key(event["prefix"], output)))
+        return int(progress["processed"]) >= int(progress["total"])
+    except Exception:
+        return False
+
+def find_completed(container_dir, events, output_field):
+    """
+    find_completed() checks the progress manifests of the videos in parallel before
+    the workers load the models
+
+    :param container_dir: directory of the container
+    :param events: events of the videos
+    :param output_field: output field of the container
+    :return: [bool], one per event
+    """
+    # the storage of the container, utils loads its heavy modules on first use
+    sys.path.insert(0, container_dir)
+    import utils
+
+    return list(utils.map_objects(lambda event: is_completed(utils, event, output_field), events))
+
+def run_video(event):
+    """
+    run_video() runs a video through the re-entry loop of the lambda_handler in a worker
+
+    :param event: event of the video
+    :return: { bucket, prefix, status, frames, elapsed, invocations, worker, model_load, error }
+    """
+    app, utils, options = _worker["app"], _worker["utils"], _worker["options"]
+    # a malformed event is reported as FAILED like any other error of the video
+    result = {
+        "bucket": event.get("bucket"),
+        "prefix": event.get("prefix"),
+        "worker": os.getpid(),
+    }
+    # model loading is reported once per worker
+    if _worker["videos"] == 0:
+        result["model_load"] = _worker["model_load"]
+    _worker["videos"] += 1
+
+    t0 = time.perf_counter()
+    invocations = 0
+    try:
+        names = utils.loads(utils.get_object(event["bucket"], os.path.join(event["prefix"], event["json"])))
+        while event.get("status") != "COMPLETED" and invocations < MAX_INVOCATIONS:
+            context = BatchContext(f"batch-{os.getpid()}-{_worker['videos']}-{invocations}", options["memory_limit_in_mb"])
+            event = app.lambda_handler(event, context)
+            invocations += 1
+        status = event.get("status")
+        error = None if status == "COMPLETED" else f"not completed after {invocations} invocations"
+    except Exception as e:
+        names = []
+        status = "FAILED"
+        error = f"{type(e).__name__}: {e}"
+    sys.stdout.flush()
+
+    return {
+        **result,
+        "status": status if error is None else "FAILED",
+        "frames": len(names),
+        "elapsed": round(time.perf_counter() - t0, 3),
+        "invocations": invocations,
+        "error": error,
+    }
+
+def find_videos(root, json_name):
+    """
+    find_videos() directories under root with a framesegmentation json
+
+    :param root: local directory of the catalog
+    :param json_name: name of the framesegmentation json
+    :return: [{ bucket, prefix }], the bucket is the file:// storage of root
+    """
+    root = os.path.abspath(root)
+    videos = []
+    for path, dirs, files in os.walk(root):
+        dirs.sort()
+        if json_name in files:
+            videos.append({
+                "bucket": f"file://{root}",
+                "prefix": os.path.relpath(path, root),
+            })
+    return videos
+
+def load_manifest(path):
+    """
+    load_manifest() events of a manifest, a json list or json lines
+
+    :param path: path of the manifest
+    :return: [event]
+    """
+    with open(path) as f:
+        body = f.read().strip()
+    if body.startswith("["):
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+def get_memory_mb():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def print_result(result, done, total):
+    line = f"== [{done}/{total}] {result['prefix']}: {result['status']}, {result['frames']} frames, {result['elapsed']}s"
+    if result["elapsed"] > 0:
+        line += f", {round(result['frames'] / result['elapsed'], 3)} frames/s"
+    if "model_load" in result:
+        line += f", worker {result['worker']} model load {result['model_load']}s"
+    if result.get("error") is not None:
+        line += f", {result['error']}"
+    print(line, flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="re-process videos with a model container on all cpus")
+    parser.add_argument("container", help="directory of the container, e.g. zero-shot-classifier-on-aws")
+    parser.add_argument("--root", default=None, help="local directory of the videos")
+    parser.add_argument("--manifest", default=None, help="json list or json lines of events")
+    parser.add_argument("--event", default="{}", help="json fields merged into every event")
+    parser.add_argument("--threads", type=int, default=THREADS_PER_WORKER, help="torch threads per worker")
+    parser.add_argument("--workers", type=int, default=None, help="default to cpus / threads")
+    parser.add_argument("--memory-mb", type=int, default=None, help="memory limit of a worker, default to its share of the memory")
+    parser.add_argument("--checkpoint", action="append", default=[], help="<loader>=<checkpoint>, e.g. load_cls_model=/models/clip")
+    parser.add_argument("--skip-completed", action="store_true", help="skip the videos completed by a previous run")
+    parser.add_argument("--log-dir", default=None, help="directory of the logs of the handlers, discarded by default")
+    parser.add_argument("--output", default=None, help="write the report json")
+    args = parser.parse_args()
+
+    container_dir = os.path.abspath(args.container)
+    container = os.path.basename(container_dir.rstrip(os.sep))
+    if container not in EVENTS:
+        parser.error(f"not a model container: {container}, one of {', '.join(EVENTS)}")
+
+    base = { **EVENTS[container], **json.loads(args.event) }
+    entries = []
+    if args.root is not None:
+        entries += find_videos(args.root, base["json"])
+    if args.manifest is not None:
+        entries += load_manifest(args.manifest)
+    if len(entries) == 0:
+        parser.error("no videos, see --root and --manifest")
+    events = [{ **base, **entry } for entry in entries]
+
+    # completed videos are skipped before any worker loads the models
+    results = []
+    pending = events
+    if args.skip_completed:
+        completed = find_completed(container_dir, events, OUTPUT_FIELDS[container])
+        pending = [event for event, done in zip(events, completed) if not done]
+        for event, done in zip(events, completed):
+            if done:
+                results.append({
+                    "bucket": event["bucket"],
+                    "prefix": event["prefix"],
+                    "status": "SKIPPED",
+                    "frames": 0,
+                    "elapsed": 0,
+                    "invocations": 0,
+                })
+                print_result(results[-1], len(results), len(events))
+
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+    workers = max(1, min(workers, len(pending)))
+    memory_limit_in_mb = args.memory_mb
+    if memory_limit_in_mb is None and get_memory_mb() is not None:
+        memory_limit_in_mb = get_memory_mb() // workers
+    if args.log_dir is not None:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    options = {
+        "threads": args.threads,
+        "checkpoints": dict(item.split("=", 1) for item in args.checkpoint),
+        "memory_limit_in_mb": memory_limit_in_mb,
+        "log_dir": args.log_dir and os.path.abspath(args.log_dir),
+    }
+    # OpenMP of the workers is sized before torch is imported
+    os.environ["OMP_NUM_THREADS"] = str(args.threads)
+    print(f"== [info]: {container}: {len(pending)}/{len(events)} videos, {workers} workers x {args.threads} threads, {memory_limit_in_mb}MB per worker", flush=True)
+
+    t0 = time.perf_counter()
+    if len(pending) > 0:
+        # spawn, a forked torch can hang in its thread pools
+        pool = multiprocessing.get_context("spawn").Pool(workers, init_worker, (container_dir, options))
+        try:
+            for result in pool.imap_unordered(run_video, pending):
+                results.append(result)
+                print_result(result, len(results), len(events))
+        finally:
+            pool.terminate()
+    elapsed = time.perf_counter() - t0
+
+    frames = sum(result["frames"] for result in results if result["status"] == "COMPLETED")
+    model_load = [result["model_load"] for result in results if "model_load" in result]
+    counts = { status: sum(result["status"] == status for result in results) for status in ["COMPLETED", "SKIPPED", "FAILED"] }
+    report = {
+        "container": container,
+        "videos": len(events),
+        **{ status.lower(): count for status, count in counts.items() },
+        "frames": frames,
+        "elapsed": round(elapsed, 3),
+        "frames_per_sec": round(frames / elapsed, 3) if elapsed > 0 else 0,
+        # throughput once the models are loaded, the workers load them in parallel
+        "frames_per_sec_after_load": round(frames / (elapsed - max(model_load, default=0)), 3) if elapsed > max(model_load, default=0) else 0,
+        "workers": workers,
+        "threads": args.threads,
+        "cpus": os.cpu_count(),
+        "model_load_max": max(model_load, default=0),
+        "results": results,
+    }
+    print(f"== {container}: {counts['COMPLETED']} completed, {counts['SKIPPED']} skipped, {counts['FAILED']} failed, "
+        f"{frames} frames in {report['elapsed']}s, {report['frames_per_sec']} frames/s, "
+        f"{report['frames_per_sec_after_load']} frames/s after the model load of {report['model_load_max']}s ({workers} workers)", flush=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if counts["FAILED"] > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
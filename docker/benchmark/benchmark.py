@@ -0,0 +1,538 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+"""
+benchmark.py end-to-end offline benchmark of the model containers. It renders a
+synthetic video (N frames and a framesegmentation json), serves it from a local S3
+endpoint and drives each lambda_handler through the re-entry loop with a fake
+context. Each container runs in its own interpreter, as in its own lambda.
+
+usage:
+    python benchmark.py [--frames 48] [--budget 20] [--tiny-models] [container ...]
+    python benchmark.py --tiny-models --repeat 3 --save-baseline        # update baseline.json
+    python benchmark.py --tiny-models --repeat 3 --fail-on-regression   # exit 1 on regression
+    python benchmark.py --tiny-models --frames-pack range               # frames read from one pack
+
+Records per container: frames/sec, per-stage latency, peak RSS, number of invocations
+and bytes moved, and compares them against the committed baseline.json. Numbers are
+only comparable with a baseline of the same config (frames, size, models, cpus).
+"""
+import os
+import io
+import sys
+import json
+import gzip
+import time
+import random
+import tarfile
+import argparse
+import platform
+import tempfile
+import subprocess
+from s3local import LocalS3
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCKER_DIR = os.path.dirname(BENCHMARK_DIR)
+WORKER = os.path.join(BENCHMARK_DIR, "worker.py")
+BASELINE_JSON = os.path.join(BENCHMARK_DIR, "baseline.json")
+RESULT_PREFIX = "BENCHMARK_RESULT"
+
+BUCKET = "benchmark"
+FRAMESEGMENTATION_JSON = "framesegmentation.json"
+# frames pack written next to the frames with --frames-pack, see write_frame_pack() of utils
+FRAMES_PACK = "frames.tar"
+FRAMES_PACK_INDEX = f"{FRAMES_PACK}.index.json"
+
+# events of the containers, in run order. faiss indexes the embeddings of the classifier.
+EVENTS = {
+    "zero-shot-classifier-on-aws": {
+        "json": FRAMESEGMENTATION_JSON,
+        "embeddings": "classifier_embeddings.json",
+    },
+    "zero-shot-object-on-aws": {
+        "json": FRAMESEGMENTATION_JSON,
+        "output": "object_detection.json",
+    },
+    "shoppable-on-aws": {
+        "json": FRAMESEGMENTATION_JSON,
+        "embeddings": "shoppable_embeddings.json",
+    },
+    "faiss-on-aws": {
+        "embeddings": "classifier_embeddings.json",
+        "similarity": "frame_similarity.json",
+    },
+}
+# output of each container, counted to check the run
+OUTPUTS = {
+    "zero-shot-classifier-on-aws": "classifier_embeddings.json",
+    "zero-shot-object-on-aws": "object_detection.json",
+    "shoppable-on-aws": "shoppable_embeddings.json",
+    "faiss-on-aws": "frame_similarity.json",
+}
+# model loaders of the containers and the tiny model they use with --tiny-models
+TINY_CHECKPOINTS = {
+    "load_cls_model": "tiny-clip",
+    "load_obj_model": "tiny-owlvit",
+    "load_model": "tiny-owlvit",
+}
+
+# metrics compared against the baseline, True if higher is better
+COMPARED_METRICS = {
+    "fps": True,
+    "elapsed": False,
+    "model_load": False,
+    "invocations": False,
+    "peak_rss": False,
+    "bytes_out": False,
+    "bytes_in": False,
+}
+# relative change reported as a regression, run to run noise of a small run is about 10%
+REGRESSION_THRESHOLD = 0.2
+
+def render_video(frames, width, height, shot_length, seed = 0):
+    """
+    render_video() renders a synthetic video, moving shapes on a background that
+    changes per shot
+
+    :param frames: number of frames
+    :param width: width of the frames
+    :param height: height of the frames
+    :param shot_length: number of frames per shot
+    :param seed: (optional) random seed
+    :return: [(name, jpeg bytes)], framesegmentation json
+    """
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(seed)
+    shots = []
+    images = []
+    framesegmentation = []
+
+    for idx in range(frames):
+        shot_idx = idx // shot_length
+        if shot_idx >= len(shots):
+            shots.append({
+                "background": tuple(rnd.randrange(256) for _ in range(3)),
+                "shapes": [
+                    (
+                        tuple(rnd.randrange(256) for _ in range(3)),
+                        rnd.uniform(0.05, 0.3) * width,
+                        rnd.uniform(0, 1), rnd.uniform(0, 1),
+                        rnd.uniform(-0.02, 0.02), rnd.uniform(-0.02, 0.02),
+                    ) for _ in range(rnd.randint(2, 5))
+                ],
+            })
+        shot = shots[shot_idx]
+        step = idx % shot_length
+
+        image = Image.new("RGB", (width, height), shot["background"])
+        draw = ImageDraw.Draw(image)
+        for color, size, x, y, dx, dy in shot["shapes"]:
+            cx = ((x + dx * step) % 1) * width
+            cy = ((y + dy * step) % 1) * height
+            draw.ellipse([cx - size / 2, cy - size / 3, cx + size / 2, cy + size / 3], fill=color)
+            draw.rectangle([cx - size / 4, cy - size / 2, cx + size / 4, cy - size / 3], fill=color[::-1])
+
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=85)
+        name = f"frame.{idx:07d}.jpg"
+        images.append((name, buffer.getvalue()))
+        framesegmentation.append({
+            "name": name,
+            "frameNo": idx,
+            "timestamp": idx * 1000,
+            "shotIdx": shot_idx,
+        })
+    return images, framesegmentation
+
+def build_tiny_models(path, seed = 0):
+    """
+    build_tiny_models() saves randomly initialized CLIP and OWL-ViT models with a
+    character tokenizer, exercises the code paths without downloading checkpoints
+
+    :param path: output directory
+    :param seed: (optional) random seed of the weights
+    :return: { name: directory }
+    """
+    import torch
+    from transformers import (
+        CLIPConfig, CLIPModel, CLIPTokenizer, CLIPImageProcessor, CLIPProcessor,
+        OwlViTConfig, OwlViTForObjectDetection, OwlViTImageProcessor, OwlViTProcessor)
+
+    tokenizer_dir = os.path.join(path, "tokenizer")
+    os.makedirs(tokenizer_dir, exist_ok=True)
+    vocab = {}
+    for char in "abcdefghijklmnopqrstuvwxyz0123456789-":
+        vocab[char] = len(vocab)
+        vocab[f"{char}</w>"] = len(vocab)
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    with open(os.path.join(tokenizer_dir, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(tokenizer_dir, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(
+        os.path.join(tokenizer_dir, "vocab.json"),
+        os.path.join(tokenizer_dir, "merges.txt"),
+        pad_token="<|endoftext|>",
+        model_max_length=32)
+
+    text_config = {
+        "vocab_size": len(vocab),
+        "hidden_size": 32,
+        "intermediate_size": 37,
+        "num_hidden_layers": 2,
+        "num_attention_heads": 4,
+        "max_position_embeddings": 32,
+        "bos_token_id": len(vocab) - 2,
+        "eos_token_id": len(vocab) - 1,
+        "pad_token_id": len(vocab) - 1,
+    }
+    vision_config = {
+        "hidden_size": 32,
+        "intermediate_size": 37,
+        "num_hidden_layers": 2,
+        "num_attention_heads": 4,
+    }
+
+    torch.manual_seed(seed)
+    checkpoints = {
+        "tiny-clip": os.path.join(path, "tiny-clip"),
+        "tiny-owlvit": os.path.join(path, "tiny-owlvit"),
+    }
+
+    model = CLIPModel(CLIPConfig(
+        text_config=text_config,
+        vision_config={ **vision_config, "image_size": 32, "patch_size": 8 },
+        projection_dim=16))
+    processor = CLIPProcessor(
+        image_processor=CLIPImageProcessor(
+            size={ "shortest_edge": 32 },
+            crop_size={ "height": 32, "width": 32 }),
+        tokenizer=tokenizer)
+    model.save_pretrained(checkpoints["tiny-clip"])
+    processor.save_pretrained(checkpoints["tiny-clip"])
+
+    model = OwlViTForObjectDetection(OwlViTConfig(
+        text_config=text_config,
+        vision_config={ **vision_config, "image_size": 64, "patch_size": 16 },
+        projection_dim=32))
+    processor = OwlViTProcessor(
+        image_processor=OwlViTImageProcessor(
+            size={ "height": 64, "width": 64 },
+            crop_size={ "height": 64, "width": 64 }),
+        tokenizer=tokenizer)
+    model.save_pretrained(checkpoints["tiny-owlvit"])
+    processor.save_pretrained(checkpoints["tiny-owlvit"])
+    return checkpoints
+
+def build_frame_pack(images):
+    """
+    build_frame_pack() bundles the frames into an uncompressed tar and its offset
+    table, the format of write_frame_pack() of the containers
+
+    :param images: [(name, jpeg bytes)]
+    :return: tar bytes, { name: [offset, size] }
+    """
+    buffer = io.BytesIO()
+    index = {}
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.USTAR_FORMAT) as tar:
+        for name, body in images:
+            info = tarfile.TarInfo(name)
+            info.size = len(body)
+            index[name] = [tar.offset + tarfile.BLOCKSIZE, len(body)]
+            tar.addfile(info, io.BytesIO(body))
+    return buffer.getvalue(), index
+
+def get_worker_env(endpoint, workdir):
+    """
+    get_worker_env() environment of the workers, the S3 client of the containers is
+    pointed at the local endpoint through the standard AWS configuration
+
+    :param endpoint: url of the local S3 endpoint
+    :param workdir: directory of the AWS config file
+    :return: environment
+    """
+    config_file = os.path.join(workdir, "aws_config")
+    with open(config_file, "w") as f:
+        f.write("\n".join([
+            "[default]",
+            "region = us-east-1",
+            "request_checksum_calculation = when_required",
+            "response_checksum_validation = when_required",
+            "s3 =",
+            "    addressing_style = path",
+            "",
+        ]))
+
+    return {
+        **os.environ,
+        "AWS_CONFIG_FILE": config_file,
+        "AWS_SHARED_CREDENTIALS_FILE": os.path.join(workdir, "aws_credentials"),
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_ENDPOINT_URL_S3": endpoint,
+        "AWS_LAMBDA_FUNCTION_NAME": "benchmark",
+        "PYTHONDONTWRITEBYTECODE": "1",
+    }
+
+def count_items(body, encoding):
+    """
+    count_items() number of items of a json output, None if unreadable
+    """
+    if body is None:
+        return None
+    try:
+        if encoding == "gzip":
+            body = gzip.decompress(body)
+        elif encoding == "zstd":
+            import zstandard
+            body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        return len(json.loads(body))
+    except Exception:
+        return None
+
+def put_video_object(s3, storage_root, key, body, mime):
+    """
+    put_video_object() stores an object of the video in the local S3 endpoint,
+    or under the directory of the file storage
+
+    :param s3: LocalS3
+    :param storage_root: root directory of STORAGE_URI=file://, None for S3
+    :param key: object key
+    :param body: bytes
+    :param mime: content type
+    """
+    if storage_root is None:
+        s3.put(BUCKET, key, body, { "Content-Type": mime })
+        return
+    path = os.path.join(storage_root, BUCKET, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(body)
+
+def get_output(s3, storage_root, key):
+    """
+    get_output() reads an output of a container
+
+    :return: (body or None, content encoding)
+    """
+    if storage_root is None:
+        with s3.lock:
+            obj = s3.objects.get((BUCKET, key))
+        return (None, None) if obj is None else (obj[0], obj[2].get("Content-Encoding"))
+
+    path = os.path.join(storage_root, BUCKET, key)
+    if not os.path.exists(path):
+        return None, None
+    with open(path, "rb") as f:
+        return f.read(), None
+
+def run_container(s3, storage_root, container, event, options, env):
+    """
+    run_container() runs a container in a worker process
+
+    :param s3: LocalS3
+    :param storage_root: root directory of STORAGE_URI=file://, None for S3
+    :param container: name of the container
+    :param event: event of the first invocation
+    :param options: { budget, memory_limit_in_mb, checkpoints }
+    :param env: environment of the worker
+    :return: result
+    """
+    s3.reset_stats()
+    worker = subprocess.run(
+        [sys.executable, WORKER, json.dumps({ **options, "event": event })],
+        cwd=os.path.join(DOCKER_DIR, container),
+        env=env,
+        capture_output=True,
+        text=True)
+
+    lines = [line for line in worker.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if worker.returncode != 0 or len(lines) == 0:
+        sys.stderr.write(worker.stdout[-4000:] + worker.stderr[-4000:])
+        raise RuntimeError(f"{container} failed with exit code {worker.returncode}")
+
+    result = json.loads(lines[-1][len(RESULT_PREFIX):])
+    result["items"] = count_items(*get_output(s3, storage_root, os.path.join(event["prefix"], OUTPUTS[container])))
+    result.update({
+        "requests": s3.stats["requests"],
+        "bytes_out": s3.stats["bytes_out"],
+        "bytes_in": s3.stats["bytes_in"],
+    })
+    return result
+
+def compare(results, baseline, threshold):
+    """
+    compare() compares the results with the baseline
+
+    :return: list of regressions
+    """
+    regressions = []
+    for container, result in results.items():
+        previous = baseline.get(container)
+        if previous is None:
+            print(f"== {container}: not in baseline")
+            continue
+        print(f"== {container}: vs baseline")
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value = result.get(metric)
+            base = previous.get(metric)
+            if value is None or base is None or base == 0:
+                continue
+            change = (value - base) / base
+            worse = -change if higher_is_better else change
+            flag = "REGRESSION" if worse > threshold else ""
+            print(f"   {metric:<12} {base:>14} -> {value:<14} {change:+.1%} {flag}")
+            if flag:
+                regressions.append((container, metric, base, value))
+    return regressions
+
+def print_result(container, result):
+    print(f"== {container}: {result['frames']} frames, {result['fps']} frames/s, "
+        f"{result['invocations']} invocations, {result['elapsed']}s ({result['model_load']}s model load), "
+        f"peak RSS {result['peak_rss'] >> 20}MB, "
+        f"{result['requests']} requests, {result['bytes_out']} bytes out, {result['bytes_in']} bytes in, "
+        f"{result['items']} items, {result['status']}")
+    if result.get("resultcache") is not None:
+        print(f"   result cache: {result['resultcache']}")
+    for stage, stats in sorted(result["stages"].items()):
+        print(f"   {stage:<12} count {stats['count']:>6}  p50 {stats['p50']:>10}ms  p95 {stats['p95']:>10}ms  sum {stats['sum']:>10}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="offline end-to-end benchmark of the model containers")
+    parser.add_argument("containers", nargs="*", default=list(EVENTS.keys()))
+    parser.add_argument("--frames", type=int, default=48)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--shot-length", type=int, default=12)
+    parser.add_argument("--budget", type=float, default=20, help="processing seconds per invocation before quit_now()")
+    parser.add_argument("--memory-mb", type=int, default=None, help="memory_limit_in_mb of the fake context")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency added to every S3 GET and PUT")
+    parser.add_argument("--storage", choices=["s3", "file"], default="s3", help="local S3 endpoint or STORAGE_URI=file://")
+    parser.add_argument("--frames-pack", choices=["none", "range", "mmap"], default="none", help="read the frames from a pack with ranged GETs or mapped")
+    parser.add_argument("--event", default="{}", help="json fields merged into every event")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per container, the median is reported")
+    parser.add_argument("--tiny-models", action="store_true", help="use randomly initialized tiny models")
+    parser.add_argument("--checkpoint", action="append", default=[], help="<loader>=<checkpoint>, e.g. load_cls_model=/models/clip")
+    parser.add_argument("--baseline", default=BASELINE_JSON)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--output", default=None, help="write the results json")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    unknown = set(args.containers) - set(EVENTS.keys())
+    if len(unknown) > 0:
+        raise ValueError(f"unknown container(s): {sorted(unknown)}")
+    containers = [container for container in EVENTS if container in args.containers]
+    if "faiss-on-aws" in containers and "zero-shot-classifier-on-aws" not in containers:
+        raise ValueError("faiss-on-aws indexes the output of zero-shot-classifier-on-aws, run both")
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as workdir:
+        checkpoints = {}
+        if args.tiny_models:
+            tiny = build_tiny_models(os.path.join(workdir, "models"))
+            checkpoints = { loader: tiny[name] for loader, name in TINY_CHECKPOINTS.items() }
+        for item in args.checkpoint:
+            loader, checkpoint = item.split("=", 1)
+            checkpoints[loader] = checkpoint
+
+        s3 = LocalS3(args.latency_ms / 1000)
+        endpoint = s3.start()
+        env = get_worker_env(endpoint, workdir)
+
+        # file storage reads the video from disk, no S3 request at all
+        storage_root = None
+        if args.storage == "file":
+            storage_root = os.path.join(workdir, "storage")
+            env["STORAGE_URI"] = f"file://{storage_root}"
+
+        prefix = f"video/{round(time.time() * 1000)}"
+        images, framesegmentation = render_video(args.frames, args.width, args.height, args.shot_length)
+        for name, body in images:
+            put_video_object(s3, storage_root, os.path.join(prefix, name), body, "image/jpeg")
+        put_video_object(s3, storage_root, os.path.join(prefix, FRAMESEGMENTATION_JSON), json.dumps(framesegmentation).encode(), "application/json")
+        pack_event = {}
+        if args.frames_pack != "none":
+            pack, index = build_frame_pack(images)
+            put_video_object(s3, storage_root, os.path.join(prefix, FRAMES_PACK), pack, "application/x-tar")
+            put_video_object(s3, storage_root, os.path.join(prefix, FRAMES_PACK_INDEX), json.dumps(index).encode(), "application/json")
+            pack_event = {
+                "frames_pack": FRAMES_PACK,
+                "frames_pack_mode": args.frames_pack,
+            }
+        print(f"== rendered {args.frames} frames {args.width}x{args.height}, {sum(len(body) for _, body in images)} bytes, storage {env.get('STORAGE_URI', endpoint)}")
+
+        options = {
+            "budget": args.budget,
+            "memory_limit_in_mb": args.memory_mb,
+            "checkpoints": checkpoints,
+        }
+        results = {}
+        try:
+            for container in containers:
+                event = {
+                    "bucket": BUCKET,
+                    "prefix": prefix,
+                    **EVENTS[container],
+                    **(pack_event if "json" in EVENTS[container] else {}),
+                    **json.loads(args.event),
+                }
+                runs = []
+                for _ in range(args.repeat):
+                    result = run_container(s3, storage_root, container, event, options, env)
+                    # frames/sec of the processing, the model loading is reported on its own
+                    model_load = result["stages"].get("model_load", {}).get("sum", 0) / 1000
+                    result["frames"] = args.frames
+                    result["model_load"] = round(model_load, 3)
+                    result["fps"] = round(args.frames / max(result["elapsed"] - model_load, 1e-6), 3)
+                    runs.append(result)
+                # the run of the median frames/sec represents the container
+                results[container] = sorted(runs, key=lambda x: x["fps"])[len(runs) // 2]
+                print_result(container, results[container])
+        finally:
+            s3.stop()
+
+    config = {
+        "frames": args.frames,
+        "width": args.width,
+        "height": args.height,
+        "shot_length": args.shot_length,
+        "budget": args.budget,
+        "memory_mb": args.memory_mb,
+        "latency_ms": args.latency_ms,
+        "storage": args.storage,
+        "frames_pack": args.frames_pack,
+        "repeat": args.repeat,
+        "event": json.loads(args.event),
+        "models": "tiny" if args.tiny_models else checkpoints or "default",
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+    }
+    report = {
+        "config": config,
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"== [warn]: baseline config differs, numbers are not comparable: {baseline['config']}")
+        regressions = compare(results, baseline["results"], args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"== saved baseline {args.baseline}")
+
+    if args.fail_on_regression and len(regressions) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
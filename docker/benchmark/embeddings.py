@@ -0,0 +1,162 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+"""
+embeddings.py checks the embedding-only path of the shoppable crops against the per
+crop zero-shot classification it replaced, run_classification() of each crop with its
+own label. At batch size 1 the embeddings must be byte-identical. A batched forward
+pass may change the last bits of the float32 embeddings, the batched sizes are
+checked against MAX_BATCHED_EMBEDDING_DIFF and their drift is reported.
+
+usage:
+    python embeddings.py [--crops 32] [--batch-size 1 --batch-size 32] [--tiny-models]
+exits 1 if the labels or scores differ, batch size 1 is not byte-identical or the
+batched drift is over the tolerance
+"""
+import os
+import io
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTAINER_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "shoppable-on-aws")
+
+LABELS = ["top", "pants", "dress", "shoes", "bag", "hat"]
+
+# max abs difference of a batched embedding, float32 rounding of the batched matmuls
+MAX_BATCHED_EMBEDDING_DIFF = 1e-5
+
+def render_crops(count, width, height, seed = 0):
+    """
+    render_crops() crops of random boxes on synthetic frames, shaped like the items
+    of find_bounding_boxes()
+
+    :param count: number of crops
+    :param width: width of the frames
+    :param height: height of the frames
+    :param seed: (optional) random seed
+    :return: [(items, image_w, image_h, options)], one entry per frame
+    """
+    from PIL import Image
+    from benchmark import render_video
+
+    rnd = random.Random(seed)
+    frames = []
+    images, _ = render_video(max(1, count // 4), width, height, 2, seed)
+    for idx in range(count):
+        name, body = images[idx % len(images)]
+        if idx % 4 == 0:
+            image = Image.open(io.BytesIO(body)).convert("RGB")
+            frames.append(([], width, height, { "name": name }))
+        w, h = rnd.uniform(0.1, 0.6) * width, rnd.uniform(0.1, 0.8) * height
+        l, t = rnd.uniform(0, width - w), rnd.uniform(0, height - h)
+        box = (l, t, l + w, t + h)
+        frames[-1][0].append({
+            "label": rnd.choice(LABELS),
+            "box": box,
+            "cropped": image.crop(box),
+        })
+    return frames
+
+def run_per_crop(app, model, processor, frames, repeat):
+    """
+    run_per_crop() runs run_classification() on each crop with its own label, the
+    output before the embedding-only path
+
+    :return: ([{ label, score, embeddings }], median milliseconds per crop)
+    """
+    crops = [item for items, _, _, _ in frames for item in items]
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        output = [app.run_classification(model, processor, item["cropped"], [item["label"]]) for item in crops]
+        timings.append((time.perf_counter() - t0) * 1000 / len(crops))
+    return output, sorted(timings)[len(timings) // 2]
+
+def run_embedding_only(app, model, processor, frames, batch_size, repeat):
+    """
+    run_embedding_only() runs get_batch_embeddings() with the embedding-only path
+
+    :return: ([{ label, score, embeddings, box, ... }], median milliseconds per crop)
+    """
+    crops = sum(len(items) for items, _, _, _ in frames)
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        output = app.get_batch_embeddings(model, processor, frames, batch_size, True)
+        timings.append((time.perf_counter() - t0) * 1000 / crops)
+    return output, sorted(timings)[len(timings) // 2]
+
+def compare(utils, expected, actual):
+    """
+    compare() compares the embedding-only output with the per crop output
+
+    :return: { same_labels, identical, max_diff }
+    """
+    import numpy as np
+
+    same_labels = [(a["label"], a["score"]) for a in expected] == [(b["label"], b["score"]) for b in actual]
+    identical = sum(utils.dumps(a["embeddings"]) == utils.dumps(b["embeddings"]) for a, b in zip(expected, actual))
+    max_diff = max(
+        float(np.abs(np.asarray(a["embeddings"], dtype=np.float64) - np.asarray(b["embeddings"], dtype=np.float64)).max())
+        for a, b in zip(expected, actual))
+    return {
+        "same_labels": same_labels and len(expected) == len(actual),
+        "identical": identical,
+        "max_diff": max_diff,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="embedding-only path vs per crop classification of the shoppable crops")
+    parser.add_argument("--crops", type=int, default=32)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--batch-size", type=int, action="append", default=None, help="default to 1 and CLS_BATCH_SIZE")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per path, the median is reported")
+    parser.add_argument("--tiny-models", action="store_true", help="use a randomly initialized tiny model")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint of the classification model")
+    args = parser.parse_args()
+
+    sys.path.insert(0, CONTAINER_DIR)
+    sys.path.insert(0, BENCHMARK_DIR)
+    os.chdir(CONTAINER_DIR)
+
+    import app
+    import utils
+    from benchmark import build_tiny_models
+
+    with tempfile.TemporaryDirectory(prefix="embeddings_") as workdir:
+        checkpoint = args.checkpoint
+        if checkpoint is None and args.tiny_models:
+            checkpoint = build_tiny_models(os.path.join(workdir, "models"))["tiny-clip"]
+        model, processor = app.load_cls_model(checkpoint) if checkpoint is not None else app.load_cls_model()
+
+        frames = render_crops(args.crops, args.width, args.height)
+        # warm up both paths
+        app.run_classification(model, processor, frames[0][0][0]["cropped"], [frames[0][0][0]["label"]])
+        app.get_batch_embeddings(model, processor, frames[:1], 1, True)
+
+        expected, per_crop_ms = run_per_crop(app, model, processor, frames, args.repeat)
+        print(f"== per crop classification: {len(expected)} crops, {round(per_crop_ms, 3)}ms/crop")
+
+        failed = False
+        for batch_size in args.batch_size or [1, app.CLS_BATCH_SIZE]:
+            actual, embedding_ms = run_embedding_only(app, model, processor, frames, batch_size, args.repeat)
+            result = compare(utils, expected, actual)
+            if batch_size == 1:
+                ok = result["same_labels"] and result["identical"] == len(expected)
+            else:
+                ok = result["same_labels"] and result["max_diff"] <= MAX_BATCHED_EMBEDDING_DIFF
+            failed = failed or not ok
+            print(f"== embedding-only, batch size {batch_size}: {round(embedding_ms, 3)}ms/crop "
+                f"({round((1 - embedding_ms / per_crop_ms) * 100, 1)}% faster), "
+                f"labels and scores {'same' if result['same_labels'] else 'DIFFER'}, "
+                f"{result['identical']}/{len(expected)} embeddings byte-identical, max abs diff {result['max_diff']:.3g}, "
+                f"{'OK' if ok else 'FAILED'}")
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
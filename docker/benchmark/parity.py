@@ -0,0 +1,215 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+"""
+parity.py checks the torchvision decode path ("decoder": "torchvision") against the
+PIL path of the model containers. Both paths run the lambda_handler on the same
+synthetic frames in memory storage; the decoded pixels, the pixel_values of the
+processors and the outputs are compared.
+
+usage:
+    python parity.py [--frames 16] [--tiny-models] [container ...]
+exits 1 if a container is out of tolerance
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCKER_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULT_PREFIX = "PARITY_RESULT"
+
+BUCKET = "parity"
+PREFIX = "video"
+CONTAINERS = ["zero-shot-classifier-on-aws", "zero-shot-object-on-aws", "shoppable-on-aws"]
+# output field of each container, the decoder is appended to the output name
+OUTPUT_FIELDS = {
+    "zero-shot-classifier-on-aws": "embeddings",
+    "zero-shot-object-on-aws": "output",
+    "shoppable-on-aws": "embeddings",
+}
+
+# a resize can round a pixel up to two steps apart, 2/255 over the smallest std of the processors
+MAX_PIXEL_VALUES_DIFF = 0.04
+# share of frames with the same labels, a detection close to the threshold may flip
+MIN_FRAME_AGREEMENT = 0.9
+# cosine similarity of the embeddings of the same item
+MIN_EMBEDDING_COSINE = 0.99
+
+def get_items(output):
+    """
+    get_items() items of an output grouped by frame, the detections of the object
+    container are nested under "labels"
+
+    :param output: json output of a container
+    :return: { name: [item, ...] }
+    """
+    frames = {}
+    for item in output:
+        if "labels" in item and isinstance(item["labels"], list):
+            frames.setdefault(item["name"], []).extend(item["labels"])
+        else:
+            frames.setdefault(item["name"], []).append(item)
+    return frames
+
+def compare_outputs(expected, actual):
+    """
+    compare_outputs() compares the outputs of the two decode paths frame by frame
+
+    :return: { frames, agreement, max_score_diff, min_cosine }
+    """
+    import numpy as np
+
+    expected, actual = get_items(expected), get_items(actual)
+    same = 0
+    score_diffs = [0.0]
+    cosines = [1.0]
+    for name, items in expected.items():
+        others = actual.get(name, [])
+        if [item["label"] for item in items] != [item["label"] for item in others]:
+            continue
+        same += 1
+        for a, b in zip(items, others):
+            score_diffs.append(abs(a["score"] - b["score"]))
+            if "embeddings" in a:
+                x, y = np.asarray(a["embeddings"], dtype=np.float64), np.asarray(b["embeddings"], dtype=np.float64)
+                cosines.append(float(x @ y / max(np.linalg.norm(x) * np.linalg.norm(y), 1e-12)))
+    return {
+        "frames": len(expected),
+        "agreement": round(same / max(len(expected), 1), 3),
+        "max_score_diff": round(max(score_diffs), 4),
+        "min_cosine": round(min(cosines), 5),
+    }
+
+def run(options):
+    """
+    run() runs in the directory of a container, the frames are in memory storage
+    """
+    os.environ["STORAGE_URI"] = f"memory://{BUCKET}"
+    sys.path.insert(0, os.getcwd())
+    sys.path.insert(0, BENCHMARK_DIR)
+
+    import torch
+    import app
+    import utils
+    import decode
+    from benchmark import render_video
+    from worker import FakeContext, override_checkpoints, MODEL_LOADERS
+
+    override_checkpoints(app, options["checkpoints"])
+    images, framesegmentation = render_video(options["frames"], options["width"], options["height"], options["shot_length"])
+    for name, body in images:
+        utils.put_object(BUCKET, os.path.join(PREFIX, name), body, "image/jpeg")
+    utils.put_object(BUCKET, os.path.join(PREFIX, "framesegmentation.json"), json.dumps(framesegmentation), "application/json")
+
+    # decoded pixels and pixel_values of each processor
+    identical = sum(
+        utils.get_content_hash(utils.open_image(body).convert("RGB")) == utils.get_content_hash(decode.decode_tensor(body))
+        for _, body in images)
+    pixel_values_diff = 0.0
+    for loader in MODEL_LOADERS:
+        if hasattr(app, loader):
+            _, processor = getattr(app, loader)()
+            for _, body in images:
+                expected = decode.preprocess(processor, images=utils.open_image(body).convert("RGB"), return_tensors="pt")["pixel_values"]
+                actual = decode.preprocess(processor, images=decode.decode_tensor(body), return_tensors="pt")["pixel_values"]
+                pixel_values_diff = max(pixel_values_diff, float((expected - actual).abs().max()))
+
+    outputs = {}
+    field = OUTPUT_FIELDS[options["container"]]
+    for decoder in decode.DECODERS:
+        output = f"parity_{decoder}.json"
+        event = {
+            "bucket": BUCKET,
+            "prefix": PREFIX,
+            "json": "framesegmentation.json",
+            field: output,
+            "decoder": decoder,
+        }
+        while event.get("status") != "COMPLETED":
+            event = app.lambda_handler(event, FakeContext(options["budget"]))
+        outputs[decoder] = json.loads(utils.get_object(BUCKET, os.path.join(PREFIX, output)))
+
+    result = {
+        "decoded_identical": round(identical / len(images), 3),
+        "max_pixel_values_diff": round(pixel_values_diff, 4),
+        **compare_outputs(outputs["pil"], outputs["torchvision"]),
+    }
+    print(f"{RESULT_PREFIX} {json.dumps(result)}", flush=True)
+
+def check(result):
+    """
+    check() tolerance violations of a result
+
+    :return: list of messages
+    """
+    errors = []
+    if result["max_pixel_values_diff"] > MAX_PIXEL_VALUES_DIFF:
+        errors.append(f"pixel_values differ by {result['max_pixel_values_diff']}")
+    if result["agreement"] < MIN_FRAME_AGREEMENT:
+        errors.append(f"labels agree on {result['agreement']} of the frames")
+    if result["min_cosine"] < MIN_EMBEDDING_COSINE:
+        errors.append(f"embeddings cosine {result['min_cosine']}")
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description="parity of the torchvision and PIL decode paths")
+    parser.add_argument("containers", nargs="*", default=CONTAINERS)
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--shot-length", type=int, default=4)
+    parser.add_argument("--budget", type=float, default=600)
+    parser.add_argument("--tiny-models", action="store_true", help="use randomly initialized tiny models")
+    parser.add_argument("--checkpoint", action="append", default=[], help="<loader>=<checkpoint>, e.g. load_cls_model=/models/clip")
+    parser.add_argument("--run", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        return run(json.loads(args.run))
+
+    from benchmark import build_tiny_models, TINY_CHECKPOINTS
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix="parity_") as workdir:
+        checkpoints = {}
+        if args.tiny_models:
+            tiny = build_tiny_models(os.path.join(workdir, "models"))
+            checkpoints = { loader: tiny[name] for loader, name in TINY_CHECKPOINTS.items() }
+        for item in args.checkpoint:
+            loader, checkpoint = item.split("=", 1)
+            checkpoints[loader] = checkpoint
+
+        for container in args.containers:
+            options = {
+                "container": container,
+                "frames": args.frames,
+                "width": args.width,
+                "height": args.height,
+                "shot_length": args.shot_length,
+                "budget": args.budget,
+                "checkpoints": checkpoints,
+            }
+            worker = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run", json.dumps(options)],
+                cwd=os.path.join(DOCKER_DIR, container),
+                capture_output=True,
+                text=True)
+            lines = [line for line in worker.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+            if worker.returncode != 0 or len(lines) == 0:
+                sys.stderr.write(worker.stdout[-4000:] + worker.stderr[-4000:])
+                print(f"== {container}: FAILED")
+                failed = True
+                continue
+
+            result = json.loads(lines[-1][len(RESULT_PREFIX):])
+            errors = check(result)
+            failed = failed or len(errors) > 0
+            print(f"== {container}: {result}, {'OK' if len(errors) == 0 else 'OUT OF TOLERANCE: ' + ', '.join(errors)}")
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+s3local.py is a minimal in-memory S3 endpoint for the offline benchmark. It speaks
+enough of the REST API for the containers: path-style GET (with If-None-Match and
+Range), HEAD, PUT and multipart uploads, and counts the requests and bytes moved.
+"""
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# headers kept with an object and returned by GET and HEAD
+STORED_HEADERS = ("Content-Type", "Content-Encoding")
+
+class LocalS3:
+    """
+    LocalS3 serves the objects of all buckets from memory on 127.0.0.1
+    """
+    def __init__(self, latency = 0.0):
+        """
+        :param latency: (optional) seconds added to every GET and PUT
+        """
+        self.latency = latency
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.server = None
+
+    def reset_stats(self):
+        self.stats = {
+            "requests": 0,
+            "get": 0,
+            "not_modified": 0,
+            "put": 0,
+            "parts": 0,
+            "bytes_out": 0,
+            "bytes_in": 0,
+        }
+
+    def count(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+    def put(self, bucket, key, body, headers = {}):
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self.lock:
+            self.objects[(bucket, key)] = (body, etag, dict(headers))
+        return etag
+
+    def get(self, bucket, key):
+        """
+        get() body of an object, read directly by the benchmark
+
+        :return: bytes or None
+        """
+        with self.lock:
+            obj = self.objects.get((bucket, key))
+        return None if obj is None else obj[0]
+
+    def start(self):
+        """
+        start() serves on a free port
+
+        :return: endpoint url
+        """
+        handler = type("Handler", (LocalS3Handler,), { "s3": self })
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    s3 = None
+
+    def log_message(self, *args):
+        pass
+
+    def parse(self):
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        return unquote(bucket), unquote(key), parse_qs(url.query, keep_blank_values=True)
+
+    def reply(self, code, body = b"", headers = {}):
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def reply_error(self, code, error):
+        self.reply(code, f"<Error><Code>{error}</Code></Error>".encode(), {
+            "Content-Type": "application/xml"
+        })
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        time.sleep(self.s3.latency)
+        bucket, key, _ = self.parse()
+        self.s3.count(requests=1, get=1)
+
+        with self.s3.lock:
+            obj = self.s3.objects.get((bucket, key))
+        if obj is None:
+            return self.reply_error(404, "NoSuchKey")
+
+        body, etag, headers = obj
+        if self.headers.get("If-None-Match") == etag:
+            self.s3.count(not_modified=1)
+            return self.reply(304, headers={ "ETag": etag })
+
+        code = 200
+        headers = { **headers, "ETag": etag }
+        byte_range = self.headers.get("Range")
+        if byte_range is not None:
+            start, end = byte_range.split("=", 1)[1].split("-")
+            start = int(start)
+            end = len(body) - 1 if end == "" else min(int(end), len(body) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            body = body[start:end + 1]
+            code = 206
+
+        if self.command == "GET":
+            self.s3.count(bytes_out=len(body))
+        self.reply(code, body, headers)
+
+    def do_PUT(self):
+        time.sleep(self.s3.latency)
+        bucket, key, query = self.parse()
+        body = self.read_body()
+        self.s3.count(requests=1, bytes_in=len(body))
+
+        if "uploadId" in query:
+            upload = self.s3.uploads[query["uploadId"][0]]
+            upload["parts"][int(query["partNumber"][0])] = body
+            self.s3.count(parts=1)
+            return self.reply(200, headers={ "ETag": f'"{hashlib.md5(body).hexdigest()}"' })
+
+        self.s3.count(put=1)
+        headers = { name: self.headers[name] for name in STORED_HEADERS if self.headers.get(name) }
+        etag = self.s3.put(bucket, key, body, headers)
+        self.reply(200, headers={ "ETag": etag })
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        self.read_body()
+        self.s3.count(requests=1)
+
+        # CreateMultipartUpload
+        if "uploads" in query:
+            upload_id = hashlib.md5(f"{bucket}/{key}/{time.time()}".encode()).hexdigest()
+            self.s3.uploads[upload_id] = {
+                "parts": {},
+                "headers": { name: self.headers[name] for name in STORED_HEADERS if self.headers.get(name) }
+            }
+            return self.reply(200, (
+                f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>").encode())
+
+        # CompleteMultipartUpload
+        upload = self.s3.uploads.pop(query["uploadId"][0], None)
+        if upload is None:
+            return self.reply_error(404, "NoSuchUpload")
+        body = b"".join(upload["parts"][number] for number in sorted(upload["parts"]))
+        etag = self.s3.put(bucket, key, body, upload["headers"])
+        self.reply(200, (
+            f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+            f"<ETag>{etag}</ETag></CompleteMultipartUploadResult>").encode())
+
+    def do_DELETE(self):
+        _, _, query = self.parse()
+        self.read_body()
+        self.s3.count(requests=1)
+        # AbortMultipartUpload
+        if "uploadId" in query:
+            self.s3.uploads.pop(query["uploadId"][0], None)
+        self.reply(204)
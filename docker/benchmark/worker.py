@@ -0,0 +1,148 @@
+"""
+worker.py drives the lambda_handler of one container through the re-entry loop of
+the state machine, it is started by benchmark.py in the directory of the container
+with the S3 client pointed at the local endpoint.
+
+usage: python worker.py '<json options>'
+prints one line "BENCHMARK_RESULT <json>" with the measurements
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import resource
+import tempfile
+
+# prefix of the result line read by benchmark.py
+RESULT_PREFIX = "BENCHMARK_RESULT"
+
+# quit_now() of the containers stops processing with 60s left
+QUIT_MARGIN_MS = 60000
+
+# max number of invocations of a run, guards against a handler that never completes
+MAX_INVOCATIONS = 1000
+
+# model loaders of the containers, timed as their own stage
+MODEL_LOADERS = ["load_cls_model", "load_obj_model", "load_model"]
+STAGE_MODEL_LOAD = "model_load"
+
+class FakeContext:
+    """
+    FakeContext stands in for the lambda context, the deadline is a processing
+    budget in seconds on top of the margin quit_now() keeps
+    """
+    def __init__(self, budget, memory_limit_in_mb = None):
+        self.deadline = time.time() + budget
+        self.aws_request_id = str(uuid.uuid4())
+        self.function_name = "benchmark"
+        if memory_limit_in_mb is not None:
+            self.memory_limit_in_mb = str(memory_limit_in_mb)
+
+    def get_remaining_time_in_millis(self):
+        return QUIT_MARGIN_MS + max(0, round((self.deadline - time.time()) * 1000))
+
+def collect_stages(metrics):
+    """
+    collect_stages() keeps the timings of all invocations, the handlers reset
+    the metrics at the start of each invocation
+
+    :param metrics: metrics module of the container
+    :return: { stage: [milliseconds, ...] }
+    """
+    stages = {}
+    record = metrics.record
+
+    def record_all(stage, elapsed):
+        stages.setdefault(stage, []).append(elapsed)
+        record(stage, elapsed)
+
+    metrics.record = record_all
+    return stages
+
+def override_checkpoints(app, checkpoints):
+    """
+    override_checkpoints() points the model loaders of the container to other checkpoints
+
+    :param app: app module of the container
+    :param checkpoints: { loader function name: checkpoint }
+    """
+    for name, checkpoint in checkpoints.items():
+        loader = getattr(app, name, None)
+        if loader is not None:
+            loader.__defaults__ = (checkpoint,)
+
+def time_model_loads(app, metrics):
+    """
+    time_model_loads() records the model loading as the "model_load" stage, the
+    frames/sec of the benchmark excludes it
+
+    :param app: app module of the container
+    :param metrics: metrics module of the container
+    """
+    for name in MODEL_LOADERS:
+        loader = getattr(app, name, None)
+        if loader is None:
+            continue
+
+        def timed_loader(*args, loader = loader, **kwargs):
+            with metrics.timer(STAGE_MODEL_LOAD):
+                return loader(*args, **kwargs)
+
+        setattr(app, name, timed_loader)
+
+def main():
+    options = json.loads(sys.argv[1])
+    sys.path.insert(0, os.getcwd())
+
+    import app
+    import utils
+    import metrics
+
+    override_checkpoints(app, options.get("checkpoints", {}))
+    stages = collect_stages(metrics)
+    time_model_loads(app, metrics)
+
+    # a cold /tmp per run, kept across the invocations like a warm container
+    cache_dir = tempfile.mkdtemp(prefix="s3_cache_")
+    utils.S3_CACHE_DIR = cache_dir
+
+    event = options["event"]
+    invocations = []
+    t0 = time.perf_counter()
+    try:
+        while event.get("status") != "COMPLETED" and len(invocations) < MAX_INVOCATIONS:
+            context = FakeContext(options["budget"], options.get("memory_limit_in_mb"))
+            t1 = time.perf_counter()
+            event = app.lambda_handler(event, context)
+            invocations.append(round(time.perf_counter() - t1, 3))
+            # the faiss container returns the event without a status
+            if "status" not in event:
+                break
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    elapsed = time.perf_counter() - t0
+
+    result = {
+        "elapsed": round(elapsed, 3),
+        "invocations": len(invocations),
+        "invocation_seconds": invocations,
+        "stages": {
+            stage: {
+                "count": len(values),
+                "sum": round(sum(values), 3),
+                "p50": round(metrics.percentile(sorted(values), 50), 3),
+                "p95": round(metrics.percentile(sorted(values), 95), 3),
+            } for stage, values in stages.items()
+        },
+        # kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "status": event.get("status"),
+        # hits and misses of the result cache of the last invocation, if enabled
+        "resultcache": event.get("resultcache"),
+    }
+    print(f"{RESULT_PREFIX} {json.dumps(result)}", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,29 @@ import traceback
 import os
 import json
 import time
-import faiss
-import numpy as np
-from utils import get_object, put_object
+from metrics import timer, reset_metrics, emit_metrics, start_profiler, stop_profiler
+from utils import LazyModule, parse_bool, get_object, get_object_uri, put_object, dumps, loads, get_cache_stats, reset_cache_stats, set_content_encoding, CONTENT_ENCODING
+
+# heavy modules are imported on first use, see LazyModule
+faiss = LazyModule("faiss")
+np = LazyModule("numpy")
 
 # image embedding size
 DIMENSION = 768
 
+# prebuilt product catalog files under the catalog prefix
+CATALOG_INDEX = "catalog.index"
+CATALOG_TABLE = "catalog.json"
+# stages of faiss index build and search
+STAGE_INDEX = "index"
+STAGE_SEARCH = "search"
+
+# number of catalog items to return per apparel
+CATALOG_TOPK = 10
+
+# product catalog loaded by the warm container, keyed by catalog s3uri
+_catalog_cache = {}
+
 def test_mode():
     """
     test_mode() runs test to ensure faiss installed
@@ -21,15 +37,177 @@ def test_mode():
         index.add(embeddings)
     print(index.ntotal)
 
+def load_catalog(s3uri):
+    """
+    load_catalog() loads the prebuilt product catalog index and its id to ASIN table.
+    The catalog is kept in memory so that a warm container only downloads it once.
+
+    :param s3uri: catalog prefix in a format of s3://bucket/prefix, or a file:// or memory:// uri
+    :return: (index, table, label_ids) where table is [{ asin, label, file, score }] in index id order
+        and label_ids maps a label to the ids of the catalog items of that label
+    """
+    if s3uri in _catalog_cache:
+        return _catalog_cache[s3uri]
+
+    t0 = time.time()
+    body = get_object_uri(os.path.join(s3uri, CATALOG_INDEX))
+    index = faiss.deserialize_index(np.frombuffer(body, dtype=np.uint8))
+    table = loads(get_object_uri(os.path.join(s3uri, CATALOG_TABLE)))
+
+    if index.ntotal != len(table):
+        raise ValueError(f"catalog index ({index.ntotal}) and table ({len(table)}) mismatched")
+
+    label_ids = {}
+    for idx, item in enumerate(table):
+        label_ids.setdefault(item["label"], []).append(idx)
+    label_ids = {
+        label: np.array(ids, dtype=np.int64)
+        for label, ids in label_ids.items()
+    }
+
+    t1 = time.time()
+    print(f"=== CATALOG LOADED: {index.ntotal} items, {round(t1 - t0, 3)}s")
+
+    _catalog_cache.clear()
+    _catalog_cache[s3uri] = (index, table, label_ids)
+    return _catalog_cache[s3uri]
+
+def search_catalog(
+        index,
+        table,
+        label_ids,
+        docs,
+        k = CATALOG_TOPK,
+        filter_by_label = True):
+    """
+    search_catalog() searches the catalog for all apparel embeddings in batches, one batch
+    per apparel label when filtering by label
+
+    :param index: catalog faiss index
+    :param table: catalog id to { asin, label, file, score } table
+    :param label_ids: catalog ids per label
+    :param docs: list of apparel items from shoppable embeddings json
+    :param k: (optional) number of catalog items to search per apparel
+    :param filter_by_label: (optional) only match catalog items of the same label
+    :return: [{ file, apparels: [{ box, label, score, items: [{ asin, score, docId, label }] }] }]
+    """
+    groups = {}
+    for idx, doc in enumerate(docs):
+        group = doc["label"] if filter_by_label else None
+        groups.setdefault(group, []).append(idx)
+
+    hits = [None] * len(docs)
+    for group, indices in groups.items():
+        params = None
+        if group is not None:
+            if group not in label_ids:
+                continue
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(label_ids[group]))
+
+        embeddings = np.array([docs[idx]["embeddings"] for idx in indices], dtype=np.float32)
+        D, I = index.search(embeddings, k, params=params)
+        for idx, distances, ids in zip(indices, D, I):
+            hits[idx] = [(int(i), float(d)) for i, d in zip(ids, distances) if i >= 0]
+
+    result_map = {}
+    for doc, doc_hits in zip(docs, hits):
+        if not doc_hits:
+            continue
+
+        if doc["name"] not in result_map:
+            result_map[doc["name"]] = {
+                "file": doc["name"],
+                "apparels": []
+            }
+
+        # hits are sorted by score, keep the best score per asin
+        items = {}
+        for i, d in doc_hits:
+            item = table[i]
+            if item["asin"] not in items:
+                items[item["asin"]] = {
+                    "asin": item["asin"],
+                    "score": round(d, 4),
+                    "docId": str(i),
+                    "label": {
+                        "name": item["label"],
+                        "score": round(float(item.get("score", 1.0)), 4),
+                        "file": item.get("file"),
+                    }
+                }
+
+        result_map[doc["name"]]["apparels"].append({
+            "box": doc["box"],
+            "label": doc["label"],
+            "score": round(float(doc["score"]), 4),
+            "items": list(items.values())
+        })
+
+    return list(result_map.values())
+
+def process_catalog_search(event):
+    """
+    process_catalog_search() matches the shoppable apparel embeddings of a video against
+    the product catalog
+
+    :param event: requires {"bucket", "prefix", "embeddings", "similarity", "catalog"}
+    :return: event
+    """
+    bucket = event["bucket"]
+    prefix = event["prefix"]
+    key = os.path.join(prefix, event["embeddings"])
+    output = event["similarity"]
+
+    tsta = round(time.time() * 1000) if "tsta" not in event else event["tsta"]
+
+    index, table, label_ids = load_catalog(event["catalog"])
+
+    docs = loads(get_object(bucket, key))
+    print(f"== [info]: loaded {event['embeddings']}: docs: {len(docs)}")
+
+    t0 = time.time()
+    with timer(STAGE_SEARCH):
+        shoppable = search_catalog(
+            index,
+            table,
+            label_ids,
+            docs,
+            int(event.get("k", CATALOG_TOPK)),
+            parse_bool(event.get("filter_by_label"), True))
+    t1 = time.time()
+    print(f"=== SEARCHED: {len(docs)} apparels, {round(t1 - t0, 3)}s")
+
+    # upload json output
+    output_key = os.path.join(prefix, output)
+    put_object(
+        bucket,
+        output_key,
+        dumps(shoppable),
+        "application/json")
+
+    tend = round(time.time() * 1000)
+    event["tsta"] = tsta
+    event["tend"] = tend
+    event["s3cache"] = get_cache_stats()
+    emit_metrics()
+    print(f"== TOTAL RUNTIME: {round((tend - tsta) / 1000)}s ==")
+
+    return event
+
 def lambda_handler(event, context):
     """
     lambda_handler() lambda entrypoint
-    :param event: requires {"bucket", "prefix", "embeddings", "similarity"}
+    :param event: requires {"bucket", "prefix", "embeddings", "similarity"}, optional "catalog"
     :param context: lambda context
     : return: event
     """
     frame_similarity = []
+    profiler = None
     try:
+        reset_cache_stats()
+        reset_metrics()
+        set_content_encoding(event.get("content_encoding", CONTENT_ENCODING), event.get("compression_level"))
+
         # special case
         if len(event.keys()) == 0:
             return test_mode()
@@ -37,6 +215,16 @@ def lambda_handler(event, context):
         if not set(("bucket", "prefix", "embeddings", "similarity")).issubset(event):
             raise ValueError("missing input field(s)")
 
+        # on-demand profiling of the invocation, off unless requested
+        profiler = start_profiler(event)
+        request_id = getattr(context, "aws_request_id", None)
+
+        # product catalog search mode
+        if "catalog" in event:
+            event = process_catalog_search(event)
+            stop_profiler(profiler, event, event["bucket"], event["prefix"], request_id)
+            return event
+
         bucket = event["bucket"]
         prefix = event["prefix"]
         key = os.path.join(prefix, event["embeddings"])
@@ -45,22 +233,24 @@ def lambda_handler(event, context):
         tsta = round(time.time() * 1000) if "tsta" not in event else event["tsta"]
 
         # load embeddings json and index it
-        frames = json.loads(get_object(bucket, key))
+        frames = loads(get_object(bucket, key))
 
         # create index
         dimension = len(frames[0]["embeddings"])
         index = faiss.IndexFlatIP(dimension) # cosine similarity
 
-        for frame in frames:
-            embeddings = np.array([frame["embeddings"]])
-            index.add(embeddings)
+        with timer(STAGE_INDEX):
+            for frame in frames:
+                embeddings = np.array([frame["embeddings"]])
+                index.add(embeddings)
         print(index.ntotal)
 
         # for each item, search for similar frames
         for idx in range(len(frames)):
             frame = frames[idx]
             embeddings = np.array([frame["embeddings"]])
-            D, I = index.search(embeddings, k = 20)
+            with timer(STAGE_SEARCH):
+                D, I = index.search(embeddings, k = 20)
             similar_frames = [ { "I": int(i), "D": float(d) } for i, d in zip(I[0], D[0]) ]
             similar_frames = list(filter(lambda x: x["D"] > 0.70 and x["I"] != idx, similar_frames))
 
@@ -75,17 +265,24 @@ def lambda_handler(event, context):
         put_object(
             bucket,
             output_key,
-            json.dumps(frame_similarity, default=str),
+            dumps(frame_similarity),
             "application/json")
 
+        # the profile covers the output upload
+        stop_profiler(profiler, event, bucket, prefix, request_id)
+
         # update event for the next re-entry of the lambda
         tend = round(time.time() * 1000)
         event["tsta"] = tsta
         event["tend"] = tend
+        event["s3cache"] = get_cache_stats()
+        emit_metrics()
         print(f"== TOTAL RUNTIME: {round((tend - tsta) / 1000)}s ==")
 
         return event
     except Exception as e:
+        if profiler is not None:
+            profiler.stop()
         print(f"[ERR]: {type(e).__name__}")
         traceback.print_exc()
         raise e
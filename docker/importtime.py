@@ -0,0 +1,101 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+"""
+importtime.py digests `python -X importtime` of the lambda entrypoints and checks
+the import-time budget. Heavy modules must only be loaded by the code paths that
+use them (see LazyModule in utils.py), a cold `import app` must not load them.
+
+usage: python importtime.py [--budget-ms 250] [--top 10] [--module app] <container dir> ...
+exit code 1 if a container is over budget or imports a heavy module at import time
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+# modules that must not be loaded by `import app`
+HEAVY_MODULES = [
+    "torch",
+    "torchvision",
+    "transformers",
+    "faiss",
+    "numpy",
+    "PIL",
+    "boto3",
+    "botocore",
+]
+
+# import-time budget of the entrypoint module
+BUDGET_MS = 250
+
+def run_importtime(container, module):
+    """
+    run_importtime() imports the module in a fresh interpreter with -X importtime
+
+    :param container: directory of the container
+    :param module: module to import
+    :return: [(self_us, cumulative_us, depth, name), ...] in import order
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=container,
+        capture_output=True,
+        text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed in {container}:\n{result.stderr}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        # import time: <self> | <cumulative> | <2 spaces per nested level><name>
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+def digest(container, module, top, budget_ms):
+    """
+    digest() prints the import-time report of a container
+
+    :return: True if within the budget and no heavy module is imported
+    """
+    rows = run_importtime(container, module)
+
+    # nested imports are listed before their parent, the subtree of the module
+    # starts after the previous top level import
+    end = max(idx for idx, row in enumerate(rows) if row[2] == 0 and row[3] == module)
+    start = end
+    while start > 0 and rows[start - 1][2] > 0:
+        start -= 1
+    children = [row for row in rows[start:end] if row[2] == 1]
+    total_ms = rows[end][1] / 1000
+
+    heavy = sorted(set(
+        row[3].split(".")[0] for row in rows
+        if row[3].split(".")[0] in HEAVY_MODULES))
+
+    ok = total_ms <= budget_ms and len(heavy) == 0
+    print(f"== {container}: import {module}: {round(total_ms, 1)}ms (budget {budget_ms}ms) {'OK' if ok else 'FAILED'}")
+    for self_us, cumulative_us, _, name in sorted(children, key=lambda x: -x[1])[:top]:
+        print(f"   {round(cumulative_us / 1000, 1):>8}ms  {name}")
+    if len(heavy) > 0:
+        print(f"   heavy modules imported: {heavy}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="import-time report and budget check")
+    parser.add_argument("containers", nargs="+", help="container directories")
+    parser.add_argument("--module", default="app", help="entrypoint module")
+    parser.add_argument("--budget-ms", type=float, default=BUDGET_MS)
+    parser.add_argument("--top", type=int, default=10, help="number of top level imports to list")
+    args = parser.parse_args()
+
+    results = [
+        digest(os.path.abspath(container), args.module, args.top, args.budget_ms)
+        for container in args.containers
+    ]
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == "__main__":
+    main()
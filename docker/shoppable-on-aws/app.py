@@ -3,12 +3,21 @@ import os
 import json
 import time
 import traceback
-import math
-import torch
-from PIL import Image
+import weakref
+import hashlib
 from pathlib import Path
-from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection, AutoModelForZeroShotImageClassification
-from utils import get_object, put_object, load_from_file, load_from_s3, load_from_s3uri, load_from_blob, load_classes, load_query_images, quit_now
+from metrics import timer, reset_metrics, emit_metrics, start_profiler, stop_profiler, STAGE_PREPROCESS, STAGE_FORWARD, STAGE_POSTPROCESS
+from sizing import start_sizer
+from decode import get_decoder, preprocess, get_image_size, crop_image
+from utils import get_object, put_object, put_json_items, dumps, loads, to_embeddings, set_embedding_precision, EMBEDDING_PRECISION, load_from_file, load_from_s3, load_from_s3uri, load_from_blob, load_images_from_s3, open_image, load_classes, load_query_images, load_images_with_results, open_frame_pack, open_result_cache, get_content_hash, get_labels_hash, quit_now, load_progress, save_progress, LazyModule, get_cache_stats, reset_cache_stats, S3_CONCURRENCY, set_content_encoding, CONTENT_ENCODING
+
+# heavy modules are imported on first use, see LazyModule
+torch = LazyModule("torch")
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
+transformers = LazyModule("transformers")
+modeling_owlvit = LazyModule("transformers.models.owlvit.modeling_owlvit")
+torchvision_ops = LazyModule("torchvision.ops")
 
 OBJ_CHECKPOINT = "google/owlvit-base-patch32"
 #CLS_CHECKPOINT = "laion/CLIP-ViT-B-32-laion2B-s34B-b79K"
@@ -34,6 +43,36 @@ SECOND_PASS_LABELS = [
 AMBIGUOUS_LABELS = [
     "dress"
 ]
+# size filters of the detected boxes
+MIN_RATIO_WH = 0.3
+MIN_RATIO_IMG = 0.05
+# small boxes are kept when ratio and score are above these
+MIN_RATIO_IMG_SMALL = 0.03
+MIN_SCORE_SMALL = 0.20
+# boxes closer than the normalized centroid distance are duplicated
+DUPLICATED_DISTANCE = 0.12
+# IoU based suppression, disabled by default
+DUPLICATED_IOU_THRESHOLD = None
+# shot-representative sampling modes and default number of frames per shot
+SAMPLING_MODES = [
+    "first",
+    "middle",
+    "sharpest",
+]
+FRAMES_PER_SHOT = 1
+# max number of cropped images per classification forward pass
+CLS_BATCH_SIZE = 32
+# upper bound of the number of frames processed together, calibrated per function memory
+MAX_FRAME_WINDOW = 8
+
+# text query embeddings encoded once per loaded object detection model
+_text_queries_cache = weakref.WeakKeyDictionary()
+
+# image query embeddings keyed by content hash, also persisted to /tmp across warm invocations
+QUERY_CACHE_DIR = "/tmp/query_embeds"
+_image_queries_cache = {}
+# score threshold of image-guided detection
+IMAGE_QUERY_THRESHOLD = 0.6
 
 def load_obj_model(checkpoint = OBJ_CHECKPOINT):
     """
@@ -42,8 +81,8 @@ def load_obj_model(checkpoint = OBJ_CHECKPOINT):
     :param checkpoint: (optional) model checkpoint
     :return: model, processor
     """
-    model = AutoModelForZeroShotObjectDetection.from_pretrained(checkpoint)
-    processor = AutoProcessor.from_pretrained(checkpoint)
+    model = transformers.AutoModelForZeroShotObjectDetection.from_pretrained(checkpoint)
+    processor = transformers.AutoProcessor.from_pretrained(checkpoint)
     return model, processor
 
 def load_cls_model(checkpoint = CLS_CHECKPOINT):
@@ -53,15 +92,154 @@ def load_cls_model(checkpoint = CLS_CHECKPOINT):
     :param checkpoint: (optional) model checkpoint
     :return: model, processor
     """
-    model = AutoModelForZeroShotImageClassification.from_pretrained(checkpoint)
-    processor = AutoProcessor.from_pretrained(checkpoint)
+    model = transformers.AutoModelForZeroShotImageClassification.from_pretrained(checkpoint)
+    processor = transformers.AutoProcessor.from_pretrained(checkpoint)
     return model, processor
 
+def encode_text_queries(
+        model,
+        processor,
+        text_labels):
+    """
+    encode_text_queries() encodes text queries for the object detection model once.
+    The query embeddings are cached per model and reused for every image.
+
+    :param model: object detection model
+    :param processor: object detection processor
+    :param text_labels: zero shot labels
+    :return: query_embeds of [len(text_labels), dim], query_mask of [len(text_labels)]
+    """
+    queries = _text_queries_cache.setdefault(model, {})
+    cache_key = tuple(text_labels)
+
+    if cache_key not in queries:
+        inputs = processor(text=text_labels, return_tensors="pt")
+        with torch.no_grad():
+            query_embeds = model.owlvit.get_text_features(**inputs)
+            query_embeds = query_embeds / torch.linalg.norm(query_embeds, ord=2, dim=-1, keepdim=True)
+        # if first token is 0, then this is a padded query
+        query_mask = inputs["input_ids"][..., 0] > 0
+        queries[cache_key] = (query_embeds, query_mask)
+
+    return queries[cache_key]
+
+def encode_image_queries(
+        model,
+        processor,
+        query_images):
+    """
+    encode_image_queries() turns reference images into query embeddings for image-guided detection.
+    The query embeddings are cached by the content hash of the image in memory and in /tmp
+    so that query images are never re-encoded per frame or per re-entry.
+
+    :param model: object detection model
+    :param processor: object detection processor
+    :param query_images: list of { image, label } returns from load_query_images
+    :return: query_embeds of [N, dim], labels of N
+    """
+    query_embeds = []
+    labels = []
+
+    os.makedirs(QUERY_CACHE_DIR, exist_ok=True)
+
+    for item in query_images:
+        cache_key = get_content_hash(item["image"])
+        cache_key = hashlib.sha256(f"{model.config._name_or_path}:{cache_key}".encode("utf-8")).hexdigest()
+        cache_file = os.path.join(QUERY_CACHE_DIR, f"{cache_key}.pt")
+
+        embeds = _image_queries_cache.get(cache_key)
+        if embeds is None and os.path.exists(cache_file):
+            embeds = torch.load(cache_file)
+
+        if embeds is None:
+            inputs = processor(query_images=item["image"], return_tensors="pt")
+            with torch.no_grad():
+                query_feature_map = model.image_embedder(pixel_values=inputs["query_pixel_values"])[0]
+                batch_size, num_patches_height, num_patches_width, hidden_dim = query_feature_map.shape
+                query_image_feats = torch.reshape(
+                    query_feature_map,
+                    (batch_size, num_patches_height * num_patches_width, hidden_dim))
+                embeds, _, _ = model.embed_image_query(query_image_feats, query_feature_map)
+
+            if embeds is None:
+                print(f"!!!!! IGNORED: NO QUERY BOX FOUND: {item['label']}")
+                continue
+
+            embeds = embeds.reshape(-1, embeds.shape[-1])[0]
+            _cache_file = f"{cache_file}.{os.getpid()}"
+            torch.save(embeds, _cache_file)
+            os.replace(_cache_file, cache_file)
+
+        _image_queries_cache[cache_key] = embeds
+        query_embeds.append(embeds)
+        labels.append(item["label"])
+
+    if len(query_embeds) == 0:
+        return None, labels
+    return torch.stack(query_embeds), labels
+
+def run_query_detection(
+        model,
+        processor,
+        images,
+        query_embeds,
+        query_mask = None,
+        threshold = 0.1):
+    """
+    run_query_detection() runs object detection on a batch of images in one forward pass
+    of the vision tower with precomputed query embeddings
+
+    :param model: object detection model
+    :param processor: object detection processor
+    :param images: list of images to inference
+    :param query_embeds: text or image query embeddings of [N, dim]
+    :param query_mask: (optional) mask of padded text queries of [N]
+    :param threshold: (optional) score threshold
+    :return: [{ scores, labels, boxes }, ...] one per image, boxes in (xmin, ymin, xmax, ymax) of the image
+    """
+    with timer(STAGE_PREPROCESS):
+        inputs = preprocess(processor, images=images, return_tensors="pt")
+
+    with torch.no_grad(), timer(STAGE_FORWARD):
+        feature_map = model.image_embedder(pixel_values=inputs["pixel_values"])[0]
+        batch_size, num_patches_height, num_patches_width, hidden_dim = feature_map.shape
+        image_feats = torch.reshape(feature_map, (batch_size, num_patches_height * num_patches_width, hidden_dim))
+
+        pred_logits, _ = model.class_predictor(
+            image_feats,
+            query_embeds.expand(batch_size, -1, -1),
+            None if query_mask is None else query_mask.expand(batch_size, -1))
+        pred_boxes = model.box_predictor(image_feats, feature_map)
+
+    with timer(STAGE_POSTPROCESS):
+        outputs = modeling_owlvit.OwlViTObjectDetectionOutput(logits=pred_logits, pred_boxes=pred_boxes)
+        target_sizes = torch.tensor([get_image_size(image)[::-1] for image in images])
+        return processor.post_process_object_detection(outputs, threshold=threshold, target_sizes=target_sizes)
+
+def run_batch_object_detection(
+        model,
+        processor,
+        images,
+        text_labels):
+    """
+    run_batch_object_detection() runs object detection on a batch of images in one forward pass
+    of the vision tower with the precomputed text query embeddings
+
+    :param model: object detection model
+    :param processor: object detection processor
+    :param images: list of images to inference
+    :param text_labels: zero shot labels
+    :return: [{ scores, labels, boxes }, ...] one per image, boxes in (xmin, ymin, xmax, ymax) of the image
+    """
+    query_embeds, query_mask = encode_text_queries(model, processor, text_labels)
+    return run_query_detection(model, processor, images, query_embeds, query_mask)
+
 def run_object_detection(
         model,
         processor,
         image,
-        text_labels):
+        text_labels,
+        image_queries = None):
     """
     run_object_detection() runs object detection
 
@@ -69,21 +247,20 @@ def run_object_detection(
     :param processor: object detection processor
     :param image: image to inference
     :param text_labels: zero shot labels
+    :param image_queries: (optional) (query_embeds, labels) from encode_image_queries, replaces text_labels
     :return: [ [label, score, box, xy], ... ]
     """
-    inputs = processor(text=text_labels, images=image, return_tensors="pt")
-
-    with torch.no_grad():
-        outputs = model(**inputs)
-
-    target_sizes = torch.tensor([image.size[::-1]])
-    results = processor.post_process_object_detection(outputs, threshold=0.1, target_sizes=target_sizes)[0]
+    if image_queries is not None:
+        query_embeds, text_labels = image_queries
+        results = run_query_detection(model, processor, [image], query_embeds, threshold=IMAGE_QUERY_THRESHOLD)[0]
+    else:
+        results = run_batch_object_detection(model, processor, [image], text_labels)[0]
 
     boxes = results["boxes"].tolist()
     labels = results["labels"].tolist()
     scores = results["scores"].tolist()
 
-    image_w, image_h = image.size    
+    image_w, image_h = get_image_size(image)
     return [
         [
             text_labels[label],
@@ -110,10 +287,11 @@ def run_classification(
     :param text_labels: zero shot labels
     :return: { label, score, embeddings } where embeddings size is 768
     """
-    inputs = processor(text = labels, images = image, return_tensors = "pt", padding = True)
+    with timer(STAGE_PREPROCESS):
+        inputs = preprocess(processor, images = image, text = labels, return_tensors = "pt", padding = True)
     outputs = None
 
-    with torch.no_grad():
+    with torch.no_grad(), timer(STAGE_FORWARD):
         outputs = model(**inputs)
 
     logits = outputs.logits_per_image[0]
@@ -127,7 +305,7 @@ def run_classification(
         print("FAILED TO FIND LABEL")
         return None
 
-    image_embeddings = outputs.image_embeds.cpu().numpy().tolist()[0]
+    image_embeddings = to_embeddings(outputs.image_embeds)[0]
     item = {
         "label": result[0]["label"],
         "score": round(float(result[0]["score"]), 3),
@@ -135,141 +313,269 @@ def run_classification(
     }
     return item
 
+def run_batch_classification(
+        model,
+        processor,
+        images,
+        labels):
+    """
+    run_batch_classification() runs classification on a batch of images in one forward pass
+
+    :param model: classification model
+    :param processor: classification processor
+    :param images: list of images to inference
+    :param labels: list of zero shot labels, one list per image
+    :return: [{ label, score, embeddings }, ...] where embeddings size is 768, None if no label
+    """
+    # encode each distinct label once and score every image against its own labels
+    text_labels = list(dict.fromkeys(label for _labels in labels for label in _labels))
+    label_indices = {label: idx for idx, label in enumerate(text_labels)}
+
+    if len(text_labels) == 0:
+        print("FAILED TO FIND LABEL")
+        return [None] * len(images)
+
+    with timer(STAGE_PREPROCESS):
+        inputs = preprocess(processor, images = images, text = text_labels, return_tensors = "pt", padding = True)
+    outputs = None
+
+    with torch.no_grad(), timer(STAGE_FORWARD):
+        outputs = model(**inputs)
+
+    logits_per_image = outputs.logits_per_image
+    image_embeddings = to_embeddings(outputs.image_embeds)
+
+    items = []
+    for idx, _labels in enumerate(labels):
+        if len(_labels) == 0:
+            print("FAILED TO FIND LABEL")
+            items.append(None)
+            continue
+
+        logits = logits_per_image[idx, [label_indices[label] for label in _labels]]
+        probs = logits.softmax(dim=-1).numpy()
+        best = int(probs.argmax())
+        items.append({
+            "label": _labels[best],
+            "score": round(float(probs[best]), 3),
+            "embeddings": image_embeddings[idx],
+        })
+    return items
+
+def normalize_embeddings(embeddings):
+    """
+    normalize_embeddings() L2 normalizes embeddings the same way the CLIP model does
+
+    :param embeddings: tensor of [N, dim]
+    :return: normalized tensor of [N, dim]
+    """
+    norm = torch.pow(torch.sum(torch.pow(embeddings, 2), dim=-1, keepdim=True), 0.5)
+    return embeddings / norm
+
+def run_image_embeddings(
+        model,
+        processor,
+        images):
+    """
+    run_image_embeddings() runs the vision tower of the classification model only,
+    skipping tokenization and text encoding
+
+    :param model: classification model
+    :param processor: classification processor
+    :param images: list of images to inference
+    :return: [embeddings, ...] where embeddings size is 768
+    """
+    with timer(STAGE_PREPROCESS):
+        inputs = preprocess(processor, images = images, return_tensors = "pt")
+
+    with torch.no_grad(), timer(STAGE_FORWARD):
+        image_embeds = normalize_embeddings(model.get_image_features(**inputs))
+
+    return list(to_embeddings(image_embeds))
+
+def filter_by_size(
+        boxes,
+        scores,
+        image_w,
+        image_h):
+    """
+    filter_by_size() filter out boxes that are too small or too narrow
+
+    Conditions to ignore cropped image
+    if w and h ratio is < 0.3
+    if image ratio is < 0.05 unless ratio is > 0.03 AND score is > 0.20
+
+    :param boxes: tensor of [N, 4] in (xmin, ymin, xmax, ymax)
+    :param scores: tensor of [N]
+    :param image_w: width of the image
+    :param image_h: height of the image
+    :return: keep mask of [N], ratio_img of [N]
+    """
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+    ratio_wh = torch.minimum(w, h) / torch.maximum(w, h)
+    ratio_img = (w * h) / (image_w * image_h)
+
+    too_narrow = ratio_wh < MIN_RATIO_WH
+    too_small = (ratio_img < MIN_RATIO_IMG) & ~((scores > MIN_SCORE_SMALL) & (ratio_img > MIN_RATIO_IMG_SMALL))
+    return ~(too_narrow | too_small), ratio_img
+
 def find_bounding_boxes(
         model,
         processor,
-        image):
+        image,
+        iou_threshold = DUPLICATED_IOU_THRESHOLD,
+        image_queries = None):
     """
     find_bounding_boxes() find apparel bounding boxes with object detection model
 
     :param model: object detection model
     :param processor: object detection processor
     :param image: image to find apparel bounding boxes
+    :param iou_threshold: (optional) also treat overlapping boxes above the IoU as duplicated
+    :param image_queries: (optional) (query_embeds, labels) from encode_image_queries, replaces first pass labels
     :return: [{ label, score, box, xy, cropped, second_pass }]
     """
     _candidates = []
 
     first_pass_labels = FIRST_PASS_LABELS
 
-    image_w, image_h = image.size
+    image_w, image_h = get_image_size(image)
 
     print(f"IMAGE WxH = {image_w} x {image_h}")
 
-    outputs = run_object_detection(model, processor, image, first_pass_labels)
+    outputs = run_object_detection(model, processor, image, first_pass_labels, image_queries)
 
-    for label, score, box, xy in outputs:
-        xmin, ymin, xmax, ymax = box
+    if len(outputs) > 0:
+        boxes = torch.tensor([box for _, _, box, _ in outputs], dtype=torch.float64)
+        scores = torch.tensor([score for _, score, _, _ in outputs], dtype=torch.float64)
+        keep, ratio_img = filter_by_size(boxes, scores, image_w, image_h)
 
-        # filter out items that are too small
-        _w = xmax - xmin
-        _h = ymax - ymin
-        ratio_wh = _w / _h if _h > _w else _h / _w
-        ratio_img = (_w * _h) / (image_w * image_h)
+        for (label, score, box, xy), _keep, _ratio_img in zip(outputs, keep.tolist(), ratio_img.tolist()):
+            if not _keep:
+                xmin, ymin, xmax, ymax = box
+                print(f"!!!!! IGNORED: SIZE TOO SMALL: {label}, {score}, [{round(_ratio_img, 2)}], ({round(xmax - xmin, 2)} x {round(ymax - ymin, 2)})")
+                continue
 
-        # Conditions to ignore cropped image
-        # if w and h ratio is < 0.3
-        # if image ratio is < 0.05 unless ratio is > 0.03 AND score is > 0.20
-        should_ignore = False
-        if ratio_wh < 0.3:
-            should_ignore = True
-        elif ratio_img < 0.05:
-            should_ignore = True
-            if score > 0.20 and ratio_img > 0.03:
-                should_ignore = False
-
-        cropped = image.crop((xmin, ymin, xmax, ymax))
-
-        if should_ignore == True:
-            print(f"!!!!! IGNORED: SIZE TOO SMALL: {label}, {score}, [{round(ratio_img, 2)}], ({round(xmax - xmin, 2)} x {round(ymax - ymin, 2)})")
-            continue
-
-        if label not in AMBIGUOUS_LABELS:
+            # crop lazily, only the boxes that survive the filters are cropped
             _candidates.append({
                 "label": label,
                 "score": score,
                 "box": box,
                 "xy": xy,
-                "cropped": cropped
+                "crop": (image, tuple(box))
             })
-        else:
-            cropped_w, cropped_h = cropped.size
-            second_pass_labels = SECOND_PASS_LABELS
 
-            inner_outputs = run_object_detection(model, processor, cropped, second_pass_labels)
+    # run second pass on all ambiguous crops as one batch
+    ambiguous = [
+        idx for idx, candidate in enumerate(_candidates)
+        if candidate["label"] in AMBIGUOUS_LABELS
+    ]
 
-            # if find nothing, use the previous detected object
-            if len(inner_outputs) == 0:
-                _candidates.append({
-                    "label": label,
-                    "score": score,
+    if len(ambiguous) > 0:
+        second_pass_labels = SECOND_PASS_LABELS
+
+        for idx in ambiguous:
+            _candidates[idx]["cropped"] = crop_image(image, _candidates[idx]["crop"][1])
+
+        inner_results = run_batch_object_detection(
+            model,
+            processor,
+            [_candidates[idx]["cropped"] for idx in ambiguous],
+            second_pass_labels)
+
+        # map the inner boxes back to the frame coordinates
+        counts = torch.tensor([len(result["boxes"]) for result in inner_results])
+        inner_boxes = torch.cat([result["boxes"] for result in inner_results]).double()
+        offsets = torch.tensor([
+            _candidates[idx]["box"][:2] * 2 for idx in ambiguous
+        ], dtype=inner_boxes.dtype).repeat_interleave(counts, dim=0)
+        boxes = inner_boxes + offsets
+        xys = ((boxes[:, :2] + boxes[:, 2:]) / 2) / torch.tensor([image_w, image_h], dtype=boxes.dtype)
+
+        inner_boxes = inner_boxes.tolist()
+        boxes = boxes.tolist()
+        xys = xys.tolist()
+
+        second_pass = {}
+        start = 0
+        for idx, result in zip(ambiguous, inner_results):
+            end = start + len(result["boxes"])
+            cropped = _candidates[idx]["cropped"]
+            second_pass[idx] = [
+                {
+                    "label": second_pass_labels[_label],
+                    "score": round(_score, 3),
                     "box": box,
                     "xy": xy,
-                    "cropped": cropped
-                })
-            else:
-                # ignore the previous detected object
-                for _label, _score, _box, _xy in inner_outputs:
-                    _xmin, _ymin, _xmax, _ymax = _box
-
-                    _cropped = cropped.crop((_xmin, _ymin, _xmax, _ymax))
-
-                    # recalculate box and xy
-                    _w = _xmax - _xmin
-                    _h = _ymax - _ymin
-
-                    _xmin = xmin + _xmin
-                    _ymin = ymin + _ymin
-                    _xmax = _xmin + _w
-                    _ymax = _ymin + _h
-
-                    _candidates.append({
-                        "label": _label,
-                        "score": _score,
-                        "box": [_xmin, _ymin, _xmax, _ymax],
-                        "xy": [((_w / 2) + _xmin) / image_w, ((_h / 2) + _ymin) / image_h],
-                        "cropped": _cropped,
-                        "second_pass": True
-                    })
+                    "crop": (cropped, tuple(inner_box)),
+                    "second_pass": True
+                }
+                for _label, _score, box, xy, inner_box in zip(
+                    result["labels"].tolist(),
+                    result["scores"].tolist(),
+                    boxes[start:end],
+                    xys[start:end],
+                    inner_boxes[start:end])
+            ]
+            start = end
+
+        # if find nothing, use the previous detected object
+        # otherwise, ignore the previous detected object
+        _candidates = [
+            inner
+            for idx, candidate in enumerate(_candidates)
+            for inner in (second_pass.get(idx) or [candidate])
+        ]
+
     # filter duplicated
-    filtered = filter_duplicated(_candidates)
+    with timer(STAGE_POSTPROCESS):
+        filtered = filter_duplicated(_candidates, iou_threshold=iou_threshold)
+
+    for item in filtered:
+        source, crop_box = item.pop("crop")
+        if "cropped" not in item:
+            item["cropped"] = crop_image(source, crop_box)
     return filtered
 
-def filter_duplicated(items):
+def filter_duplicated(
+        items,
+        distance = DUPLICATED_DISTANCE,
+        iou_threshold = None):
     """
-    filter_duplicated() filter out duplicated bounding boxes within the image
+    filter_duplicated() filter out duplicated bounding boxes within the image.
+    Items are visited in descending score order and an item is dropped when its center
+    is closer than the distance to an item already kept (or overlaps it above iou_threshold).
 
     :param items: list of boxes from find_bounding_boxes
+    :param distance: (optional) normalized centroid distance below which boxes are duplicated
+    :param iou_threshold: (optional) IoU above which boxes are duplicated
     :return: [{ label, score, box, xy, cropped, second_pass }]
     """
-    filtered = []
-
     if len(items) == 0:
-        return filtered
-
-    filtered.append(items.pop(0))
-
-    for item in items:
-        found = None
-        xy = item["xy"]
-
-        for _idx in range(len(filtered)):
-            _item = filtered[_idx]
-            _xy = _item["xy"]
-
-            distance = math.dist(xy, _xy)
-            if distance < 0.12:
-                # swap the item
-                if item["score"] > _item["score"]:
-                    found = _idx
-                # keep the original
-                else:
-                    found = -1
-
-        if found == None:
-            filtered.append(item)
-        elif found >= 0:
-            filtered[found] = item
-    return filtered
+        return []
+
+    xy = torch.tensor([item["xy"] for item in items], dtype=torch.float64)
+    scores = torch.tensor([item["score"] for item in items], dtype=torch.float64)
+
+    duplicated = torch.cdist(xy, xy) < distance
+    if iou_threshold is not None:
+        boxes = torch.tensor([item["box"] for item in items], dtype=torch.float64)
+        duplicated |= torchvision_ops.box_iou(boxes, boxes) > iou_threshold
+
+    # stable sort keeps the original order among equal scores
+    order = torch.sort(scores, descending=True, stable=True).indices.tolist()
+
+    suppressed = torch.zeros(len(items), dtype=torch.bool)
+    keep = []
+    for idx in order:
+        if suppressed[idx]:
+            continue
+        keep.append(idx)
+        suppressed |= duplicated[idx]
+
+    # return in the original detection order
+    return [items[idx] for idx in sorted(keep)]
 
 def get_embeddings(
     model,
@@ -290,26 +596,72 @@ def get_embeddings(
     :param options: option dict to merge into the response
     :return: { label, score, embeddings, box, **options }
     """
+    return get_batch_embeddings(
+        model,
+        processor,
+        [(items, image_w, image_h, options)])
+
+def get_batch_embeddings(
+    model,
+    processor,
+    frames,
+    batch_size = CLS_BATCH_SIZE,
+    embedding_only = True
+    ):
+    """
+    get_batch_embeddings() runs get embeddings for the cropped images of one or more frames
+    in batched forward passes of the classification model
+
+    :param model: classification model
+    :param processor: classification processor
+    :param frames: list of (items, image_w, image_h, options) where items returns from find_bounding_boxes
+    :param batch_size: (optional) max number of cropped images per forward pass
+    :param embedding_only: (optional) skip the text tower. Each crop is scored against its
+        own label only, the softmax over a single label is always 1.0
+    :return: [{ label, score, embeddings, box, **options }, ...]
+    """
+    # flatten the cropped images of all frames, keeping the frame each one belongs to
+    crops = [
+        (item, image_w, image_h, options)
+        for items, image_w, image_h, options in frames
+        for item in items
+    ]
+
     embedding_items = []
-    for item in items:
-        embedding_item = run_classification(
-            model,
-            processor,
-            item["cropped"],
-            [item["label"]])
-        if embedding_item != None:
-            xmin, ymin, xmax, ymax = item["box"]
-            box = {
-                "w": float((xmax - xmin) / image_w),
-                "h": float((ymax - ymin) / image_h),
-                "l": float(xmin / image_w),
-                "t": float(ymin / image_h)
-            }
-            embedding_items.append({
-                **embedding_item,
-                **options,
-                "box": box
-            })
+    for idx in range(0, len(crops), batch_size):
+        batch = crops[idx:idx + batch_size]
+        images = [item["cropped"] for item, _, _, _ in batch]
+
+        if embedding_only:
+            outputs = [
+                {
+                    "label": item["label"],
+                    "score": 1.0,
+                    "embeddings": embeddings,
+                }
+                for (item, _, _, _), embeddings in zip(batch, run_image_embeddings(model, processor, images))
+            ]
+        else:
+            outputs = run_batch_classification(
+                model,
+                processor,
+                images,
+                [[item["label"]] for item, _, _, _ in batch])
+
+        for (item, image_w, image_h, options), embedding_item in zip(batch, outputs):
+            if embedding_item != None:
+                xmin, ymin, xmax, ymax = item["box"]
+                box = {
+                    "w": float((xmax - xmin) / image_w),
+                    "h": float((ymax - ymin) / image_h),
+                    "l": float(xmin / image_w),
+                    "t": float(ymin / image_h)
+                }
+                embedding_items.append({
+                    **embedding_item,
+                    **options,
+                    "box": box
+                })
     return embedding_items
 
 def process_image(
@@ -332,29 +684,196 @@ def process_image(
     :param name: name of the image
     :return: [ { label, score, embeddings, box, name }, ...]
     """
-    embedding_items = []
-
-    key = os.path.join(prefix, name)
-
-    image = load_from_s3(bucket, key)
-    image_w, image_h = image.size
+    return process_images(
+        obj_model,
+        obj_processor,
+        cls_model,
+        cls_processor,
+        bucket,
+        prefix,
+        [name])
 
-    items = find_bounding_boxes(
+def process_images(
         obj_model,
         obj_processor,
-        image)
+        cls_model,
+        cls_processor,
+        bucket,
+        prefix,
+        names,
+        image_queries = None,
+        frame_options = {},
+        images = None):
+    """
+    process_images() process a window of images, the cropped images of all frames
+    are embedded together
 
-    options = {
-        "name": name
-    }
-    embedding_items = get_embeddings(cls_model,
-                                     cls_processor,
-                                     items,
-                                     image_w,
-                                     image_h,
-                                     options)
+    :param obj_model: object detection model
+    :param obj_processor: object detection processor
+    :param cls_model: classification model
+    :param cls_processor: classification processor
+    :param bucket: bucket of the images
+    :param prefix: prefix of the images
+    :param names: names of the images
+    :param image_queries: (optional) (query_embeds, labels) from encode_image_queries
+    :param frame_options: (optional) dict of name to option dict to merge into the response
+    :param images: (optional) prefetched Image objects of the images
+    :return: [ { label, score, embeddings, box, name }, ...]
+    """
+    frames = []
+
+    for idx, name in enumerate(names):
+        if images is not None:
+            image = images[idx]
+        else:
+            key = os.path.join(prefix, name)
+            image = load_from_s3(bucket, key)
+        image_w, image_h = get_image_size(image)
+
+        items = find_bounding_boxes(
+            obj_model,
+            obj_processor,
+            image,
+            image_queries=image_queries)
+
+        options = {
+            **frame_options.get(name, {}),
+            "name": name
+        }
+        frames.append((items, image_w, image_h, options))
+
+    embedding_items = get_batch_embeddings(cls_model,
+                                           cls_processor,
+                                           frames)
     return embedding_items
 
+def laplacian_variance(image):
+    """
+    laplacian_variance() cheap sharpness score of an image
+
+    :param image: Image object
+    :return: variance of the Laplacian of the grayscale image
+    """
+    gray = np.asarray(image.convert("L"), dtype=np.float32)
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return 0.0
+    laplacian = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+        - 4 * gray[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+def check_sampling(mode, frames_per_shot):
+    """
+    check_sampling() validates the shot sampling options
+
+    :param mode: first, middle or sharpest
+    :param frames_per_shot: number of frames to pick per shot, at least 1
+    """
+    if mode not in SAMPLING_MODES:
+        raise ValueError(f"invalid sampling mode: {mode}")
+    if frames_per_shot < 1:
+        raise ValueError(f"invalid frames_per_shot: {frames_per_shot}")
+
+def get_shots(frames):
+    """
+    get_shots() indices of the frames per shot, frames without shotIdx are their own shot
+
+    :param frames: framesegmentation json, [{ name, shotIdx, ... }]
+    :return: { shotIdx: [index, ...] }
+    """
+    shots = {}
+    for idx, frame in enumerate(frames):
+        shot_idx = frame.get("shotIdx", f"frame-{idx}")
+        shots.setdefault(shot_idx, []).append(idx)
+    return shots
+
+def get_unscored_frames(frames, frames_per_shot = FRAMES_PER_SHOT):
+    """
+    get_unscored_frames() frames the sharpest mode has to score, the frames without
+    laplacian of the shots with more than frames_per_shot frames
+
+    :param frames: framesegmentation json
+    :param frames_per_shot: (optional) number of frames to pick per shot
+    :return: [name, ...]
+    """
+    return [
+        frames[idx]["name"]
+        for indices in get_shots(frames).values() if len(indices) > frames_per_shot
+        for idx in indices if "laplacian" not in frames[idx]
+    ]
+
+def score_frames(
+        bucket,
+        prefix,
+        names,
+        context,
+        scores,
+        pack = None):
+    """
+    score_frames() scores the sharpness of frames with the parallel prefetch until
+    quit_now(), the scores of a previous entry are kept
+
+    :param bucket: bucket of the frames
+    :param prefix: prefix of the frames
+    :param names: names of the frames to score
+    :param context: lambda context
+    :param scores: { name: laplacian } updated in place
+    :param pack: (optional) FramePack of the frames
+    :return: True if all frames are scored
+    """
+    names = [name for name in names if name not in scores]
+    # the frames are scored where they are decoded, in the prefetch threads with a pack
+    laplacians = load_images_from_s3(
+        bucket,
+        [os.path.join(prefix, name) for name in names],
+        S3_CONCURRENCY,
+        pack,
+        lambda body: laplacian_variance(open_image(body)))
+    try:
+        for name in names:
+            if quit_now(context):
+                return False
+            scores[name] = next(laplacians)
+    finally:
+        laplacians.close()
+    return True
+
+def select_shot_frames(
+        frames,
+        mode = "middle",
+        frames_per_shot = FRAMES_PER_SHOT):
+    """
+    select_shot_frames() picks representative frames per shot from the framesegmentation json
+
+    :param frames: framesegmentation json, [{ name, shotIdx, laplacian?, ... }]
+    :param mode: (optional) first, middle or sharpest. The sharpest mode needs the
+        laplacian of the frames returned by get_unscored_frames(), see score_frames()
+    :param frames_per_shot: (optional) number of frames to pick per shot
+    :return: selected framesegmentation items in the original order
+    """
+    check_sampling(mode, frames_per_shot)
+
+    selected = []
+    for indices in get_shots(frames).values():
+        if len(indices) <= frames_per_shot:
+            selected.extend(indices)
+        elif mode == "first":
+            selected.extend(indices[:frames_per_shot])
+        elif mode == "middle":
+            selected.extend([
+                indices[int((i + 0.5) * len(indices) / frames_per_shot)]
+                for i in range(frames_per_shot)
+            ])
+        else:
+            missing = [frames[idx]["name"] for idx in indices if "laplacian" not in frames[idx]]
+            if len(missing) > 0:
+                raise ValueError(f"missing laplacian: {missing[0]}")
+            ranked = sorted(indices, key=lambda idx: -frames[idx]["laplacian"])
+            selected.extend(ranked[:frames_per_shot])
+
+    return [frames[idx] for idx in sorted(selected)]
+
 def load_previous_run(bucket, prefix, output):
     """
     load_previous_run() loads json results from the previous run if exists
@@ -368,8 +887,7 @@ def load_previous_run(bucket, prefix, output):
 
     try:
         key = os.path.join(prefix, output)
-        item_embeddings = get_object(bucket, key).decode('utf-8')
-        item_embeddings = json.loads(item_embeddings)
+        item_embeddings = loads(get_object(bucket, key))
     except:
         pass
     return item_embeddings
@@ -402,25 +920,29 @@ def process_local_file(file):
                                      image_h,
                                      options)
 
-    with open("embeddings.json", "w") as f:
-        f.write(json.dumps(embedding_items))
+    with open("embeddings.json", "wb") as f:
+        f.write(dumps(embedding_items))
     return embedding_items
 
 def set_completed(event, params = {}):
     if "next_index" in event:
         del event["next_index"]
+    emit_metrics()
     return {
         **event,
         **params,
+        "s3cache": get_cache_stats(event.get("s3cache", {})),
         "tend": round(time.time() * 1000),
         "status": "COMPLETED"
     }
 
 def set_progress(event, params = {}):
+    emit_metrics()
     print(f"== [info]: set_progress.before: {event}, {params}")
     _params = {
         **event,
         **params,
+        "s3cache": get_cache_stats(event.get("s3cache", {})),
         "status": "IN_PROGRESS"
     }
     print(f"== [info]: set_progress.after: {_params}")
@@ -430,7 +952,13 @@ def lambda_handler(event, context):
     """
     lambda_handler() lambda entrypoint
     """
+    profiler = None
     try:
+        reset_cache_stats()
+        reset_metrics()
+        set_embedding_precision(event.get("precision", EMBEDDING_PRECISION))
+        set_content_encoding(event.get("content_encoding", CONTENT_ENCODING), event.get("compression_level"))
+
         # special case
         if "local_file" in event:
             return process_local_file(event["local_file"])
@@ -449,21 +977,98 @@ def lambda_handler(event, context):
         else:
             event["tsta"] = tsta
 
-        # load framesegmentation json
+        # the progress manifest of this run decides whether work remains before the
+        # frames, the results of the previous run and the models are loaded
         next_index = 0 if "next_index" not in event else int(event["next_index"])
-        key = os.path.join(prefix, event["json"])
-        names = json.loads(get_object(bucket, key))
-        print(f"== [info]: loaded {event['json']}: names: {len(names)}")
+        progress = load_progress(bucket, prefix, output, tsta)
+        if progress is not None:
+            print(f"== [info]: loaded progress: processed: {progress['processed']}, total: {progress['total']}")
+            # the manifest is saved after the output, it is ahead of the event
+            # when the previous entry uploaded the output but did not return
+            next_index = int(progress["processed"])
+            if next_index >= int(progress["total"]):
+                return set_completed(event)
+
+        # load framesegmentation json, or the frames sampled by the first entry
+        frames_json = event.get("sampled_json", event["json"])
+        key = os.path.join(prefix, frames_json)
+        frames = json.loads(get_object(bucket, key))
+        print(f"== [info]: loaded {frames_json}: names: {len(frames)}")
+
+        # frames bundled in one pack are read with a few ranged GETs instead of one GET per frame
+        pack = open_frame_pack(event, bucket, prefix)
+
+        # shot-representative sampling, select once and save the selection for re-entries
+        sampling = event.get("sampling")
+        if sampling is not None and "sampled_json" not in event:
+            t0 = time.time()
+            frames_per_shot = int(event.get("frames_per_shot", FRAMES_PER_SHOT))
+            check_sampling(sampling, frames_per_shot)
+
+            # frames without laplacian are scored first, the scores are saved for the
+            # next entry when the time is up before all frames are scored
+            if sampling == "sharpest":
+                laplacian_json = f"{os.path.splitext(output)[0]}_laplacian.json"
+                scores = {}
+                if "laplacian_json" in event:
+                    scores = loads(get_object(bucket, os.path.join(prefix, event["laplacian_json"])))
+                unscored = get_unscored_frames(frames, frames_per_shot)
+                if not score_frames(bucket, prefix, unscored, context, scores, pack):
+                    put_object(
+                        bucket,
+                        os.path.join(prefix, laplacian_json),
+                        dumps(scores),
+                        "application/json")
+                    print(f"== [info]: scored {len(scores)}/{len(unscored)} frames, {round(time.time() - t0, 3)}s")
+                    return set_progress(event, {
+                        "laplacian_json": laplacian_json
+                    })
+                frames = [
+                    { **frame, "laplacian": scores[frame["name"]] } if frame["name"] in scores else frame
+                    for frame in frames
+                ]
+
+            frames = select_shot_frames(
+                frames,
+                sampling,
+                frames_per_shot)
+            sampled_json = f"{os.path.splitext(output)[0]}_frames.json"
+            put_object(
+                bucket,
+                os.path.join(prefix, sampled_json),
+                dumps(frames),
+                "application/json")
+            event["sampled_json"] = sampled_json
+            t1 = time.time()
+            print(f"== [info]: sampled {event['json']} ({sampling}): names: {len(frames)}, {round(t1 - t0, 3)}s")
+
+        # label the output of sampled frames so the per shot aggregation knows
+        frame_options = {}
+        if sampling is not None:
+            frame_options = {
+                frame["name"]: {
+                    "shotIdx": frame.get("shotIdx"),
+                    "sampling": sampling
+                }
+                for frame in frames
+            }
 
         # no more frame to process?
-        names = [ item["name"] for item in names[next_index:] ]
-        print(f"== [info]: sliced {event['json']}: names: {len(names)}")
+        total = len(frames)
+        names = [ item["name"] for item in frames[next_index:] ]
+        print(f"== [info]: sliced {frames_json}: names: {len(names)}")
 
         if len(names) == 0:
             return set_completed(event)
 
-        item_embeddings = load_previous_run(bucket, prefix, output)
-        print(f"== [info]: loaded {event['embeddings']}: item_embeddings: {len(item_embeddings)}")
+        # on-demand profiling of the first N frames, off unless requested
+        profiler = start_profiler(event)
+
+        # results of the previous entries of this run, the first entry starts afresh
+        item_embeddings = []
+        if next_index > 0:
+            item_embeddings = load_previous_run(bucket, prefix, output)
+            print(f"== [info]: loaded {event['embeddings']}: item_embeddings: {len(item_embeddings)}")
 
         print(f"=== LOADING MODELS ===")
         t0 = time.time()
@@ -476,46 +1081,154 @@ def lambda_handler(event, context):
         t1 = time.time()
         print(f"=== CLASSIFICATION MODEL LOADED: {round(t1 - t0)}s")
 
-        while not quit_now(context) and len(names) > 0:
-            name = names.pop(0)
-            print(f"=== PROCESSING: {name}")
-            t0 = time.time()
-            image_embeddings = process_image(
+        # image-guided detection, reference images are encoded once
+        image_queries = None
+        queries_hash = None
+        if "query_images" in event:
+            query_images = load_query_images(event["query_images"])
+            queries_hash = get_labels_hash([
+                [item["label"], get_content_hash(item["image"])] for item in query_images
+            ])
+            query_embeds, query_labels = encode_image_queries(
                 obj_model,
                 obj_processor,
-                cls_model,
-                cls_processor,
-                bucket,
-                prefix,
-                name
-            )
-            t1 = time.time()
-            print(f"=== PROCESSED: {name} ({len(image_embeddings)} items), {round(t1 - t0)}s")
-            item_embeddings.extend(image_embeddings)
+                query_images)
+            if query_embeds is None:
+                raise ValueError("no usable query image")
+            image_queries = (query_embeds, query_labels)
+            print(f"=== QUERY IMAGES ENCODED: {query_labels}")
+
+        # number of frames whose cropped images are embedded together and the prefetch
+        # depth, sized from the memory limit unless set by "frame_window" and "concurrency"
+        sizer = start_sizer(event, context, S3_CONCURRENCY, MAX_FRAME_WINDOW, "frame_window")
+
+        # PIL images or uint8 tensors decoded by torchvision, see decode.py
+        decoder, decode = get_decoder(event)
+
+        # results of identical frames seen before with the same models and labels, off by
+        # default. The cached items of a frame have no frame options, they are merged back.
+        result_cache = open_result_cache(
+            event,
+            obj_checkpoint=obj_model.name_or_path,
+            cls_checkpoint=cls_model.name_or_path,
+            labels=get_labels_hash([FIRST_PASS_LABELS, SECOND_PASS_LABELS, AMBIGUOUS_LABELS]),
+            query_images=queries_hash,
+            precision=event.get("precision", EMBEDDING_PRECISION),
+            decoder=decoder)
+
+        # prefetch the images in parallel while the models are running
+        images = load_images_with_results(
+            bucket,
+            [os.path.join(prefix, name) for name in names],
+            result_cache,
+            sizer.concurrency,
+            pack,
+            decode)
+
+        # the prefetch stops downloading when the loop ends or raises
+        try:
+            while not quit_now(context) and len(names) > 0:
+                window = names[:sizer.batch_size]
+                names = names[sizer.batch_size:]
+                print(f"=== PROCESSING: {window}")
+                t0 = time.time()
+                loaded = [next(images) for _ in window]
+
+                # { name: items of the frame }, only the frames missing from the cache are processed
+                frame_items = {}
+                misses = [idx for idx, (_, _, cached) in enumerate(loaded) if cached is None]
+                for name, (_, _, cached) in zip(window, loaded):
+                    if cached is not None:
+                        options = {
+                            **frame_options.get(name, {}),
+                            "name": name
+                        }
+                        frame_items[name] = [
+                            {
+                                **{k: v for k, v in item.items() if k != "box"},
+                                **options,
+                                "box": item["box"]
+                            } for item in cached
+                        ]
+
+                if len(misses) > 0:
+                    with sizer.measure(len(misses)):
+                        processed = process_images(
+                            obj_model,
+                            obj_processor,
+                            cls_model,
+                            cls_processor,
+                            bucket,
+                            prefix,
+                            [window[idx] for idx in misses],
+                            image_queries,
+                            frame_options,
+                            [loaded[idx][0] for idx in misses]
+                        )
+                    for idx in misses:
+                        frame_items[window[idx]] = []
+                    for item in processed:
+                        frame_items[item["name"]].append(item)
+
+                    if result_cache is not None:
+                        for idx in misses:
+                            name = window[idx]
+                            option_keys = set(frame_options.get(name, {})) | {"name"}
+                            result_cache.put(loaded[idx][1], [
+                                {k: v for k, v in item.items() if k not in option_keys}
+                                for item in frame_items[name]
+                            ])
+
+                image_embeddings = [item for name in window for item in frame_items[name]]
+                t1 = time.time()
+                print(f"=== PROCESSED: {window} ({len(image_embeddings)} items), {round(t1 - t0)}s")
+                item_embeddings.extend(image_embeddings)
+                if profiler is not None:
+                    profiler.step(len(window))
+        finally:
+            images.close()
+
+        result_stats = {}
+        if result_cache is not None:
+            result_cache.close()
+            result_stats = { "resultcache": result_cache.get_stats() }
+            print(f"== [info]: result cache: {result_stats['resultcache']}")
 
         print(f"== [info]: completed {event['embeddings']}: item_embeddings: {len(item_embeddings)}, names: {len(names)}")
 
         # upload json output
         output_key = os.path.join(prefix, output)
-        put_object(
+        put_json_items(
             bucket,
             output_key,
-            json.dumps(item_embeddings, default=str),
-            "application/json")
+            item_embeddings)
 
         tend = round(time.time() * 1000)
         print(f"== TOTAL RUNTIME: {round((tend - tsta) / 1000)}s ==")
 
+        # frames processed so far, the output has a variable number of items per frame
+        print(f"== [info]: next_index.before = {next_index}, .after = {total - len(names)}")
+        next_index = total - len(names)
+        save_progress(bucket, prefix, output, tsta, next_index, total)
+
+        # the profile covers the output upload and the progress manifest
+        stop_profiler(profiler, event, bucket, prefix, getattr(context, "aws_request_id", None))
+
         # update event for the next re-entry of the lambda
         if len(names) == 0:
-            return set_completed(event)
+            return set_completed(event, {
+                "sizing": sizer.get_settings(),
+                **result_stats
+            })
 
-        print(f"== [info]: next_index.before = {next_index}, .after = {len(item_embeddings)}");
-        next_index = len(item_embeddings)
         return set_progress(event, {
-            "next_index": next_index
+            "next_index": next_index,
+            "sizing": sizer.get_settings(),
+            **result_stats
         })
     except Exception as e:
+        if profiler is not None:
+            profiler.stop()
         print(f"[ERR]: {type(e).__name__}")
         traceback.print_exc()
         raise e
@@ -0,0 +1,273 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+import os
+import json
+import time
+import traceback
+from io import BytesIO
+from utils import LazyModule, get_object, put_object, get_uri, dumps, loads, load_from_file, load_from_s3, load_from_s3uri, map_objects, quit_now, reset_cache_stats, set_content_encoding, CONTENT_ENCODING
+from metrics import reset_metrics
+from app import load_cls_model, run_image_embeddings, set_completed, set_progress, CLS_BATCH_SIZE
+
+# heavy modules are imported on first use, see LazyModule
+faiss = LazyModule("faiss")
+np = LazyModule("numpy")
+
+# number of manifest items per shard, progress is saved per shard
+SHARD_SIZE = 512
+SHARD_PREFIX = "shards"
+
+# ready-to-load catalog files, read by faiss-on-aws catalog search
+CATALOG_INDEX = "catalog.index"
+CATALOG_TABLE = "catalog.json"
+
+def load_product_image(bucket, item):
+    """
+    load_product_image() loads a product image of a manifest item
+
+    :param bucket: bucket of the catalog
+    :param item: manifest item contains "s3uri", "key" or "file" of the image
+    :return: Image object or None
+    """
+    image = None
+    try:
+        if "s3uri" in item:
+            image = load_from_s3uri(item["s3uri"])
+        elif "key" in item:
+            image = load_from_s3(bucket, item["key"])
+        elif "file" in item:
+            image = load_from_file(item["file"])
+    except Exception as e:
+        print(f"!!!!! SKIPPED: {item.get('asin')}: {type(e).__name__}")
+        return None
+
+    if image is not None:
+        image = image.convert("RGB")
+    return image
+
+def embed_shard(
+        cls_model,
+        cls_processor,
+        bucket,
+        items,
+        batch_size = CLS_BATCH_SIZE,
+        context = None,
+        offset = 0,
+        embeddings = None,
+        table = None):
+    """
+    embed_shard() embeds the product images of a shard in batches, the images are
+    prefetched in parallel. Stops at quit_now() after a batch, the next entry resumes
+    from the returned offset.
+
+    :param cls_model: classification model
+    :param cls_processor: classification processor
+    :param bucket: bucket of the catalog
+    :param items: manifest items of the shard
+    :param batch_size: (optional) number of images per forward pass
+    :param context: (optional) lambda context
+    :param offset: (optional) number of items embedded by a previous entry
+    :param embeddings: (optional) embeddings of the items before offset, see get_shard()
+    :param table: (optional) table of the items before offset
+    :return: embeddings of [N, 768] float32, table [{ asin, label, file, score }] of N rows,
+        number of items embedded
+    """
+    embeddings = [] if embeddings is None else list(embeddings)
+    table = [] if table is None else list(table)
+
+    images = map_objects(lambda item: load_product_image(bucket, item), items[offset:])
+    try:
+        for idx in range(offset, len(items), batch_size):
+            # at least one batch per entry
+            if idx > offset and quit_now(context):
+                offset = idx
+                break
+            batch = []
+            for item in items[idx:idx + batch_size]:
+                image = next(images)
+                if image is None:
+                    continue
+                batch.append(image)
+                table.append({
+                    "asin": item["asin"],
+                    "label": item["label"],
+                    "file": item.get("key", item.get("s3uri", item.get("file"))),
+                    "score": 1.0,
+                })
+
+            if len(batch) > 0:
+                embeddings.extend(run_image_embeddings(cls_model, cls_processor, batch))
+        else:
+            offset = len(items)
+    finally:
+        images.close()
+
+    if len(embeddings) == 0:
+        return np.zeros((0, cls_model.config.projection_dim), dtype=np.float32), table, offset
+    return np.array(embeddings, dtype=np.float32), table, offset
+
+def get_shard_name(prefix, shard_idx):
+    return os.path.join(prefix, SHARD_PREFIX, f"{shard_idx:05d}")
+
+def put_shard(bucket, prefix, shard_idx, embeddings, table):
+    """
+    put_shard() uploads the embeddings and table of a shard
+
+    :param bucket: bucket of the catalog
+    :param prefix: prefix of the catalog
+    :param shard_idx: index of the shard
+    :param embeddings: embeddings of [N, dim]
+    :param table: table of N rows
+    """
+    buffer = BytesIO()
+    np.save(buffer, embeddings)
+    name = get_shard_name(prefix, shard_idx)
+    put_object(bucket, f"{name}.npy", buffer.getvalue(), "application/octet-stream")
+    put_object(bucket, f"{name}.json", dumps(table), "application/json")
+
+def get_shard(bucket, prefix, shard_idx):
+    """
+    get_shard() downloads the embeddings and table of a shard
+
+    :param bucket: bucket of the catalog
+    :param prefix: prefix of the catalog
+    :param shard_idx: index of the shard
+    :return: embeddings of [N, dim], table of N rows
+    """
+    name = get_shard_name(prefix, shard_idx)
+    embeddings = np.load(BytesIO(get_object(bucket, f"{name}.npy")))
+    return embeddings, loads(get_object(bucket, f"{name}.json"))
+
+def build_index(bucket, prefix, num_shards):
+    """
+    build_index() merges all shards into a faiss index and the id to ASIN table
+
+    :param bucket: bucket of the catalog
+    :param prefix: prefix of the catalog
+    :param num_shards: number of shards
+    :return: number of catalog items
+    """
+    index = None
+    table = []
+
+    for shard_idx in range(num_shards):
+        embeddings, shard_table = get_shard(bucket, prefix, shard_idx)
+        if index is None:
+            index = faiss.IndexFlatIP(embeddings.shape[1]) # cosine similarity
+        index.add(embeddings)
+        table.extend(shard_table)
+
+    if index is None or index.ntotal == 0:
+        raise ValueError("no product image embedded")
+
+    put_object(
+        bucket,
+        os.path.join(prefix, CATALOG_INDEX),
+        faiss.serialize_index(index).tobytes(),
+        "application/octet-stream")
+    put_object(
+        bucket,
+        os.path.join(prefix, CATALOG_TABLE),
+        dumps(table),
+        "application/json")
+    return index.ntotal
+
+def lambda_handler(event, context):
+    """
+    lambda_handler() catalog builder entrypoint
+
+    :param event: requires {"bucket", "prefix", "manifest"} where manifest is
+        a json list of { asin, label, key | s3uri | file }
+    :param context: lambda context
+    :return: event
+    """
+    try:
+        reset_cache_stats()
+        reset_metrics()
+        set_content_encoding(event.get("content_encoding", CONTENT_ENCODING), event.get("compression_level"))
+
+        print("event =", json.dumps(event, indent=2))
+
+        if not set(("bucket", "prefix", "manifest")).issubset(event):
+            raise ValueError("missing input field(s)")
+
+        bucket = event["bucket"]
+        prefix = event["prefix"]
+        shard_size = int(event.get("shard_size", SHARD_SIZE))
+
+        # set start time
+        tsta = round(time.time() * 1000)
+        if "tsta" in event:
+            tsta = event["tsta"]
+        else:
+            event["tsta"] = tsta
+
+        # load manifest and slice by shards
+        next_shard = 0 if "next_shard" not in event else int(event["next_shard"])
+        first_shard = next_shard
+        # items of next_shard embedded by the previous entry, the partial shard is stored
+        shard_offset = int(event.pop("shard_offset", 0))
+        items = json.loads(get_object(bucket, event["manifest"]))
+        num_shards = (len(items) + shard_size - 1) // shard_size
+        print(f"== [info]: loaded {event['manifest']}: items: {len(items)}, shards: {num_shards}, next_shard: {next_shard}")
+
+        if next_shard < num_shards:
+            print(f"=== LOADING MODELS ===")
+            t0 = time.time()
+            cls_model, cls_processor = load_cls_model()
+            t1 = time.time()
+            print(f"=== CLASSIFICATION MODEL LOADED: {round(t1 - t0)}s")
+
+        while not quit_now(context) and next_shard < num_shards:
+            t0 = time.time()
+            shard = items[next_shard * shard_size:(next_shard + 1) * shard_size]
+            embeddings, table = None, None
+            if shard_offset > 0:
+                embeddings, table = get_shard(bucket, prefix, next_shard)
+            embeddings, table, offset = embed_shard(
+                cls_model,
+                cls_processor,
+                bucket,
+                shard,
+                context=context,
+                offset=shard_offset,
+                embeddings=embeddings,
+                table=table)
+            put_shard(bucket, prefix, next_shard, embeddings, table)
+            t1 = time.time()
+            print(f"=== PROCESSED: shard {next_shard} ({len(table)}/{offset} items of {len(shard)}), {round(t1 - t0, 3)}s, {round((offset - shard_offset) / max(t1 - t0, 1e-6), 2)} items/s")
+
+            # the time is up within the shard, the next entry resumes from the offset
+            if offset < len(shard):
+                return set_progress(event, {
+                    "next_shard": next_shard,
+                    "shard_offset": offset
+                })
+            shard_offset = 0
+            next_shard += 1
+
+        # update event for the next re-entry of the lambda, the index is merged in an
+        # invocation of its own when the shards used up the time of this one
+        if next_shard < num_shards or (next_shard > first_shard and quit_now(context)):
+            progress = { "next_shard": next_shard }
+            if shard_offset > 0:
+                progress["shard_offset"] = shard_offset
+            return set_progress(event, progress)
+
+        t0 = time.time()
+        ntotal = build_index(bucket, prefix, num_shards)
+        t1 = time.time()
+        print(f"=== CATALOG INDEX BUILT: {ntotal} items, {round(t1 - t0, 3)}s")
+
+        tend = round(time.time() * 1000)
+        print(f"== TOTAL RUNTIME: {round((tend - tsta) / 1000)}s ==")
+
+        if "next_shard" in event:
+            del event["next_shard"]
+        return set_completed(event, {
+            "catalog": get_uri(bucket, prefix),
+            "ntotal": ntotal
+        })
+    except Exception as e:
+        print(f"[ERR]: {type(e).__name__}")
+        traceback.print_exc()
+        raise e
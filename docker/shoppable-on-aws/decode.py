@@ -0,0 +1,155 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+import os
+import weakref
+import warnings
+from metrics import timer, STAGE_DECODE
+from utils import LazyModule, open_image
+
+# heavy modules are imported on first use, see LazyModule
+np = LazyModule("numpy")
+torch = LazyModule("torch")
+torchvision_io = LazyModule("torchvision.io")
+torchvision_functional = LazyModule("torchvision.transforms.v2.functional")
+transformers = LazyModule("transformers")
+
+# "pil" decodes the frames into PIL images for the processors (default), "torchvision"
+# decodes JPEG straight into uint8 tensors resized and normalized in batches by the
+# fast image processors of transformers, no PIL and numpy round trip
+DECODERS = ["pil", "torchvision"]
+DECODER = os.environ.get("DECODER", "pil")
+
+# start of image marker of JPEG, other formats are decoded by PIL
+JPEG_SOI = b"\xff\xd8\xff"
+
+# fast image processor of each processor, created on first use
+_fast_image_processors = weakref.WeakKeyDictionary()
+
+# the tensors only read the bodies, which are bytes or read only mapped packs
+warnings.filterwarnings("ignore", message="The given buffer is not writable")
+
+def decode_tensor(body):
+    """
+    decode_tensor() decodes an image into an RGB tensor without copying the body,
+    JPEG with torchvision.io.decode_jpeg, other formats with PIL
+
+    :param body: bytes or memoryview of the image
+    :return: uint8 tensor of [3, H, W]
+    """
+    if bytes(body[:len(JPEG_SOI)]) != JPEG_SOI:
+        image = open_image(body).convert("RGB")
+        return torch.from_numpy(np.asarray(image)).permute(2, 0, 1)
+
+    with timer(STAGE_DECODE):
+        data = torch.frombuffer(body, dtype=torch.uint8)
+        return torchvision_io.decode_jpeg(data, mode=torchvision_io.ImageReadMode.RGB)
+
+def get_decoder(event):
+    """
+    get_decoder() decoder of the frames
+
+    :param event: optional "decoder", "pil" or "torchvision", default to DECODER
+    :return: (name, function of a body)
+    """
+    name = event.get("decoder", DECODER)
+    if name not in DECODERS:
+        raise ValueError(f"invalid decoder: {name}")
+    return name, decode_tensor if name == "torchvision" else open_image
+
+def is_tensor(image):
+    return not hasattr(image, "getbands")
+
+def get_image_size(image):
+    """
+    get_image_size() size of a PIL image or an image tensor
+
+    :param image: Image object or tensor of [3, H, W]
+    :return: (width, height)
+    """
+    if is_tensor(image):
+        return image.shape[-1], image.shape[-2]
+    return image.size
+
+def get_fast_image_processor(processor):
+    """
+    get_fast_image_processor() fast image processor with the configuration of the
+    image processor of a processor, e.g. CLIPImageProcessorFast for CLIPImageProcessor
+
+    :param processor: processor of the model
+    :return: fast image processor
+    """
+    if processor not in _fast_image_processors:
+        image_processor = processor.image_processor
+        fast_cls = getattr(transformers, f"{type(image_processor).__name__}Fast", None)
+        if fast_cls is None:
+            raise ValueError(f"no fast image processor for {type(image_processor).__name__}")
+        config = {
+            k: v for k, v in image_processor.to_dict().items()
+            if k not in ("image_processor_type", "processor_class", "_processor_class")
+        }
+        fast_image_processor = fast_cls(**config)
+        fast_image_processor.center_crop = center_crop
+        _fast_image_processors[processor] = fast_image_processor
+    return _fast_image_processors[processor]
+
+def center_crop(image, size, **kwargs):
+    """
+    center_crop() center crop of the fast image processors with the offsets of the slow
+    ones, torchvision rounds an odd margin up and shifts the crop by one pixel
+
+    :param image: tensor of [..., H, W]
+    :param size: SizeDict of height and width
+    :return: tensor of [..., height, width]
+    """
+    height, width = image.shape[-2:]
+    top = (height - size["height"]) // 2
+    left = (width - size["width"]) // 2
+    if top < 0 or left < 0:
+        # padded like the slow image processors
+        return torchvision_functional.center_crop(image, [size["height"], size["width"]])
+    return image[..., top:top + size["height"], left:left + size["width"]]
+
+def preprocess(processor, images = None, **kwargs):
+    """
+    preprocess() processor(images=images, **kwargs). Image tensors are resized and
+    normalized in batches by the fast image processor, the text goes to the processor.
+
+    :param processor: processor of the model
+    :param images: (optional) image or list of images, PIL or tensors
+    :param kwargs: text and options of the processor
+    :return: BatchFeature or BatchEncoding
+    """
+    batch = images if isinstance(images, (list, tuple)) else [images]
+    if images is None or len(batch) == 0 or not is_tensor(batch[0]):
+        return processor(images=images, **kwargs)
+
+    pixel_values = get_fast_image_processor(processor)(images=batch, return_tensors="pt")["pixel_values"]
+    if kwargs.get("text") is None:
+        return transformers.BatchFeature(data={ "pixel_values": pixel_values })
+
+    inputs = processor(**kwargs)
+    inputs["pixel_values"] = pixel_values
+    return inputs
+
+def crop_image(image, box):
+    """
+    crop_image() crops like PIL Image.crop: the box is rounded to pixels and the area
+    outside of the image is black. A crop inside a tensor is a view, not a copy.
+
+    :param image: Image object or tensor of [3, H, W]
+    :param box: (left, top, right, bottom)
+    :return: Image object or tensor
+    """
+    if not is_tensor(image):
+        return image.crop(box)
+
+    left, top, right, bottom = (int(round(x)) for x in box)
+    height, width = image.shape[-2:]
+    if left >= 0 and top >= 0 and right <= width and bottom <= height:
+        return image[:, top:bottom, left:right]
+
+    cropped = image.new_zeros((image.shape[0], max(0, bottom - top), max(0, right - left)))
+    x0, y0 = max(left, 0), max(top, 0)
+    x1, y1 = min(right, width), min(bottom, height)
+    if x1 > x0 and y1 > y0:
+        cropped[:, y0 - top:y1 - top, x0 - left:x1 - left] = image[:, y0:y1, x0:x1]
+    return cropped
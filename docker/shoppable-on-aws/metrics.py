@@ -0,0 +1,264 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+import os
+import io
+import math
+import json
+import time
+import pstats
+import marshal
+import cProfile
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# CloudWatch namespace of the embedded metric format record
+METRICS_NAMESPACE = "Media2Cloud/Models"
+
+# well-known stages, any other stage name can also be timed
+STAGE_S3_GET = "s3_get"
+STAGE_DECODE = "decode"
+STAGE_PREPROCESS = "preprocess"
+STAGE_FORWARD = "forward"
+STAGE_POSTPROCESS = "postprocess"
+STAGE_SERIALIZE = "serialize"
+STAGE_UPLOAD = "upload"
+
+# profiling is off unless the event has "profile" or the PROFILE environment variable is set,
+# PROFILE=1 (or true) runs cProfile, PROFILE=torch also runs torch.profiler, PROFILE=0 (or false) is off
+PROFILE_FRAMES = 20
+PROFILE_PREFIX = "_profile"
+
+# { stage: [milliseconds, ...] } of the current invocation
+_stages = {}
+_stages_lock = threading.Lock()
+
+def reset_metrics():
+    """
+    reset_metrics() clears the timings at the start of an invocation
+    """
+    with _stages_lock:
+        _stages.clear()
+
+def record(stage, elapsed):
+    """
+    record() adds a timing of a stage, thread safe
+
+    :param stage: name of the stage
+    :param elapsed: elapsed time in milliseconds
+    """
+    with _stages_lock:
+        _stages.setdefault(stage, []).append(elapsed)
+
+@contextmanager
+def timer(stage):
+    """
+    timer() context manager that times the enclosed block as a stage
+
+    :param stage: name of the stage
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, (time.perf_counter() - t0) * 1000)
+
+def percentile(values, q):
+    """
+    percentile() nearest-rank percentile
+
+    :param values: sorted list of values
+    :param q: percentile between 0 and 100
+    :return: value
+    """
+    idx = max(0, math.ceil(q / 100 * len(values)) - 1)
+    return values[idx]
+
+def get_metrics():
+    """
+    get_metrics() aggregates the timings of the current invocation
+
+    :return: { stage: { count, sum, p50, p95, max } } in milliseconds
+    """
+    with _stages_lock:
+        stages = {stage: sorted(values) for stage, values in _stages.items()}
+
+    return {
+        stage: {
+            "count": len(values),
+            "sum": round(sum(values), 3),
+            "p50": round(percentile(values, 50), 3),
+            "p95": round(percentile(values, 95), 3),
+            "max": round(values[-1], 3),
+        } for stage, values in stages.items() if len(values) > 0
+    }
+
+def emit_metrics(dimensions = {}):
+    """
+    emit_metrics() prints the aggregated timings as one CloudWatch Embedded Metric Format
+    record. Lambda ships stdout to CloudWatch Logs which extracts the metrics.
+
+    :param dimensions: (optional) extra dimensions, FunctionName is always added
+    :return: the record
+    """
+    metrics = get_metrics()
+    dimensions = {
+        "FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local"),
+        **dimensions
+    }
+
+    definitions = []
+    values = {}
+    for stage, stats in metrics.items():
+        for name in ("p50", "p95", "max", "sum"):
+            definitions.append({
+                "Name": f"{stage}_{name}",
+                "Unit": "Milliseconds"
+            })
+            values[f"{stage}_{name}"] = stats[name]
+        definitions.append({
+            "Name": f"{stage}_count",
+            "Unit": "Count"
+        })
+        values[f"{stage}_count"] = stats["count"]
+
+    record = {
+        "_aws": {
+            "Timestamp": round(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": definitions
+            }]
+        },
+        **dimensions,
+        **values
+    }
+    print(json.dumps(record))
+    return record
+
+class InvocationProfiler:
+    """
+    InvocationProfiler runs cProfile, and optionally torch.profiler with operator level
+    CPU timings, from the start of the invocation until the first N frames are processed
+    """
+    def __init__(self, frames = PROFILE_FRAMES, use_torch = False):
+        self.frames = frames
+        self.use_torch = use_torch
+        self.steps = 0
+        self.profile = None
+        self.torch_profile = None
+        self.running = False
+
+    def start(self):
+        self.profile = cProfile.Profile()
+        if self.use_torch:
+            import torch
+            self.torch_profile = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU],
+                record_shapes=True)
+            self.torch_profile.__enter__()
+        self.profile.enable()
+        self.running = True
+
+    def step(self, count = 1):
+        """
+        step() counts processed frames, stops profiling after the first N frames
+
+        :param count: (optional) number of frames processed
+        """
+        self.steps += count
+        if self.running and self.steps >= self.frames:
+            self.stop()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.profile.disable()
+        if self.torch_profile is not None:
+            self.torch_profile.__exit__(None, None, None)
+        self.running = False
+
+    def get_files(self):
+        """
+        get_files() collects the profiling results
+
+        :return: { file name: bytes }, .prof is loadable by pstats/snakeviz,
+            .trace.json by chrome://tracing or Perfetto
+        """
+        self.stop()
+        files = {}
+
+        self.profile.create_stats()
+        files["cprofile.prof"] = marshal.dumps(self.profile.stats)
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(50)
+        files["cprofile.txt"] = summary.getvalue().encode("utf-8")
+
+        if self.torch_profile is not None:
+            with tempfile.TemporaryDirectory() as tmp:
+                trace = os.path.join(tmp, "trace.json")
+                self.torch_profile.export_chrome_trace(trace)
+                with open(trace, "rb") as f:
+                    files["torch.trace.json"] = f.read()
+            table = self.torch_profile.key_averages().table(sort_by="self_cpu_time_total", row_limit=50)
+            files["torch.txt"] = table.encode("utf-8")
+        return files
+
+def start_profiler(event):
+    """
+    start_profiler() starts profiling if requested by the event or the PROFILE environment variable
+
+    :param event: optional "profile": true, "torch" or { "frames", "torch", "prefix" }
+    :return: InvocationProfiler or None if profiling is off
+    """
+    # utils imports metrics
+    from utils import parse_bool
+
+    options = event.get("profile", os.environ.get("PROFILE"))
+    if not isinstance(options, dict):
+        use_torch = isinstance(options, str) and options.strip().lower() == "torch"
+        if not use_torch and not parse_bool(options):
+            return None
+        options = {
+            "torch": use_torch
+        }
+
+    frames = int(options.get("frames", os.environ.get("PROFILE_FRAMES", PROFILE_FRAMES)))
+    profiler = InvocationProfiler(frames, parse_bool(options.get("torch")))
+    profiler.start()
+    print(f"== [info]: profiling first {frames} frames, torch.profiler: {profiler.use_torch}")
+    return profiler
+
+def stop_profiler(profiler, event, bucket, prefix, request_id = None):
+    """
+    stop_profiler() stops profiling and uploads the results to
+    <prefix>/_profile/<request_id>/ or to event["profile"]["prefix"]
+
+    :param profiler: InvocationProfiler or None
+    :param event: event of the invocation
+    :param bucket: bucket of the outputs
+    :param prefix: prefix of the outputs
+    :param request_id: (optional) lambda request id, default to the current time
+    :return: list of uploaded keys
+    """
+    if profiler is None:
+        return []
+
+    # lazy import, utils imports this module
+    from utils import put_object
+
+    options = event.get("profile")
+    profile_prefix = os.path.join(prefix, PROFILE_PREFIX)
+    if isinstance(options, dict) and "prefix" in options:
+        profile_prefix = options["prefix"]
+    if request_id is None:
+        request_id = str(round(time.time() * 1000))
+
+    keys = []
+    for name, body in profiler.get_files().items():
+        key = os.path.join(profile_prefix, request_id, name)
+        mime = "application/json" if name.endswith(".json") else "text/plain" if name.endswith(".txt") else "application/octet-stream"
+        put_object(bucket, key, body, mime)
+        keys.append(key)
+    print(f"== [info]: uploaded profiles: {keys}")
+    return keys
@@ -0,0 +1,279 @@
+# pyright: reportMissingImports=false, reportMissingModuleSource=false
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# fraction of the memory limit kept free, the peak RSS must stay below the rest
+MEMORY_HEADROOM = 0.2
+
+# upper bound of the batch size tried by the calibration
+MAX_BATCH_SIZE = 8
+# a larger batch size is kept only if the frames/sec improves by at least 5%
+MIN_THROUGHPUT_GAIN = 0.05
+# the first batch warms up the models and is not used for the calibration
+CALIBRATION_WARMUP = 1
+
+# bounds of the prefetch depth (number of parallel GETs, 2 x depth bodies are buffered)
+MIN_PREFETCH = 2
+MAX_PREFETCH = 32
+# share of the free memory the prefetch buffer may use
+PREFETCH_MEMORY_SHARE = 0.25
+# size estimate of a prefetched body before any frame is seen, a decoded 1080p frame
+FRAME_BYTES = 1920 * 1080 * 3
+
+# interval of the RSS sampling while a batch runs
+RSS_SAMPLE_INTERVAL = 0.005
+
+def read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+def get_memory_limit(context = None):
+    """
+    get_memory_limit() memory limit of the function, the smallest of the lambda
+    configuration, the cgroup limit and the physical memory
+
+    :param context: (optional) lambda context
+    :return: (bytes, source) or (None, None) if unknown
+    """
+    limits = []
+
+    memory_mb = getattr(context, "memory_limit_in_mb", None) or os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if memory_mb:
+        limits.append((int(memory_mb) * 1024 * 1024, "lambda"))
+
+    # cgroup v2, then v1. An unlimited v1 cgroup reports a huge number.
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        value = read_first_line(path)
+        if value is not None and value.isdigit() and int(value) < (1 << 60):
+            limits.append((int(value), "cgroup"))
+            break
+
+    try:
+        limits.append((os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE"), "physical"))
+    except (ValueError, OSError, AttributeError):
+        pass
+
+    if len(limits) == 0:
+        return None, None
+    return min(limits)
+
+def get_rss():
+    """
+    get_rss() resident set size of the process
+
+    :return: bytes or None if unknown
+    """
+    statm = read_first_line("/proc/self/statm")
+    if statm is None:
+        return None
+    return int(statm.split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+class RssSampler:
+    """
+    RssSampler samples the RSS in a thread to catch the peak of a block, the
+    activations of a forward pass are freed before the block returns
+    """
+    def __init__(self, interval = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start_rss = get_rss()
+        self.peak_rss = self.start_rss
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = get_rss()
+            if rss is not None and rss > self.peak_rss:
+                self.peak_rss = rss
+
+    def start(self):
+        if self.start_rss is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.peak_rss = max(self.peak_rss, get_rss())
+        return self.peak_rss
+
+class BatchSizer:
+    """
+    BatchSizer chooses the batch size and the prefetch depth from the memory limit of
+    the function. The batch size is calibrated on the first batches of the invocation:
+    it doubles while the frames/sec improves and the projected peak RSS of the next
+    size fits the memory budget, then it stays fixed. Real frames are processed during
+    the calibration, no work is thrown away.
+    """
+    def __init__(
+            self,
+            memory_limit,
+            headroom = MEMORY_HEADROOM,
+            max_batch_size = MAX_BATCH_SIZE,
+            batch_size = None,
+            concurrency = None):
+        """
+        :param memory_limit: memory limit in bytes or None if unknown
+        :param headroom: (optional) fraction of the memory limit kept free
+        :param max_batch_size: (optional) upper bound of the batch size
+        :param batch_size: (optional) fixed batch size, disables the calibration
+        :param concurrency: (optional) fixed prefetch depth
+        """
+        self.memory_limit = memory_limit
+        self.headroom = headroom
+        self.budget = None if memory_limit is None else memory_limit * (1 - headroom)
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_size = 1 if batch_size is None else max(1, batch_size)
+        self.calibrating = batch_size is None and self.max_batch_size > 1
+        self.warmup = CALIBRATION_WARMUP
+        self.concurrency = concurrency
+        self.samples = {}
+        self.frames = 0
+        self.elapsed = 0
+        self.peak_rss = None
+
+    def choose_concurrency(self, default, frame_bytes = FRAME_BYTES):
+        """
+        choose_concurrency() prefetch depth that fits a share of the free memory
+
+        :param default: depth if the memory limit or the RSS is unknown
+        :param frame_bytes: (optional) size estimate of a prefetched body
+        :return: prefetch depth
+        """
+        if self.concurrency is not None:
+            return self.concurrency
+
+        rss = get_rss()
+        if self.budget is None or rss is None:
+            self.concurrency = default
+            return self.concurrency
+
+        free = max(0, self.budget - rss)
+        depth = int(free * PREFETCH_MEMORY_SHARE / (2 * frame_bytes))
+        self.concurrency = min(MAX_PREFETCH, max(MIN_PREFETCH, depth))
+        return self.concurrency
+
+    @contextmanager
+    def measure(self, frames):
+        """
+        measure() context manager that times a batch and samples its peak RSS
+
+        :param frames: number of frames in the batch
+        """
+        sampler = RssSampler().start()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.update(frames, elapsed, sampler.start_rss, sampler.stop())
+
+    def update(self, frames, elapsed, start_rss, peak_rss):
+        """
+        update() records a batch and moves the calibration forward
+
+        :param frames: number of frames in the batch
+        :param elapsed: elapsed time in seconds
+        :param start_rss: RSS before the batch, None if unknown
+        :param peak_rss: peak RSS of the batch, None if unknown
+        """
+        self.frames += frames
+        self.elapsed += elapsed
+        if peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, peak_rss)
+
+        # back off if a batch ever goes over the budget, calibrated or not
+        if self.budget is not None and peak_rss is not None and peak_rss > self.budget and self.batch_size > 1:
+            self.batch_size = max(1, self.batch_size // 2)
+            self.calibrating = False
+            print(f"== [warn]: sizing: peak RSS {peak_rss >> 20}MB over budget {int(self.budget) >> 20}MB, batch_size: {self.batch_size}")
+            return
+
+        # a short last batch says nothing about the batch size
+        if not self.calibrating or frames < self.batch_size:
+            return
+        if self.warmup > 0:
+            self.warmup -= 1
+            return
+
+        fps = frames / max(elapsed, 1e-6)
+        self.samples[self.batch_size] = round(fps, 3)
+
+        previous = self.samples.get(self.batch_size // 2)
+        if previous is not None and fps < previous * (1 + MIN_THROUGHPUT_GAIN):
+            self.settle(self.batch_size // 2, "no throughput gain")
+            return
+
+        next_size = self.batch_size * 2
+        if next_size > self.max_batch_size:
+            self.settle(self.batch_size, "max batch size")
+            return
+
+        if self.budget is not None and start_rss is not None and peak_rss is not None:
+            per_frame = max(0, peak_rss - start_rss) / frames
+            projected = start_rss + per_frame * next_size
+            if projected > self.budget:
+                self.settle(self.batch_size, f"projected peak RSS {int(projected) >> 20}MB")
+                return
+
+        self.batch_size = next_size
+
+    def settle(self, batch_size, reason):
+        self.batch_size = batch_size
+        self.calibrating = False
+        print(f"== [info]: sizing: calibrated batch_size: {batch_size} ({reason}), frames/sec: {self.samples}")
+
+    def get_settings(self):
+        """
+        get_settings() chosen settings, passed to the re-entries through the event
+
+        :return: { batch_size, concurrency, memory_limit, headroom, peak_rss, fps }
+        """
+        return {
+            "batch_size": self.batch_size,
+            "concurrency": self.concurrency,
+            "memory_limit": self.memory_limit,
+            "headroom": self.headroom,
+            "peak_rss": self.peak_rss,
+            "fps": round(self.frames / self.elapsed, 3) if self.elapsed > 0 else None,
+        }
+
+def start_sizer(event, context, default_concurrency, max_batch_size = MAX_BATCH_SIZE, batch_field = None):
+    """
+    start_sizer() creates the BatchSizer of an invocation. Explicit settings of the event
+    win, a re-entry reuses the settings calibrated by the previous entry.
+
+    :param event: optional "memory_headroom", "concurrency", <batch_field> and "sizing"
+        (settings of the previous entry)
+    :param context: lambda context
+    :param default_concurrency: prefetch depth if the memory limit is unknown
+    :param max_batch_size: (optional) upper bound of the batch size, 1 disables batching
+    :param batch_field: (optional) event field of a fixed batch size
+    :return: BatchSizer
+    """
+    memory_limit, source = get_memory_limit(context)
+    headroom = float(event.get("memory_headroom", os.environ.get("MEMORY_HEADROOM", MEMORY_HEADROOM)))
+
+    batch_size = None
+    if batch_field is not None and batch_field in event:
+        batch_size = int(event[batch_field])
+    concurrency = int(event["concurrency"]) if "concurrency" in event else None
+
+    previous = event.get("sizing")
+    if isinstance(previous, dict) and previous.get("memory_limit") == memory_limit and previous.get("headroom") == headroom:
+        if batch_size is None:
+            batch_size = min(max_batch_size, int(previous["batch_size"]))
+
+    sizer = BatchSizer(memory_limit, headroom, max_batch_size, batch_size, concurrency)
+    sizer.choose_concurrency(default_concurrency)
+
+    memory = "unknown" if memory_limit is None else f"{memory_limit >> 20}MB ({source})"
+    print(f"== [info]: sizing: memory limit: {memory}, headroom: {headroom}, rss: {(get_rss() or 0) >> 20}MB, batch_size: {sizer.batch_size}{' (calibrating)' if sizer.calibrating else ''}, concurrency: {sizer.concurrency}")
+    return sizer
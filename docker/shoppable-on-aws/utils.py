@@ -1,80 +1,1128 @@
 # pyright: reportMissingImports=false, reportMissingModuleSource=false
-import boto3
+import os
+import io
 import json
+import mmap
 import base64
+import gzip
+import zlib
+import shutil
+import hashlib
+import threading
+import importlib
 from io import BytesIO
-from PIL import Image
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
+from metrics import timer, STAGE_S3_GET, STAGE_DECODE, STAGE_SERIALIZE, STAGE_UPLOAD
 
-session = boto3.Session()
-s3 = session.client("s3")
+class LazyModule:
+    """
+    LazyModule imports a module on the first attribute access, so heavy modules
+    (torch, transformers, boto3, ...) are only loaded by the code paths that use them
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
 
-def get_object(bucket, key):
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
+tarfile = LazyModule("tarfile")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# number of parallel GETs of get_objects
+S3_CONCURRENCY = 16
+
+# part size of the multipart upload of S3StreamWriter, minimum is 5MB
+S3_PART_SIZE = 8 * 1024 * 1024
+
+# suffix of the progress manifest written next to the output, <output name>.progress.json
+PROGRESS_SUFFIX = ".progress.json"
+
+# decimal places of the embeddings in the json output, None keeps the float32 precision
+EMBEDDING_PRECISION = None
+_embedding_precision = EMBEDDING_PRECISION
+
+# Content-Encoding of the objects written by put_object, None (default), "gzip" or "zstd".
+# Off by default as downstream states read the json outputs directly from S3.
+CONTENT_ENCODING = None
+COMPRESSION_LEVELS = {
+    "gzip": 6,
+    "zstd": 3
+}
+_content_encoding = (CONTENT_ENCODING, None)
+
+# local disk cache of S3 objects, kept across warm invocations and validated by ETag.
+# Off unless S3_CACHE_DIR is set, e.g. /tmp/s3_cache, the frames are read once and
+# only the models, label files and re-entry outputs gain from it
+S3_CACHE_DIR = os.environ.get("S3_CACHE_DIR")
+# upper bound of the cache size, also capped to half of the /tmp ephemeral storage
+S3_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# a cached object is one file of the ETag, a newline and the body, the pair is
+# replaced by one rename
+S3_CACHE_SUFFIX = ".object"
+
+# { cache file name: size } in least recently used order
+_s3_cache_index = None
+# sum of the sizes of _s3_cache_index
+_s3_cache_size = 0
+# { cache dir: capacity }, computed once per process
+_s3_cache_capacity = {}
+_s3_cache_lock = threading.Lock()
+_s3_cache_stats = { "hits": 0, "misses": 0 }
+
+# S3 client, created on first use by get_s3()
+s3 = None
+_s3_lock = threading.Lock()
+
+# string values of the boolean flags of the events and the environment, see parse_bool()
+TRUE_FLAGS = ["true", "1", "yes", "on"]
+FALSE_FLAGS = ["false", "0", "no", "off", ""]
+
+# storage of the bucket names without a scheme, e.g. file:///mnt/efs stores
+# <bucket>/<key> under /mnt/efs, memory:// keeps them in memory. Default is S3.
+STORAGE_URI = os.environ.get("STORAGE_URI")
+STORAGE_SCHEMES = ["s3", "file", "memory"]
+
+# { base uri: storage backend }
+_storages = {}
+_storages_lock = threading.Lock()
+
+# shared store of the inference results keyed by the image content, the checkpoint and
+# the labels. Off unless the event has "result_cache" or RESULT_CACHE_URI is set,
+# e.g. s3://bucket/_result_cache or file:///mnt/efs/result_cache
+RESULT_CACHE_URI = os.environ.get("RESULT_CACHE_URI")
+# bump when the results of the same model and labels change, invalidates the store
+RESULT_CACHE_VERSION = 1
+# number of threads writing the results to the store
+RESULT_CACHE_WRITERS = 4
+
+# frames bundled in an uncompressed tar with an offset table, <pack>.index.json of
+# { member name: [offset, size] }. Members are named like the frames they replace,
+# relative to the directory of the pack.
+FRAME_PACK_INDEX_SUFFIX = ".index.json"
+# one ranged GET reads up to this many bytes and frames of consecutive members
+FRAME_PACK_RANGE_SIZE = 8 * 1024 * 1024
+FRAME_PACK_RANGE_FRAMES = 8
+# unused bytes between two members read by the same GET rather than starting another
+FRAME_PACK_MAX_GAP = 256 * 1024
+# "range" reads the members with ranged GETs, "mmap" downloads the pack once into
+# FRAME_PACK_DIR and maps it, kept across warm invocations. Local files are always mapped.
+FRAME_PACK_MODES = ["range", "mmap"]
+FRAME_PACK_DIR = "/tmp/frame_packs"
+
+def get_s3():
+    """
+    get_s3() creates the S3 client on first use, importing boto3 takes a few hundred
+    milliseconds that the special cases of the lambda handlers do not need to pay
+
+    :return: S3 client
+    """
+    global s3
+
+    if s3 is None:
+        with _s3_lock:
+            if s3 is None:
+                import boto3
+                from botocore.config import Config
+                session = boto3.Session()
+                s3 = session.client("s3", config=Config(
+                    max_pool_connections=S3_CONCURRENCY * 2,
+                    retries={"max_attempts": 10, "mode": "adaptive"},
+                    tcp_keepalive=True
+                ))
+    return s3
+
+def parse_bool(value, default = False):
+    """
+    parse_bool() boolean flag of an event field or an environment variable,
+    "true", "1", "yes", "on" are True and "false", "0", "no", "off", "" are False
+
+    :param value: bool, number, string or None
+    :param default: (optional) value of a missing flag
+    :return: bool
+    """
+    if value is None:
+        return default
+    if isinstance(value, str):
+        flag = value.strip().lower()
+        if flag in TRUE_FLAGS:
+            return True
+        if flag in FALSE_FLAGS:
+            return False
+        raise ValueError(f"invalid boolean flag: {value}")
+    return bool(value)
+
+def set_embedding_precision(precision = EMBEDDING_PRECISION):
+    """
+    set_embedding_precision() sets the decimal places of the embeddings returned by to_embeddings
+
+    :param precision: (optional) decimal places, None keeps the float32 precision
+    """
+    global _embedding_precision
+    _embedding_precision = None if precision is None else int(precision)
+
+def to_embeddings(embeddings):
+    """
+    to_embeddings() converts embeddings to a float32 array that dumps() writes directly,
+    instead of a list of python floats
+
+    :param embeddings: tensor or array of [N, dim] or [dim]
+    :return: float32 ndarray, rounded to the embedding precision
+    """
+    if hasattr(embeddings, "detach"):
+        embeddings = embeddings.detach().cpu().numpy()
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if _embedding_precision is not None:
+        embeddings = np.round(embeddings, _embedding_precision)
+    return embeddings
+
+def json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+def dumps(obj):
+    """
+    dumps() serializes obj to compact json, float32 arrays are written natively by orjson.
+    Falls back to json if orjson is not installed.
+
+    :param obj: json serializable object, may contain numpy arrays and scalars
+    :return: bytes
+    """
+    with timer(STAGE_SERIALIZE):
+        if orjson is not None:
+            return orjson.dumps(
+                obj,
+                default=json_default,
+                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        return json.dumps(obj, default=json_default, separators=(",", ":")).encode("utf-8")
+
+def loads(body):
+    """
+    loads() deserializes json
+
+    :param body: str or bytes
+    :return: object
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+def set_content_encoding(encoding = CONTENT_ENCODING, level = None):
+    """
+    set_content_encoding() sets the Content-Encoding of the objects written by put_object
+    and S3StreamWriter
+
+    :param encoding: (optional) None, "gzip" or "zstd"
+    :param level: (optional) compression level, default to COMPRESSION_LEVELS
+    """
+    global _content_encoding
+
+    if encoding is not None:
+        if encoding not in COMPRESSION_LEVELS:
+            raise ValueError(f"unsupported content encoding: {encoding}")
+        if encoding == "zstd" and zstandard is None:
+            raise ValueError("zstandard is not installed")
+        if level is None:
+            level = COMPRESSION_LEVELS[encoding]
+        level = int(level)
+    _content_encoding = (encoding, level)
+
+def get_compressor(encoding, level):
+    """
+    get_compressor() incremental compressor of the content encoding
+
+    :param encoding: "gzip" or "zstd"
+    :param level: compression level
+    :return: compressor with compress(data) and flush() methods
+    """
+    if encoding == "gzip":
+        # wbits 31 writes the gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError(f"unsupported content encoding: {encoding}")
+
+def encode_body(body, encoding, level):
+    """
+    encode_body() compresses a payload
+
+    :param body: bytes
+    :param encoding: "gzip" or "zstd"
+    :param level: compression level
+    :return: compressed bytes
+    """
+    compressor = get_compressor(encoding, level)
+    return compressor.compress(body) + compressor.flush()
+
+def decode_body(body, encoding):
+    """
+    decode_body() decompresses a payload by its Content-Encoding
+
+    :param body: bytes
+    :param encoding: Content-Encoding of the object, None for identity
+    :return: bytes
+    """
+    if not encoding or encoding == "identity":
+        return body
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("zstandard is not installed")
+        # streaming frames do not have the content size, use a decompressobj
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return body
+
+def get_cache_capacity():
+    """
+    get_cache_capacity() size limit of the local S3 cache
+
+    :return: number of bytes
+    """
+    if S3_CACHE_DIR not in _s3_cache_capacity:
+        os.makedirs(S3_CACHE_DIR, exist_ok=True)
+        total = shutil.disk_usage(S3_CACHE_DIR).total
+        _s3_cache_capacity[S3_CACHE_DIR] = min(S3_CACHE_MAX_BYTES, total // 2)
+    return _s3_cache_capacity[S3_CACHE_DIR]
+
+def get_cache_index():
+    """
+    get_cache_index() lazily builds the LRU index of the local S3 cache from the
+    files left by previous (warm) invocations. Must be called with _s3_cache_lock held.
+
+    :return: OrderedDict of { cache file name: size }
+    """
+    global _s3_cache_index, _s3_cache_size
+
+    if _s3_cache_index is None:
+        _s3_cache_index = OrderedDict()
+        os.makedirs(S3_CACHE_DIR, exist_ok=True)
+        entries = []
+        for entry in os.scandir(S3_CACHE_DIR):
+            if entry.name.endswith(S3_CACHE_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(S3_CACHE_SUFFIX)], stat.st_size))
+        for _, name, size in sorted(entries):
+            _s3_cache_index[name] = size
+        _s3_cache_size = sum(_s3_cache_index.values())
+    return _s3_cache_index
+
+def get_cache_name(bucket, key):
+    return hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+
+def read_cache(bucket, key):
+    """
+    read_cache() reads an object from the local S3 cache
+
+    :param bucket: S3 bucket name
+    :param key: S3 object key
+    :return: (etag, body) or (None, None) if not cached
+    """
+    name = get_cache_name(bucket, key)
+    path = os.path.join(S3_CACHE_DIR, f"{name}{S3_CACHE_SUFFIX}")
+    try:
+        with open(path, "rb") as f:
+            etag = f.readline()[:-1].decode("utf-8")
+            body = f.read()
+    except (OSError, UnicodeDecodeError):
+        return None, None
+
+    with _s3_cache_lock:
+        index = get_cache_index()
+        if name in index:
+            index.move_to_end(name)
+    return etag, body
+
+def write_cache(bucket, key, etag, body):
     """
-    get_object() get_object from S3 and loads it into Image.
+    write_cache() writes an object to the local S3 cache and evicts the least
+    recently used objects to stay within get_cache_capacity()
 
     :param bucket: S3 bucket name
     :param key: S3 object key
+    :param etag: ETag of the object
+    :param body: bytes of the object
+    """
+    global _s3_cache_size
+
+    if etag is None or not isinstance(body, bytes):
+        return
+
+    capacity = get_cache_capacity()
+    if len(body) > capacity // 4:
+        return
+
+    name = get_cache_name(bucket, key)
+    path = os.path.join(S3_CACHE_DIR, f"{name}{S3_CACHE_SUFFIX}")
+    header = f"{etag}\n".encode("utf-8")
+    # write to a temp file of this process and thread and rename, concurrent readers
+    # and processes sharing the cache never see a partial object or a mixed pair
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(header)
+            f.write(body)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"== [warn]: write_cache: {key}: {type(e).__name__}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return
+
+    with _s3_cache_lock:
+        index = get_cache_index()
+        _s3_cache_size -= index.get(name, 0)
+        index[name] = len(header) + len(body)
+        _s3_cache_size += index[name]
+        index.move_to_end(name)
+        while _s3_cache_size > capacity and len(index) > 1:
+            evicted, size = index.popitem(last=False)
+            _s3_cache_size -= size
+            try:
+                os.remove(os.path.join(S3_CACHE_DIR, f"{evicted}{S3_CACHE_SUFFIX}"))
+            except OSError:
+                pass
+
+def get_cache_stats(previous = {}):
+    """
+    get_cache_stats() hit and miss counters of the local S3 cache
+
+    :param previous: (optional) counters of the previous runs to accumulate
+    :return: { hits, misses }
+    """
+    with _s3_cache_lock:
+        return {
+            name: previous.get(name, 0) + count
+            for name, count in _s3_cache_stats.items()
+        }
+
+def reset_cache_stats():
+    """
+    reset_cache_stats() resets the counters at the start of an invocation
+    """
+    with _s3_cache_lock:
+        for name in _s3_cache_stats:
+            _s3_cache_stats[name] = 0
+
+def count_cache(name):
+    with _s3_cache_lock:
+        _s3_cache_stats[name] += 1
+
+def get_storage(bucket):
+    """
+    get_storage() resolves the storage backend of a bucket. The bucket is either
+    a bucket name, stored in STORAGE_URI (S3 by default), or an uri:
+    s3://<bucket>, file://<directory> or memory://<name>
+
+    :param bucket: bucket name or uri
+    :return: (storage backend, bucket name within the backend)
+    """
+    if bucket is None:
+        raise ValueError('missing bucket')
+
+    if "://" in bucket:
+        base, name = bucket, ""
+    elif STORAGE_URI is not None:
+        base, name = STORAGE_URI, bucket
+    else:
+        base, name = "s3://", bucket
+
+    url = urlparse(base)
+    if url.scheme not in STORAGE_SCHEMES:
+        raise ValueError(f"unsupported storage: {base}")
+    if url.scheme == "s3":
+        return _get_storage("s3://", S3Storage), name or url.netloc
+    if url.scheme == "file":
+        root = os.path.join("/", url.netloc, url.path.lstrip("/"))
+        return _get_storage(f"file://{root}", LocalStorage, root), name
+    return _get_storage(f"memory://{url.netloc}{url.path}", MemoryStorage), name
+
+def _get_storage(base, cls, *args):
+    with _storages_lock:
+        if base not in _storages:
+            _storages[base] = cls(*args)
+        return _storages[base]
+
+def get_object(bucket, key):
+    """
+    get_object() get object from the storage of the bucket, see get_storage()
+
+    :param bucket: bucket name or uri
+    :param key: object key
     :return: Body
     """
     if bucket is None or key is None:
         raise ValueError('missing bucket or key')
 
-    return s3.get_object(
-        Bucket = bucket,
-        Key = key
-    )["Body"].read()
+    storage, name = get_storage(bucket)
+    return storage.get_object(name, key)
+
+def get_s3_object(bucket, key):
+    """
+    get_s3_object() get_object from S3.
+    Objects are cached in S3_CACHE_DIR, a cached copy is revalidated with a
+    conditional GET (If-None-Match) and only downloaded again if the ETag changed.
+    Objects with gzip or zstd Content-Encoding are decompressed.
+
+    :param bucket: S3 bucket name
+    :param key: S3 object key
+    :return: Body
+    """
+    if S3_CACHE_DIR is None:
+        with timer(STAGE_S3_GET):
+            response = get_s3().get_object(
+                Bucket = bucket,
+                Key = key
+            )
+            body = response["Body"].read()
+        return decode_body(body, response.get("ContentEncoding"))
+
+    etag, body = read_cache(bucket, key)
+
+    params = {
+        "Bucket": bucket,
+        "Key": key,
+    }
+    if etag is not None:
+        params["IfNoneMatch"] = etag
+
+    from botocore.exceptions import ClientError
+
+    try:
+        with timer(STAGE_S3_GET):
+            response = get_s3().get_object(**params)
+            payload = response["Body"].read()
+    except ClientError as e:
+        if etag is not None and e.response["Error"]["Code"] in ("304", "NotModified"):
+            count_cache("hits")
+            return body
+        raise e
+
+    count_cache("misses")
+    # the cache keeps the decompressed body
+    body = decode_body(payload, response.get("ContentEncoding"))
+    write_cache(bucket, key, response.get("ETag"), body)
+    return body
+
+def get_s3_range(bucket, key, start, size):
+    """
+    get_s3_range() ranged GET of an object from S3, not cached
+
+    :param bucket: S3 bucket name
+    :param key: S3 object key
+    :param start: first byte
+    :param size: number of bytes
+    :return: Body
+    """
+    with timer(STAGE_S3_GET):
+        response = get_s3().get_object(
+            Bucket = bucket,
+            Key = key,
+            Range = f"bytes={start}-{start + size - 1}"
+        )
+        body = response["Body"].read()
+    if response.get("ContentEncoding") in ("gzip", "zstd"):
+        raise ValueError(f"ranged read of a compressed object: {key}")
+    return body
+
+def map_s3_object(bucket, key):
+    """
+    map_s3_object() downloads an object into FRAME_PACK_DIR and maps it read only.
+    The local copy is named after the ETag and reused by the warm invocations.
+
+    :param bucket: S3 bucket name
+    :param key: S3 object key
+    :return: mmap
+    """
+    etag = get_s3().head_object(Bucket = bucket, Key = key)["ETag"].strip('"')
+    name = hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+    path = os.path.join(FRAME_PACK_DIR, f"{name}-{etag}")
+
+    if not os.path.exists(path):
+        os.makedirs(FRAME_PACK_DIR, exist_ok=True)
+        # older versions of the same pack
+        for file in os.listdir(FRAME_PACK_DIR):
+            if file.startswith(name):
+                os.remove(os.path.join(FRAME_PACK_DIR, file))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with timer(STAGE_S3_GET):
+            get_s3().download_file(bucket, key, tmp)
+        os.replace(tmp, path)
+
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def map_objects(fetch, keys, concurrency = S3_CONCURRENCY):
+    """
+    map_objects() runs fetch(key) over the keys in parallel with a thread pool.
+    At most 2 x concurrency results are in flight or buffered at any time.
+
+    :param fetch: function of a key
+    :param keys: list of S3 object keys
+    :param concurrency: (optional) number of parallel calls
+    :return: generator of results, in the order of keys
+    """
+    keys = iter(keys)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = deque()
+        for key in keys:
+            futures.append(executor.submit(fetch, key))
+            if len(futures) >= concurrency * 2:
+                break
+
+        while len(futures) > 0:
+            result = futures.popleft().result()
+            key = next(keys, None)
+            if key is not None:
+                futures.append(executor.submit(fetch, key))
+            yield result
+    finally:
+        # a closed generator does not wait for the fetches in flight
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def get_objects(bucket, keys, concurrency = S3_CONCURRENCY):
+    """
+    get_objects() get objects from S3 in parallel with a thread pool.
+    At most 2 x concurrency objects are in flight or buffered at any time.
+
+    :param bucket: S3 bucket name
+    :param keys: list of S3 object keys
+    :param concurrency: (optional) number of parallel GETs
+    :return: generator of Body, in the order of keys
+    """
+    yield from map_objects(lambda key: get_object(bucket, key), keys, concurrency)
+
+def split_uri(uri):
+    """
+    split_uri() splits an object uri into bucket and key
+
+    :param uri: s3://bucket/key, file:///path/to/file or memory://name/key
+    :return: (bucket, key)
+    """
+    url = urlparse(uri)
+    if url.scheme == "s3":
+        return url.netloc, url.path[1:]
+    return f"{url.scheme}://{url.netloc}", url.path[1:]
+
+def get_uri(bucket, key):
+    """
+    get_uri() uri of an object, the inverse of split_uri()
+
+    :param bucket: bucket name or uri
+    :param key: object key
+    :return: s3://bucket/key or the uri in the storage of the bucket
+    """
+    if "://" in bucket:
+        return os.path.join(bucket, key)
+    if STORAGE_URI is not None:
+        return os.path.join(STORAGE_URI, bucket, key)
+    return f"s3://{bucket}/{key}"
 
 def get_object_uri(s3uri):
     """
-    get_object_uri() get object from S3
+    get_object_uri() get object from S3, or from a file:// or memory:// uri
 
     :param s3uri: in a format of s3://bucket/key
     :return: Body
     """
-    url = urlparse(s3uri)
-    bucket = url.netloc
-    key = url.path[1:]
+    bucket, key = split_uri(s3uri)
     return get_object(bucket, key)
 
 def put_object(bucket, key, body, mime = "application/json"):
     """
-    put_object() wrapper function of s3.put_object
+    put_object() put object to the storage of the bucket, see get_storage()
+
+    :param bucket: bucket name or uri
+    :param key: object key
+    :param body: payload
+    :param mime: default to application/json
+    """
+    if bucket is None or key is None:
+        raise ValueError('missing bucket or key')
+
+    storage, name = get_storage(bucket)
+    return storage.put_object(name, key, body, mime)
+
+def put_s3_object(bucket, key, body, mime = "application/json"):
+    """
+    put_s3_object() wrapper function of s3.put_object
 
     :param bucket: S3 bucket name
     :param key: S3 object key
     :param body: payload
     :param mime: default to application/json
     """
-    return s3.put_object(
-        Bucket = bucket,
-        Key = key,
-        Body = body,
-        ContentType = mime
-    )
+    params = {}
+    payload = body
+
+    encoding, level = _content_encoding
+    if encoding is not None:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        payload = encode_body(body, encoding, level)
+        params["ContentEncoding"] = encoding
+
+    with timer(STAGE_UPLOAD):
+        response = get_s3().put_object(
+            Bucket = bucket,
+            Key = key,
+            Body = payload,
+            ContentType = mime,
+            **params
+        )
+
+    # write through so the re-entry of the lambda reads its own output from the cache
+    if S3_CACHE_DIR is not None:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        write_cache(bucket, key, response.get("ETag"), body)
+    return response
+
+class S3StreamWriter:
+    """
+    S3StreamWriter buffers writes into parts of S3_PART_SIZE and uploads them as
+    a multipart upload, peak memory is bounded to about one part. Payload smaller
+    than a part is uploaded with put_object on close. Writes are compressed
+    incrementally when a content encoding is set.
+    """
+    def __init__(self, bucket, key, mime = "application/json", part_size = S3_PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.mime = mime
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.buffer = BytesIO()
+        self.upload_id = None
+        self.parts = []
+        self.encoding, level = _content_encoding
+        self.compressor = None
+        if self.encoding is not None:
+            self.compressor = get_compressor(self.encoding, level)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, data):
+        """
+        write() appends data, uploads a part once the buffer reaches the part size
+
+        :param data: str or bytes
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            self.upload_part()
+
+    def upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = get_s3().create_multipart_upload(
+                Bucket = self.bucket,
+                Key = self.key,
+                ContentType = self.mime,
+                **self.get_encoding_params()
+            )["UploadId"]
+
+        part_number = len(self.parts) + 1
+        with timer(STAGE_UPLOAD):
+            response = get_s3().upload_part(
+                Bucket = self.bucket,
+                Key = self.key,
+                UploadId = self.upload_id,
+                PartNumber = part_number,
+                Body = self.buffer.getvalue()
+            )
+        self.parts.append({
+            "ETag": response["ETag"],
+            "PartNumber": part_number
+        })
+        self.buffer = BytesIO()
+
+    def get_encoding_params(self):
+        if self.encoding is None:
+            return {}
+        return {
+            "ContentEncoding": self.encoding
+        }
+
+    def close(self):
+        """
+        close() uploads the remaining buffer and completes the upload
+        """
+        if self.compressor is not None:
+            self.buffer.write(self.compressor.flush())
+            self.compressor = None
+
+        if self.upload_id is None:
+            if self.encoding is None:
+                put_s3_object(self.bucket, self.key, self.buffer.getvalue(), self.mime)
+            else:
+                # already compressed, bypass put_object
+                with timer(STAGE_UPLOAD):
+                    get_s3().put_object(
+                        Bucket = self.bucket,
+                        Key = self.key,
+                        Body = self.buffer.getvalue(),
+                        ContentType = self.mime,
+                        **self.get_encoding_params()
+                    )
+            self.buffer = BytesIO()
+            return
+
+        if self.buffer.tell() > 0:
+            self.upload_part()
+        with timer(STAGE_UPLOAD):
+            get_s3().complete_multipart_upload(
+                Bucket = self.bucket,
+                Key = self.key,
+                UploadId = self.upload_id,
+                MultipartUpload = {
+                    "Parts": self.parts
+                }
+            )
+        self.upload_id = None
+
+    def abort(self):
+        """
+        abort() discards the uploaded parts
+        """
+        if self.upload_id is not None:
+            get_s3().abort_multipart_upload(
+                Bucket = self.bucket,
+                Key = self.key,
+                UploadId = self.upload_id
+            )
+            self.upload_id = None
+        self.buffer = BytesIO()
+
+class S3Storage:
+    """
+    S3Storage objects in S3 buckets, cached in S3_CACHE_DIR and compressed
+    with the Content-Encoding set by set_content_encoding()
+    """
+    def get_object(self, bucket, key):
+        return get_s3_object(bucket, key)
+
+    def get_range(self, bucket, key, start, size):
+        return get_s3_range(bucket, key, start, size)
+
+    def map_object(self, bucket, key):
+        return map_s3_object(bucket, key)
+
+    def put_object(self, bucket, key, body, mime = "application/json"):
+        return put_s3_object(bucket, key, body, mime)
+
+    def open_writer(self, bucket, key, mime = "application/json", part_size = S3_PART_SIZE):
+        return S3StreamWriter(bucket, key, mime, part_size)
+
+class LocalStorage:
+    """
+    LocalStorage objects as files under a root directory, e.g. an EFS mount or the
+    local NVMe. Files are read at disk speed, neither cached nor compressed.
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def get_path(self, bucket, key):
+        path = os.path.normpath(os.path.join(self.root, bucket, key.lstrip("/")))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"key outside of {self.root}: {key}")
+        return path
+
+    def get_object(self, bucket, key):
+        with timer(STAGE_S3_GET):
+            with open(self.get_path(bucket, key), "rb") as f:
+                return f.read()
+
+    def get_range(self, bucket, key, start, size):
+        with timer(STAGE_S3_GET):
+            with open(self.get_path(bucket, key), "rb") as f:
+                f.seek(start)
+                return f.read(size)
+
+    def map_object(self, bucket, key):
+        with open(self.get_path(bucket, key), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def put_object(self, bucket, key, body, mime = "application/json"):
+        with self.open_writer(bucket, key, mime) as writer:
+            writer.write(body)
+
+    def open_writer(self, bucket, key, mime = "application/json", part_size = S3_PART_SIZE):
+        return LocalFileWriter(self.get_path(bucket, key))
+
+class LocalFileWriter:
+    """
+    LocalFileWriter writes to a temporary file that replaces the target on close,
+    readers never see a partial file
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.file = open(self.tmp, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.file.write(data)
+
+    def close(self):
+        with timer(STAGE_UPLOAD):
+            self.file.close()
+            os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+class MemoryStorage:
+    """
+    MemoryStorage objects in a dict of the process, for tests and hermetic benchmarks
+    """
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def get_object(self, bucket, key):
+        with self.lock:
+            body = self.objects.get((bucket, key))
+        if body is None:
+            raise FileNotFoundError(f"{bucket}/{key}")
+        return body
+
+    def get_range(self, bucket, key, start, size):
+        return self.get_object(bucket, key)[start:start + size]
+
+    def map_object(self, bucket, key):
+        return memoryview(self.get_object(bucket, key))
+
+    def put_object(self, bucket, key, body, mime = "application/json"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        with self.lock:
+            self.objects[(bucket, key)] = bytes(body)
+
+    def open_writer(self, bucket, key, mime = "application/json", part_size = S3_PART_SIZE):
+        return MemoryWriter(self, bucket, key)
+
+class MemoryWriter:
+    """
+    MemoryWriter buffers writes and stores the object on close
+    """
+    def __init__(self, storage, bucket, key):
+        self.storage = storage
+        self.bucket = bucket
+        self.key = key
+        self.buffer = BytesIO()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.buffer.write(data)
+
+    def close(self):
+        self.storage.put_object(self.bucket, self.key, self.buffer.getvalue())
+
+    def abort(self):
+        self.buffer = BytesIO()
+
+def open_writer(bucket, key, mime = "application/json", part_size = S3_PART_SIZE):
+    """
+    open_writer() opens a streaming writer on the storage of the bucket,
+    S3StreamWriter on S3
+
+    :param bucket: bucket name or uri
+    :param key: object key
+    :param mime: (optional) content type
+    :param part_size: (optional) part size of the S3 multipart upload
+    :return: writer with write(), close() and abort(), also a context manager
+    """
+    storage, name = get_storage(bucket)
+    return storage.open_writer(name, key, mime, part_size)
+
+def put_json_items(bucket, key, items, part_size = S3_PART_SIZE):
+    """
+    put_json_items() serializes a list of items one at a time into the writer of
+    the storage (S3StreamWriter on S3).
+    The output is byte-identical to put_object(bucket, key, dumps(items))
+    without materializing the whole json string.
+
+    :param bucket: bucket name or uri
+    :param key: object key
+    :param items: list of json serializable items
+    :param part_size: (optional) part size of the multipart upload
+    """
+    with open_writer(bucket, key, "application/json", part_size) as writer:
+        writer.write(b"[")
+        for idx, item in enumerate(items):
+            if idx > 0:
+                writer.write(b",")
+            writer.write(dumps(item))
+        writer.write(b"]")
+
+class MemoryReader(io.RawIOBase):
+    """
+    MemoryReader read only file object over a buffer (bytes, memoryview or mmap),
+    the decoders read it in chunks without copying the whole buffer first
+    """
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.buffer) - self.position))
+        b[:n] = self.buffer[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+def open_image(body):
+    """
+    open_image() decodes an image, Image.open is lazy so the decode is forced here
+    to be timed as its own stage
 
-def load_from_s3(bucket, key):
+    :param body: bytes or memoryview of the image
+    :return: Image object
+    """
+    with timer(STAGE_DECODE):
+        image = Image.open(BytesIO(body) if isinstance(body, bytes) else MemoryReader(body))
+        image.load()
+    return image
+
+def load_from_s3(bucket, key, pack = None):
     """
     load_from_s3() get_object from S3 and loads it into Image.
 
     :param bucket: S3 bucket name
     :param key: S3 object key
+    :param pack: (optional) FramePack read instead of the object if it has the frame
     :return: Image object
     """
+    if pack is not None and pack.has(key):
+        return open_image(pack.read(key))
     bytes = get_object(bucket, key)
-    return Image.open(BytesIO(bytes))
+    return open_image(bytes)
+
+def load_images_from_s3(bucket, keys, concurrency = S3_CONCURRENCY, pack = None, decode = open_image):
+    """
+    load_images_from_s3() prefetches objects from S3 in parallel and loads them into Image.
+
+    :param bucket: S3 bucket name
+    :param keys: list of S3 object keys
+    :param concurrency: (optional) number of parallel GETs
+    :param pack: (optional) FramePack of the frames, decoded in the prefetch threads
+    :param decode: (optional) decoder of a body, open_image or one returning tensors
+    :return: generator of Image object, in the order of keys
+    """
+    if pack is not None:
+        yield from pack.map_frames(decode, keys, concurrency)
+        return
+
+    for body in get_objects(bucket, keys, concurrency):
+        yield decode(body)
+
+def load_images_with_results(bucket, keys, result_cache = None, concurrency = S3_CONCURRENCY, pack = None, decode = open_image):
+    """
+    load_images_with_results() prefetches the images like load_images_from_s3() and looks
+    up their results in the result cache, in the prefetch threads
+
+    :param bucket: S3 bucket name
+    :param keys: list of S3 object keys
+    :param result_cache: (optional) ResultCache, None skips the hashing and the lookup
+    :param concurrency: (optional) number of parallel GETs
+    :param pack: (optional) FramePack of the frames
+    :param decode: (optional) decoder of a body, open_image or one returning tensors
+    :return: generator of (Image object, content hash, cached result or None), in the order of keys
+    """
+    if result_cache is None:
+        for image in load_images_from_s3(bucket, keys, concurrency, pack, decode):
+            yield image, None, None
+        return
+
+    def lookup(body):
+        image = decode(body)
+        content_hash = get_content_hash(image)
+        return image, content_hash, result_cache.get(content_hash)
+
+    if pack is not None:
+        yield from pack.map_frames(lookup, keys, concurrency)
+        return
+
+    yield from map_objects(lambda key: lookup(get_object(bucket, key)), keys, concurrency)
 
 def load_from_s3uri(s3uri):
     """
     load_from_s3uri() get_object from S3 and loads it into Image.
 
-    :param s3uri: in a format of s3://bucket/key
+    :param s3uri: in a format of s3://bucket/key, file:// and memory:// also work
     :return: Image object
     """
-    url = urlparse(s3uri)
-    bucket = url.netloc
-    key = url.path[1:]
-
+    bucket, key = split_uri(s3uri)
     return load_from_s3(bucket, key)
 
 def load_from_file(file):
@@ -136,3 +1184,337 @@ def quit_now(context):
         and context.get_remaining_time_in_millis() <= 60000):
         return True
     return False
+
+def get_progress_key(prefix, output):
+    """
+    get_progress_key() key of the progress manifest of an output
+
+    :param prefix: prefix of the output
+    :param output: name of the output json file
+    :return: key
+    """
+    return os.path.join(prefix, f"{os.path.splitext(output)[0]}{PROGRESS_SUFFIX}")
+
+def load_progress(bucket, prefix, output, tsta):
+    """
+    load_progress() loads the progress manifest of the current run. The manifest is
+    a small object, re-entries use it to decide whether work remains before loading
+    the frames, the results of the previous run and the models.
+
+    :param bucket: bucket of the output
+    :param prefix: prefix of the output
+    :param output: name of the output json file
+    :param tsta: start time of the run, a manifest left by another run is ignored
+    :return: { processed, total, tsta } or None
+    """
+    try:
+        progress = loads(get_object(bucket, get_progress_key(prefix, output)))
+    except Exception:
+        return None
+
+    if progress.get("tsta") != tsta:
+        return None
+    return progress
+
+def save_progress(bucket, prefix, output, tsta, processed, total):
+    """
+    save_progress() saves the progress manifest, must be called after the output is uploaded
+
+    :param bucket: bucket of the output
+    :param prefix: prefix of the output
+    :param output: name of the output json file
+    :param tsta: start time of the run
+    :param processed: number of frames processed
+    :param total: total number of frames
+    :return: progress manifest
+    """
+    progress = {
+        "output": output,
+        "processed": processed,
+        "total": total,
+        "tsta": tsta
+    }
+    put_object(bucket, get_progress_key(prefix, output), dumps(progress), "application/json")
+    return progress
+
+def get_content_hash(image):
+    """
+    get_content_hash() hash of the decoded pixels, identical frames have the same
+    hash whatever their file name, format or metadata
+
+    :param image: Image object or RGB tensor of [3, H, W]
+    :return: sha256 hex digest of the mode, size and pixels of the image
+    """
+    digest = hashlib.sha256()
+    if hasattr(image, "getbands"):
+        digest.update(f"{image.mode}:{image.size}".encode("utf-8"))
+        digest.update(image.tobytes())
+    else:
+        # same digest as the RGB Image object of the same pixels
+        digest.update(f"RGB:{(image.shape[-1], image.shape[-2])}".encode("utf-8"))
+        digest.update(image.permute(1, 2, 0).contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+def get_labels_hash(labels):
+    """
+    get_labels_hash() hash of a label set, the order of the labels matters
+
+    :param labels: json serializable labels
+    :return: hex digest
+    """
+    return hashlib.sha256(dumps(labels)).hexdigest()
+
+class ResultCache:
+    """
+    ResultCache per frame inference results in a shared store, under
+    <uri>/<model key>/<hash[:2]>/<hash>.json. The model key hashes the checkpoint,
+    the labels and the options that change the results. Writes run in the
+    background and are flushed by close().
+    """
+    def __init__(self, uri, model_key, writers = RESULT_CACHE_WRITERS):
+        self.bucket, prefix = split_uri(uri)
+        self.prefix = os.path.join(prefix, model_key)
+        self.executor = ThreadPoolExecutor(max_workers=writers)
+        self.futures = []
+        self.lock = threading.Lock()
+        self.stats = { "hits": 0, "misses": 0, "writes": 0, "errors": 0 }
+
+    def get_key(self, content_hash):
+        return os.path.join(self.prefix, content_hash[:2], f"{content_hash}.json")
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, content_hash):
+        """
+        get() cached result of an image, thread safe
+
+        :param content_hash: from get_content_hash()
+        :return: result or None on a miss
+        """
+        try:
+            result = loads(get_object(self.bucket, self.get_key(content_hash)))
+        except Exception:
+            self.count("misses")
+            return None
+        self.count("hits")
+        return result
+
+    def put(self, content_hash, result):
+        """
+        put() stores the result of an image in the background
+
+        :param content_hash: from get_content_hash()
+        :param result: json serializable result
+        """
+        body = dumps(result)
+        self.futures.append(self.executor.submit(
+            put_object, self.bucket, self.get_key(content_hash), body, "application/json"))
+
+    def close(self):
+        """
+        close() waits for the pending writes, a failed write is counted and skipped
+        """
+        for future in self.futures:
+            try:
+                future.result()
+                self.count("writes")
+            except Exception as e:
+                print(f"== [warn]: result cache write failed: {type(e).__name__}")
+                self.count("errors")
+        self.futures = []
+        self.executor.shutdown()
+
+    def get_stats(self):
+        """
+        get_stats() counters of the invocation
+
+        :return: { hits, misses, writes, errors, hit_rate }
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups > 0 else None
+        return stats
+
+def open_result_cache(event, **model):
+    """
+    open_result_cache() opens the result cache if enabled by the event or RESULT_CACHE_URI
+
+    :param event: optional "result_cache": uri of the store, or false to disable
+    :param model: checkpoint(s), label hashes and options that change the results
+    :return: ResultCache or None
+    """
+    uri = event.get("result_cache", RESULT_CACHE_URI)
+    if not uri:
+        return None
+
+    model_key = hashlib.sha256(dumps({
+        "version": RESULT_CACHE_VERSION,
+        **model
+    })).hexdigest()[:16]
+    print(f"== [info]: result cache: {uri}, model key: {model_key}, {model}")
+    return ResultCache(uri, model_key)
+
+class FramePack:
+    """
+    FramePack reads the frames of a pack, see write_frame_pack(). Consecutive members
+    are read together by one ranged GET, or sliced from the mapped pack, and decoded
+    from memoryviews of the buffer. Frames missing from the pack are read as objects.
+    """
+    def __init__(self, bucket, key, mode = "range"):
+        """
+        :param bucket: bucket name or uri
+        :param key: key of the pack
+        :param mode: (optional) "range" or "mmap", see FRAME_PACK_MODES
+        """
+        if mode not in FRAME_PACK_MODES:
+            raise ValueError(f"invalid frames pack mode: {mode}")
+
+        self.bucket = bucket
+        self.key = key
+        self.directory = os.path.dirname(key)
+        self.storage, self.name = get_storage(bucket)
+        self.buffer = None
+        self.requests = 0
+
+        index = None
+        try:
+            index = loads(get_object(bucket, f"{key}{FRAME_PACK_INDEX_SUFFIX}"))
+        except Exception:
+            print(f"== [warn]: no index of {key}, the pack is mapped and scanned")
+
+        # ranged reads need the offset table, local files are mapped for free
+        if mode == "mmap" or index is None or isinstance(self.storage, (LocalStorage, MemoryStorage)):
+            self.buffer = self.storage.map_object(self.name, key)
+        if index is None:
+            index = self.scan()
+        self.index = { os.path.join(self.directory, name): entry for name, entry in index.items() }
+        print(f"== [info]: frames pack {key}: {len(self.index)} frames, {'mapped' if self.buffer is not None else 'ranged reads'}")
+
+    def scan(self):
+        """
+        scan() offset table of a mapped tar without an index
+
+        :return: { member name: [offset, size] }
+        """
+        with tarfile.open(fileobj=MemoryReader(self.buffer), mode="r:") as tar:
+            return {
+                member.name: [member.offset_data, member.size]
+                for member in tar.getmembers() if member.isfile()
+            }
+
+    def has(self, key):
+        return key in self.index
+
+    def get_spans(self, keys):
+        """
+        get_spans() groups the keys into the reads of the pack
+
+        :param keys: list of frame keys
+        :return: list of (start, size, [(key, offset, size), ...]), start is None for
+            a frame read as an object
+        """
+        spans = []
+        for key in keys:
+            entry = self.index.get(key)
+            if entry is None:
+                spans.append((None, 0, [(key, 0, 0)]))
+                continue
+
+            offset, size = entry
+            if len(spans) > 0 and spans[-1][0] is not None:
+                start, span_size, members = spans[-1]
+                end = start + span_size
+                if (offset >= end
+                        and offset - end <= FRAME_PACK_MAX_GAP
+                        and offset + size - start <= FRAME_PACK_RANGE_SIZE
+                        and len(members) < FRAME_PACK_RANGE_FRAMES):
+                    members.append((key, offset, size))
+                    spans[-1] = (start, offset + size - start, members)
+                    continue
+            spans.append((offset, size, [(key, offset, size)]))
+        return spans
+
+    def read_span(self, span):
+        """
+        read_span() bodies of the frames of a span
+
+        :param span: (start, size, members) from get_spans()
+        :return: list of memoryview or bytes
+        """
+        start, size, members = span
+        if start is None:
+            return [get_object(self.bucket, key) for key, _, _ in members]
+
+        if self.buffer is not None:
+            buffer, base = memoryview(self.buffer), 0
+        else:
+            buffer, base = memoryview(self.storage.get_range(self.name, self.key, start, size)), start
+            self.requests += 1
+        return [buffer[offset - base:offset - base + length] for _, offset, length in members]
+
+    def read(self, key):
+        """
+        read() body of one frame
+
+        :param key: frame key
+        :return: memoryview or bytes
+        """
+        return self.read_span(self.get_spans([key])[0])[0]
+
+    def map_frames(self, fn, keys, concurrency = S3_CONCURRENCY):
+        """
+        map_frames() reads the spans in parallel and runs fn(body) on their frames in
+        the prefetch threads. The number of spans in flight is scaled down so about
+        2 x concurrency frames are buffered, as with get_objects().
+
+        :param fn: function of a frame body
+        :param keys: list of frame keys
+        :param concurrency: (optional) number of parallel GETs of single frames
+        :return: generator of results, in the order of keys
+        """
+        spans = self.get_spans(keys)
+        workers = max(1, concurrency // FRAME_PACK_RANGE_FRAMES)
+        for results in map_objects(lambda span: [fn(body) for body in self.read_span(span)], spans, workers):
+            yield from results
+
+def open_frame_pack(event, bucket, prefix):
+    """
+    open_frame_pack() opens the frames pack of the event
+
+    :param event: optional "frames_pack": name of the pack under the prefix and
+        "frames_pack_mode": "range" (default) or "mmap"
+    :param bucket: bucket of the frames
+    :param prefix: prefix of the frames
+    :return: FramePack or None
+    """
+    if not event.get("frames_pack"):
+        return None
+    return FramePack(bucket, os.path.join(prefix, event["frames_pack"]), event.get("frames_pack_mode", "range"))
+
+def write_frame_pack(bucket, key, frames):
+    """
+    write_frame_pack() bundles frames into an uncompressed tar and writes its offset
+    table next to it. Keep the Content-Encoding off (the default), ranged reads need
+    the raw bytes.
+
+    :param bucket: bucket name or uri
+    :param key: key of the pack, e.g. <prefix>/frames.tar
+    :param frames: iterable of (name relative to the directory of the pack, bytes)
+    :return: { member name: [offset, size] }
+    """
+    buffer = BytesIO()
+    index = {}
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.USTAR_FORMAT) as tar:
+        for name, body in frames:
+            info = tarfile.TarInfo(name)
+            info.size = len(body)
+            # a ustar header is one block, the data follows
+            index[name] = [tar.offset + tarfile.BLOCKSIZE, len(body)]
+            tar.addfile(info, BytesIO(body))
+
+    put_object(bucket, key, buffer.getvalue(), "application/x-tar")
+    put_object(bucket, f"{key}{FRAME_PACK_INDEX_SUFFIX}", dumps(index), "application/json")
+    return index
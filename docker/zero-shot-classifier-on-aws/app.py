@@ -1,16 +1,35 @@
 # pyright: reportMissingImports=false, reportMissingModuleSource=false
 import traceback
 import os
+import io
 import json
 import time
-import torch
-from PIL import Image
-from transformers import AutoProcessor, AutoModelForZeroShotImageClassification
-from utils import get_object, put_object, load_from_file, load_from_s3, quit_now
+from metrics import timer, reset_metrics, emit_metrics, start_profiler, stop_profiler, STAGE_PREPROCESS, STAGE_FORWARD, STAGE_POSTPROCESS
+from sizing import start_sizer
+from decode import get_decoder, preprocess
+from utils import parse_bool, get_object, put_object, put_json_items, loads, to_embeddings, set_embedding_precision, EMBEDDING_PRECISION, load_from_file, load_from_s3, load_images_with_results, open_frame_pack, open_result_cache, get_labels_hash, quit_now, load_progress, save_progress, LazyModule, get_cache_stats, reset_cache_stats, S3_CONCURRENCY, set_content_encoding, CONTENT_ENCODING
+
+# heavy modules are imported on first use, see LazyModule
+torch = LazyModule("torch")
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
+transformers = LazyModule("transformers")
 
 DEFAULT_CLASSES_JSON = "default_classes.json"
 CLS_CHECKPOINT = "openai/clip-vit-large-patch14"
 
+# switch to large vocabulary mode when labelconfig has more labels than this
+LARGE_VOCABULARY_THRESHOLD = 512
+# number of labels tokenized and encoded per text forward pass
+LABEL_ENCODE_CHUNK_SIZE = 256
+# number of label embeddings scored per matmul
+LABEL_SCORE_CHUNK_SIZE = 8192
+# encoded label banks are stored next to the output, <prefix>/_label_bank/<hash>.npy
+LABEL_BANK_PREFIX = "_label_bank"
+
+# label bank encoded by the warm container, keyed by (checkpoint, labels)
+_label_bank_cache = {}
+
 def load_cls_model(checkpoint = CLS_CHECKPOINT):
     """
     load_cls_model() load classification model
@@ -18,8 +37,8 @@ def load_cls_model(checkpoint = CLS_CHECKPOINT):
     :param checkpoint: (optional) model checkpoint
     :return: model, processor
     """
-    model = AutoModelForZeroShotImageClassification.from_pretrained(checkpoint)
-    processor = AutoProcessor.from_pretrained(checkpoint)
+    model = transformers.AutoModelForZeroShotImageClassification.from_pretrained(checkpoint)
+    processor = transformers.AutoProcessor.from_pretrained(checkpoint)
     return model, processor
 
 def run_classification(
@@ -36,10 +55,11 @@ def run_classification(
     :param text_labels: zero shot labels
     :return: { label, score, embeddings } where embeddings size is 768
     """
-    inputs = processor(text = labels, images = image, return_tensors = "pt", padding = True)
+    with timer(STAGE_PREPROCESS):
+        inputs = preprocess(processor, images = image, text = labels, return_tensors = "pt", padding = True)
     outputs = None
 
-    with torch.no_grad():
+    with torch.no_grad(), timer(STAGE_FORWARD):
         outputs = model(**inputs)
 
     logits = outputs.logits_per_image[0]
@@ -53,7 +73,7 @@ def run_classification(
         print("FAILED TO FIND LABEL")
         return None
 
-    image_embeddings = outputs.image_embeds.cpu().numpy().tolist()[0]
+    image_embeddings = to_embeddings(outputs.image_embeds)[0]
     item = {
         "label": result[0]["label"],
         "score": round(float(result[0]["score"]), 3),
@@ -61,6 +81,184 @@ def run_classification(
     }
     return item
 
+def normalize_embeddings(embeddings):
+    """
+    normalize_embeddings() L2 normalizes embeddings the same way the CLIP model does
+
+    :param embeddings: tensor of [N, dim]
+    :return: normalized tensor of [N, dim]
+    """
+    norm = torch.pow(torch.sum(torch.pow(embeddings, 2), dim=-1, keepdim=True), 0.5)
+    return embeddings / norm
+
+def get_label_bank_key(prefix, checkpoint, labels):
+    return os.path.join(prefix, LABEL_BANK_PREFIX, f"{get_labels_hash([checkpoint, labels])}.npy")
+
+def load_label_bank(bucket, key):
+    """
+    load_label_bank() loads the label embeddings stored by a previous invocation
+
+    :param bucket: bucket of the output
+    :param key: key of the label bank
+    :return: tensor of [N, dim], N may be less than the number of labels, or None
+    """
+    try:
+        body = get_object(bucket, key)
+    except Exception:
+        return None
+    return torch.from_numpy(np.load(io.BytesIO(body)))
+
+def save_label_bank(bucket, key, label_bank):
+    buffer = io.BytesIO()
+    np.save(buffer, label_bank.numpy())
+    put_object(bucket, key, buffer.getvalue(), "application/octet-stream")
+
+def encode_label_bank(
+        model,
+        processor,
+        labels,
+        checkpoint = CLS_CHECKPOINT,
+        chunk_size = LABEL_ENCODE_CHUNK_SIZE,
+        context = None,
+        bucket = None,
+        prefix = None):
+    """
+    encode_label_bank() encodes labels into a normalized text embedding matrix.
+    The matrix is cached so that re-entries of a warm container skip the text encoding,
+    and stored under <prefix>/_label_bank/ with a bucket so that a cold start does not
+    encode the labels again. When quit_now(), the labels encoded so far are stored and
+    the next entry resumes from them.
+
+    :param model: classification model
+    :param processor: classification processor
+    :param labels: zero shot labels
+    :param checkpoint: (optional) model checkpoint, part of the cache key
+    :param chunk_size: (optional) number of labels to encode per forward pass
+    :param context: (optional) lambda context
+    :param bucket: (optional) bucket of the output, to store the label bank
+    :param prefix: (optional) prefix of the output
+    :return: tensor of [len(labels), dim] or None if the time is up
+    """
+    cache_key = (checkpoint, tuple(labels))
+    if cache_key in _label_bank_cache:
+        return _label_bank_cache[cache_key]
+
+    key = None
+    text_embeds = []
+    if bucket is not None:
+        key = get_label_bank_key(prefix, checkpoint, labels)
+        stored = load_label_bank(bucket, key)
+        if stored is not None:
+            text_embeds.append(stored)
+    encoded = sum(len(embeds) for embeds in text_embeds)
+    if encoded > 0:
+        print(f"== [info]: loaded label bank: {encoded}/{len(labels)} labels")
+
+    for idx in range(encoded, len(labels), chunk_size):
+        if quit_now(context):
+            if key is not None and idx > encoded:
+                save_label_bank(bucket, key, torch.cat(text_embeds))
+            print(f"== [info]: label bank: {idx}/{len(labels)} labels encoded before quit")
+            return None
+        inputs = processor(text = labels[idx:idx + chunk_size], return_tensors = "pt", padding = True)
+        with torch.no_grad():
+            text_embeds.append(normalize_embeddings(model.get_text_features(**inputs)))
+    label_bank = torch.cat(text_embeds)
+    if key is not None and encoded < len(labels):
+        save_label_bank(bucket, key, label_bank)
+
+    _label_bank_cache.clear()
+    _label_bank_cache[cache_key] = label_bank
+    return label_bank
+
+def score_label_bank(
+        image_embeds,
+        label_bank,
+        logit_scale,
+        top_k = 1,
+        chunk_size = LABEL_SCORE_CHUNK_SIZE):
+    """
+    score_label_bank() scores image embeddings against the label bank chunk by chunk.
+    Only the running top-k and the running logsumexp are kept, so the scores are the
+    softmax probabilities over the full label bank without materializing it.
+
+    :param image_embeds: normalized image embeddings, tensor of [N, dim]
+    :param label_bank: normalized label embeddings, tensor of [L, dim]
+    :param logit_scale: CLIP logit scale (already exponentiated)
+    :param top_k: (optional) number of labels to return per image
+    :param chunk_size: (optional) number of labels to score per matmul
+    :return: scores, indices, both tensor of [N, top_k]
+    """
+    top_k = min(top_k, label_bank.shape[0])
+    top_logits = None
+    top_indices = None
+    lse = None
+
+    for idx in range(0, label_bank.shape[0], chunk_size):
+        logits = torch.matmul(image_embeds, label_bank[idx:idx + chunk_size].t()) * logit_scale
+
+        chunk_lse = torch.logsumexp(logits, dim=-1)
+        lse = chunk_lse if lse is None else torch.logaddexp(lse, chunk_lse)
+
+        chunk_logits, chunk_indices = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1)
+        chunk_indices = chunk_indices + idx
+        if top_logits is not None:
+            chunk_logits = torch.cat((top_logits, chunk_logits), dim=-1)
+            chunk_indices = torch.cat((top_indices, chunk_indices), dim=-1)
+        top_logits, positions = torch.topk(chunk_logits, top_k, dim=-1)
+        top_indices = torch.gather(chunk_indices, -1, positions)
+
+    scores = torch.exp(top_logits - lse.unsqueeze(-1))
+    return scores, top_indices
+
+def run_large_vocabulary_classification(
+        model,
+        processor,
+        image,
+        labels,
+        label_bank,
+        top_k = 1):
+    """
+    run_large_vocabulary_classification() runs classification against a pre-encoded label bank
+
+    :param model: classification model
+    :param processor: classification processor
+    :param image: image to inference
+    :param labels: zero shot labels
+    :param label_bank: normalized label embeddings from encode_label_bank
+    :param top_k: (optional) number of labels to return
+    :return: { label, score, embeddings, top_k? } where embeddings size is 768
+    """
+    if len(labels) == 0:
+        print("FAILED TO FIND LABEL")
+        return None
+
+    with timer(STAGE_PREPROCESS):
+        inputs = preprocess(processor, images = image, return_tensors = "pt")
+
+    with torch.no_grad():
+        with timer(STAGE_FORWARD):
+            image_embeds = normalize_embeddings(model.get_image_features(**inputs))
+        with timer(STAGE_POSTPROCESS):
+            scores, indices = score_label_bank(
+                image_embeds,
+                label_bank,
+                model.logit_scale.exp(),
+                top_k)
+
+    result = [
+        {"label": labels[index], "score": round(float(score), 3)}
+        for score, index in zip(scores[0].tolist(), indices[0].tolist())
+    ]
+
+    item = {
+        **result[0],
+        "embeddings": to_embeddings(image_embeds)[0],
+    }
+    if top_k > 1:
+        item["top_k"] = result
+    return item
+
 def load_labels(event):
     """
     load_labels() loads labels. If labelconfig present, loads labels from s3. Otherwise, use default_classes.json
@@ -87,8 +285,7 @@ def load_previous_run(bucket, prefix, output):
 
     try:
         key = os.path.join(prefix, output)
-        item_embeddings = get_object(bucket, key).decode('utf-8')
-        item_embeddings = json.loads(item_embeddings)
+        item_embeddings = loads(get_object(bucket, key))
     except:
         pass
     return item_embeddings
@@ -118,7 +315,10 @@ def process_image(
         labels,
         bucket,
         prefix,
-        name):
+        name,
+        label_bank = None,
+        top_k = 1,
+        image = None):
     """
     process_image() process per image
 
@@ -128,17 +328,29 @@ def process_image(
     :param bucket: bucket of the image
     :param prefix: prefix of the image
     :param name: name of the image
+    :param label_bank: (optional) pre-encoded labels, enables large vocabulary mode
+    :param top_k: (optional) number of labels to return in large vocabulary mode
+    :param image: (optional) prefetched Image object of the image
     :return: { label, score, embeddings, name }
     """
-    key = os.path.join(prefix, name)
-
-    image = load_from_s3(bucket, key)
-
-    embedding_item = run_classification(
-        cls_model,
-        cls_processor,
-        image,
-        labels)
+    if image is None:
+        key = os.path.join(prefix, name)
+        image = load_from_s3(bucket, key)
+
+    if label_bank is not None:
+        embedding_item = run_large_vocabulary_classification(
+            cls_model,
+            cls_processor,
+            image,
+            labels,
+            label_bank,
+            top_k)
+    else:
+        embedding_item = run_classification(
+            cls_model,
+            cls_processor,
+            image,
+            labels)
 
     if embedding_item != None:
         return {
@@ -150,18 +362,22 @@ def process_image(
 def set_completed(event, params = {}):
     if "next_index" in event:
         del event["next_index"]
+    emit_metrics()
     return {
         **event,
         **params,
+        "s3cache": get_cache_stats(event.get("s3cache", {})),
         "tend": round(time.time() * 1000),
         "status": "COMPLETED"
     }
 
 def set_progress(event, params = {}):
+    emit_metrics()
     print(f"== [info]: set_progress.before: {event}, {params}")
     _params = {
         **event,
         **params,
+        "s3cache": get_cache_stats(event.get("s3cache", {})),
         "status": "IN_PROGRESS"
     }
     print(f"== [info]: set_progress.after: {_params}")
@@ -171,7 +387,13 @@ def lambda_handler(event, context):
     """
     lambda_handler() lambda entrypoint
     """
+    profiler = None
     try:
+        reset_cache_stats()
+        reset_metrics()
+        set_embedding_precision(event.get("precision", EMBEDDING_PRECISION))
+        set_content_encoding(event.get("content_encoding", CONTENT_ENCODING), event.get("compression_level"))
+
         print("event =", json.dumps(event, indent=2))
 
         # special case
@@ -193,11 +415,23 @@ def lambda_handler(event, context):
         else:
             event["tsta"] = tsta
 
-        # load framesegmentation json
+        # the progress manifest of this run decides whether work remains before the
+        # frames, the results of the previous run and the models are loaded
         next_index = 0 if "next_index" not in event else int(event["next_index"])
+        progress = load_progress(bucket, prefix, output, tsta)
+        if progress is not None:
+            print(f"== [info]: loaded progress: processed: {progress['processed']}, total: {progress['total']}")
+            # the manifest is saved after the output, it is ahead of the event
+            # when the previous entry uploaded the output but did not return
+            next_index = int(progress["processed"])
+            if next_index >= int(progress["total"]):
+                return set_completed(event)
+
+        # load framesegmentation json
         key = os.path.join(prefix, event["json"])
         names = json.loads(get_object(bucket, key))
-        print(f"== [info]: loaded {event['json']}: names: {len(names)}")
+        total = len(names)
+        print(f"== [info]: loaded {event['json']}: names: {total}")
 
         # no more frame to process?
         names = [ item["name"] for item in names[next_index:] ]
@@ -208,8 +442,16 @@ def lambda_handler(event, context):
 
         # load label config
         labels = load_labels(event)
-        item_embeddings = load_previous_run(bucket, prefix, output)
-        print(f"== [info]: loaded {event['embeddings']}: item_embeddings: {len(item_embeddings)}")
+        if len(labels) == 0:
+            raise ValueError("empty label list")
+        # on-demand profiling of the first N frames, off unless requested
+        profiler = start_profiler(event)
+
+        # results of the previous entries of this run, the first entry starts afresh
+        item_embeddings = []
+        if next_index > 0:
+            item_embeddings = load_previous_run(bucket, prefix, output)
+            print(f"== [info]: loaded {event['embeddings']}: item_embeddings: {len(item_embeddings)}")
 
         print(f"=== LOADING MODELS ===")
         t0 = time.time()
@@ -217,50 +459,141 @@ def lambda_handler(event, context):
         t1 = time.time()
         print(f"=== CLASSIFICATION MODEL LOADED: {round(t1 - t0)}s")
 
-        # count = 0
-        while not quit_now(context) and len(names) > 0:
-            name = names.pop(0)
-            # print(f"=== PROCESSING: {name}")
+        # large vocabulary mode encodes the labels once instead of per image
+        label_bank = None
+        top_k = int(event.get("top_k", 1))
+        if parse_bool(event.get("large_vocabulary"), len(labels) > LARGE_VOCABULARY_THRESHOLD):
             t0 = time.time()
-            image_embedding = process_image(
+            label_bank = encode_label_bank(
                 cls_model,
                 cls_processor,
                 labels,
-                bucket,
-                prefix,
-                name
-            )
+                cls_model.name_or_path,
+                context=context,
+                bucket=bucket,
+                prefix=prefix)
             t1 = time.time()
-            print(f"=== PROCESSED: {name} ({round(t1 - t0, 3)}s)")
-            item_embeddings.append(image_embedding)
-            # # TESTING
-            # count += 1
-            # if count > 20:
-            #     break
+            # the next entry resumes from the stored labels
+            if label_bank is None:
+                if profiler is not None:
+                    profiler.stop()
+                return set_progress(event, {
+                    "next_index": next_index
+                })
+            print(f"=== LABEL BANK ENCODED: {len(labels)} labels, {round(t1 - t0, 3)}s")
+
+        # prefetch depth sized from the memory limit unless set by "concurrency",
+        # frames are processed one at a time
+        sizer = start_sizer(event, context, S3_CONCURRENCY, 1)
+
+        # PIL images or uint8 tensors decoded by torchvision, see decode.py
+        decoder, decode = get_decoder(event)
+
+        # results of identical frames seen before with the same model and labels, off by default
+        result_cache = open_result_cache(
+            event,
+            checkpoint=cls_model.name_or_path,
+            labels=get_labels_hash(labels),
+            large_vocabulary=label_bank is not None,
+            top_k=top_k,
+            precision=event.get("precision", EMBEDDING_PRECISION),
+            decoder=decoder)
+
+        # frames bundled in one pack are read with a few ranged GETs instead of one GET per frame
+        pack = open_frame_pack(event, bucket, prefix)
+
+        # prefetch the images in parallel while the model is running
+        images = load_images_with_results(
+            bucket,
+            [os.path.join(prefix, name) for name in names],
+            result_cache,
+            sizer.concurrency,
+            pack,
+            decode)
+
+        # count = 0
+        # the prefetch stops downloading when the loop ends or raises
+        try:
+            while not quit_now(context) and len(names) > 0:
+                name = names.pop(0)
+                # print(f"=== PROCESSING: {name}")
+                t0 = time.time()
+                image, content_hash, cached = next(images)
+                if cached is not None:
+                    image_embedding = {
+                        **cached,
+                        "name": name
+                    }
+                else:
+                    with sizer.measure(1):
+                        image_embedding = process_image(
+                            cls_model,
+                            cls_processor,
+                            labels,
+                            bucket,
+                            prefix,
+                            name,
+                            label_bank,
+                            top_k,
+                            image
+                        )
+                    if result_cache is not None and image_embedding is not None:
+                        result_cache.put(content_hash, {
+                            k: v for k, v in image_embedding.items() if k != "name"
+                        })
+                t1 = time.time()
+                print(f"=== PROCESSED: {name} ({round(t1 - t0, 3)}s)")
+                item_embeddings.append(image_embedding)
+                if profiler is not None:
+                    profiler.step()
+                # # TESTING
+                # count += 1
+                # if count > 20:
+                #     break
+        finally:
+            images.close()
+
+        result_stats = {}
+        if result_cache is not None:
+            result_cache.close()
+            result_stats = { "resultcache": result_cache.get_stats() }
+            print(f"== [info]: result cache: {result_stats['resultcache']}")
 
         print(f"== [info]: completed {event['embeddings']}: item_embeddings: {len(item_embeddings)}, names: {len(names)}")
 
         # upload json output
         output_key = os.path.join(prefix, output)
-        put_object(
+        put_json_items(
             bucket,
             output_key,
-            json.dumps(item_embeddings, default=str),
-            "application/json")
+            item_embeddings)
 
         tend = round(time.time() * 1000)
         print(f"== TOTAL RUNTIME: {round((tend - tsta) / 1000)}s ==")
 
+        # frames processed so far
+        print(f"== [info]: next_index.before = {next_index}, .after = {total - len(names)}")
+        next_index = total - len(names)
+        save_progress(bucket, prefix, output, tsta, next_index, total)
+
+        # the profile covers the output upload and the progress manifest
+        stop_profiler(profiler, event, bucket, prefix, getattr(context, "aws_request_id", None))
+
         # update event for the next re-entry of the lambda
         if len(names) == 0:
-            return set_completed(event)
+            return set_completed(event, {
+                "sizing": sizer.get_settings(),
+                **result_stats
+            })
 
-        print(f"== [info]: next_index.before = {next_index}, .after = {len(item_embeddings)}");
-        next_index = len(item_embeddings)
         return set_progress(event, {
-            "next_index": next_index
+            "next_index": next_index,
+            "sizing": sizer.get_settings(),
+            **result_stats
         })
     except Exception as e:
+        if profiler is not None:
+            profiler.stop()
         print(f"[ERR]: {type(e).__name__}")
         traceback.print_exc()
         raise e
@@ -3,9 +3,14 @@ import os
 import json
 import time
 import traceback
-import torch
-from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
-from utils import get_object, put_object, load_from_file, load_from_s3, quit_now
+from metrics import timer, reset_metrics, emit_metrics, start_profiler, stop_profiler, STAGE_PREPROCESS, STAGE_FORWARD, STAGE_POSTPROCESS
+from sizing import start_sizer
+from decode import get_decoder, preprocess, is_tensor, get_image_size
+from utils import get_object, put_object, put_json_items, loads, load_from_file, load_from_s3, load_images_with_results, open_frame_pack, open_result_cache, get_labels_hash, quit_now, load_progress, save_progress, LazyModule, get_cache_stats, reset_cache_stats, S3_CONCURRENCY, set_content_encoding, CONTENT_ENCODING
+
+# heavy modules are imported on first use, see LazyModule
+torch = LazyModule("torch")
+transformers = LazyModule("transformers")
 
 CHECKPOINT = "google/owlvit-base-patch32"
 DEFAULT_CLASSES_JSON = "default_classes.json"
@@ -18,8 +23,8 @@ def load_model(checkpoint = CHECKPOINT):
     :return: model, processor
     """
     t0 = time.time()
-    model = AutoModelForZeroShotObjectDetection.from_pretrained(checkpoint)
-    processor = AutoProcessor.from_pretrained(checkpoint)
+    model = transformers.AutoModelForZeroShotObjectDetection.from_pretrained(checkpoint)
+    processor = transformers.AutoProcessor.from_pretrained(checkpoint)
     t1 = time.time()
     print(f"=== Loading model: {round(t1 - t0, 3)}s")
     return model, processor
@@ -39,18 +44,21 @@ def run_model(
     :return: [{ label, score, box: {l, t, w, h} }, ...]
     """
     outputs = None
-    w, h = image.size
-    _image = image.convert("RGB")
-    inputs = processor(images=_image, text=candidate_labels, return_tensors="pt")
+    w, h = get_image_size(image)
+    with timer(STAGE_PREPROCESS):
+        _image = image if is_tensor(image) else image.convert("RGB")
+        inputs = preprocess(processor, images=_image, text=candidate_labels, return_tensors="pt")
 
     with torch.no_grad():
-        outputs = model(**inputs)
-        target_sizes = torch.tensor([_image.size[::-1]])
-        outputs = processor.post_process_object_detection(
-            outputs,
-            threshold=0.1,
-            target_sizes=target_sizes
-        )[0]
+        with timer(STAGE_FORWARD):
+            outputs = model(**inputs)
+        with timer(STAGE_POSTPROCESS):
+            target_sizes = torch.tensor([get_image_size(_image)[::-1]])
+            outputs = processor.post_process_object_detection(
+                outputs,
+                threshold=0.1,
+                target_sizes=target_sizes
+            )[0]
 
     scores = outputs["scores"].tolist()
     labels = outputs["labels"].tolist()
@@ -95,8 +103,7 @@ def load_previous_run(bucket, prefix, output):
     items = []
     try:
         key = os.path.join(prefix, output)
-        items = get_object(bucket, key).decode('utf-8')
-        items = json.loads(items)
+        items = loads(get_object(bucket, key))
     except:
         pass
     return items
@@ -123,7 +130,8 @@ def process_image(
         candidate_labels,
         bucket,
         prefix,
-        name):
+        name,
+        image = None):
     """
     process_image() process per image
 
@@ -133,12 +141,14 @@ def process_image(
     :param bucket: bucket of the image
     :param prefix: prefix of the image
     :param name: name of the image
+    :param image: (optional) prefetched Image object of the image
     :return: { name, labels }
     """
     t0 = time.time()
 
-    key = os.path.join(prefix, name)
-    image = load_from_s3(bucket, key)
+    if image is None:
+        key = os.path.join(prefix, name)
+        image = load_from_s3(bucket, key)
     labels = run_model(
         model,
         processor,
@@ -156,18 +166,22 @@ def process_image(
 def set_completed(event, params = {}):
     if "next_index" in event:
         del event["next_index"]
+    emit_metrics()
     return {
         **event,
         **params,
+        "s3cache": get_cache_stats(event.get("s3cache", {})),
         "tend": round(time.time() * 1000),
         "status": "COMPLETED"
     }
 
 def set_progress(event, params = {}):
+    emit_metrics()
     print(f"== [info]: set_progress.before: {event}, {params}")
     _params = {
         **event,
         **params,
+        "s3cache": get_cache_stats(event.get("s3cache", {})),
         "status": "IN_PROGRESS"
     }
     print(f"== [info]: set_progress.after: {_params}")
@@ -177,7 +191,12 @@ def lambda_handler(event, context):
     """
     lambda_handler() lambda entrypoint
     """
+    profiler = None
     try:
+        reset_cache_stats()
+        reset_metrics()
+        set_content_encoding(event.get("content_encoding", CONTENT_ENCODING), event.get("compression_level"))
+
         print("event =", json.dumps(event, indent=2))
 
         if "local_file" in event:
@@ -197,11 +216,23 @@ def lambda_handler(event, context):
         else:
             event["tsta"] = tsta
 
-        # load framesegmentation json
+        # the progress manifest of this run decides whether work remains before the
+        # frames, the results of the previous run and the models are loaded
         next_index = 0 if "next_index" not in event else int(event["next_index"])
+        progress = load_progress(bucket, prefix, output, tsta)
+        if progress is not None:
+            print(f"== [info]: loaded progress: processed: {progress['processed']}, total: {progress['total']}")
+            # the manifest is saved after the output, it is ahead of the event
+            # when the previous entry uploaded the output but did not return
+            next_index = int(progress["processed"])
+            if next_index >= int(progress["total"]):
+                return set_completed(event)
+
+        # load framesegmentation json
         key = os.path.join(prefix, event["json"])
         names = json.loads(get_object(bucket, key))
-        print(f"== [info]: loaded {event['json']}: names: {len(names)}")
+        total = len(names)
+        print(f"== [info]: loaded {event['json']}: names: {total}")
 
         # no more frame to process?
         names = [ item["name"] for item in names[next_index:] ]
@@ -213,46 +244,115 @@ def lambda_handler(event, context):
         # load label config
         candidate_labels = load_labels(event)
 
-        items = load_previous_run(bucket, prefix, output)
-        print(f"== [info]: loaded {event['output']}: items: {len(items)}")
+        # on-demand profiling of the first N frames, off unless requested
+        profiler = start_profiler(event)
+
+        # results of the previous entries of this run, the first entry starts afresh
+        items = []
+        if next_index > 0:
+            items = load_previous_run(bucket, prefix, output)
+            print(f"== [info]: loaded {event['output']}: items: {len(items)}")
 
         model, processor = load_model()
 
-        while not quit_now(context) and len(names) > 0:
-            name = names.pop(0)
-            item = process_image(
-                model,
-                processor,
-                candidate_labels,
-                bucket,
-                prefix,
-                name
-            )
-            items.extend(item)
+        # prefetch depth sized from the memory limit unless set by "concurrency",
+        # frames are processed one at a time
+        sizer = start_sizer(event, context, S3_CONCURRENCY, 1)
+
+        # PIL images or uint8 tensors decoded by torchvision, see decode.py
+        decoder, decode = get_decoder(event)
+
+        # results of identical frames seen before with the same model and labels, off by default
+        result_cache = open_result_cache(
+            event,
+            checkpoint=model.name_or_path,
+            labels=get_labels_hash(candidate_labels),
+            decoder=decoder)
+
+        # frames bundled in one pack are read with a few ranged GETs instead of one GET per frame
+        pack = open_frame_pack(event, bucket, prefix)
+
+        # prefetch the images in parallel while the model is running
+        images = load_images_with_results(
+            bucket,
+            [os.path.join(prefix, name) for name in names],
+            result_cache,
+            sizer.concurrency,
+            pack,
+            decode)
+
+        # the prefetch stops downloading when the loop ends or raises
+        try:
+            while not quit_now(context) and len(names) > 0:
+                name = names.pop(0)
+                image, content_hash, cached = next(images)
+                if cached is not None:
+                    item = {
+                        "name": name,
+                        **cached
+                    }
+                else:
+                    with sizer.measure(1):
+                        item = process_image(
+                            model,
+                            processor,
+                            candidate_labels,
+                            bucket,
+                            prefix,
+                            name,
+                            image
+                        )
+                    if result_cache is not None:
+                        result_cache.put(content_hash, {
+                            k: v for k, v in item.items() if k != "name"
+                        })
+                items.append(item)
+                if profiler is not None:
+                    profiler.step()
+        finally:
+            images.close()
+
+        result_stats = {}
+        if result_cache is not None:
+            result_cache.close()
+            result_stats = { "resultcache": result_cache.get_stats() }
+            print(f"== [info]: result cache: {result_stats['resultcache']}")
 
         print(f"== [info]: completed {event['output']}: items: {len(items)}, names: {len(names)}")
 
         # upload json output
         output_key = os.path.join(prefix, output)
-        put_object(
+        put_json_items(
             bucket,
             output_key,
-            json.dumps(items, default=str),
-            "application/json")
+            items)
 
         tend = round(time.time() * 1000)
         print(f"== TOTAL RUNTIME: {round((tend - tsta) / 1000)}s ==")
 
+        # frames processed so far
+        print(f"== [info]: next_index.before = {next_index}, .after = {total - len(names)}")
+        next_index = total - len(names)
+        save_progress(bucket, prefix, output, tsta, next_index, total)
+
+        # the profile covers the output upload and the progress manifest
+        stop_profiler(profiler, event, bucket, prefix, getattr(context, "aws_request_id", None))
+
         # update event for the next re-entry of the lambda
         if len(names) == 0:
-            return set_completed(event)
+            return set_completed(event, {
+                "sizing": sizer.get_settings(),
+                **result_stats
+            })
 
-        print(f"== [info]: next_index.before = {next_index}, .after = {len(items)}")
-        next_index = len(items)
         return set_progress(event, {
-            "next_index": next_index
+            "next_index": next_index,
+            "sizing": sizer.get_settings(),
+            **result_stats
         })
     except Exception as e:
+        if profiler is not None:
+            profiler.stop()
         print(f"[ERR]: {type(e).__name__}")
         traceback.print_exc()
         raise e